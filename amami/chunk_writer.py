@@ -0,0 +1,258 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to write the data of netCDF variables after the structure of the file.
+
+netCDF3 files are defined fully (dimensions, coordinates, attributes and data
+variables) before any data is written, so that netCDF-C never has to grow the
+header and move the data already written (which happens every time a variable is
+defined after data has been written, and is quadratic in the number of variables).
+Their data is then written through memory maps (see `amami.netcdf3_writer`).
+
+The data of netCDF4 variables can also be written with multithreaded compression.
+
+The deflate filter of netCDF4/HDF5 runs single-threaded when the data is written.
+Here the structure of the file (dimensions, coordinates, attributes and the
+compressed data variables) is written first by the iris Saver, without the data.
+The data of each variable is then split into its HDF5 chunks, which are
+compressed with zlib in a thread pool (zlib releases the GIL) and written
+already compressed with HDF5 direct chunk writes.
+The chunks are compressed with the same filters (shuffle and deflate) that
+HDF5 would apply, so the result is a standard netCDF4 file.
+
+The data of a variable can also be copied from a variable with the same chunks
+and filters in another netCDF4 file, by copying its compressed chunks as they are.
+
+This requires the optional 'h5py' package.
+"""
+
+import collections
+import itertools
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import dask.array as da
+from amami.exceptions import AmamiError
+from amami.loggers import LOGGER
+from amami.packing import pack
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# netCDF formats without 64-bit and unsigned integers, whose data iris stores as int32
+INT32_FORMATS = ("NETCDF3_CLASSIC", "NETCDF3_64BIT", "NETCDF4_CLASSIC")
+
+
+def check_cast(data, dtype, varname: str) -> None:
+    """
+    Check that the integer 'data' can be stored in the netCDF variable 'varname'
+    of type 'dtype' (as iris does when it stores int64 data as int32).
+    """
+    dtype = np.dtype(dtype)
+    if data.dtype.kind not in "iu" or dtype.kind not in "iu" or data.size == 0:
+        return
+    if np.can_cast(data.dtype, dtype):
+        return
+    info = np.iinfo(dtype)
+    if data.min() < info.min or data.max() > info.max:
+        raise AmamiError(
+            f"The data of variable '{varname}' cannot be safely cast to {dtype}."
+        )
+
+
+def _same_storage(source, target) -> bool:
+    """Check whether two HDF5 datasets store their chunks in the same way"""
+    return source.chunks is not None and all(
+        getattr(source, attr) == getattr(target, attr)
+        for attr in (
+            "dtype",
+            "chunks",
+            "compression",
+            "compression_opts",
+            "shuffle",
+            "fletcher32",
+            "scaleoffset",
+            "fillvalue",
+        )
+    )
+
+
+def _compress_chunk(chunk, complevel, shuffle) -> bytes:
+    """Apply the HDF5 shuffle and deflate filters to a chunk"""
+    chunk = np.ascontiguousarray(chunk)
+    if shuffle and chunk.dtype.itemsize > 1:
+        chunk = np.ascontiguousarray(
+            chunk.reshape(-1).view(np.uint8).reshape(-1, chunk.dtype.itemsize).T
+        )
+    return zlib.compress(chunk, complevel)
+
+
+class DeferredWriter:
+    """
+    Base class of the writers of the data of netCDF variables after the
+    structure of the whole file.
+
+    Usage:
+    -   write the structure of each variable with `write_structure`, using
+        an iris Saver created with `compute=False`;
+    -   close the Saver and complete it (`Saver.complete`);
+    -   within `open`, write the data of each variable with `write_data`,
+        in the same order as the structures were written.
+    """
+
+    def __init__(self):
+        self._varnames = collections.deque()
+        self._file = None
+
+    def write_structure(self, sman, cube, **kwargs) -> str:
+        """
+        Write the cube to the iris Saver 'sman' without its data, and record and
+        return the name of its netCDF variable. The cube data is replaced by a lazy
+        placeholder, which is never computed.
+        """
+        dtype = cube.dtype
+        if (
+            np.issubdtype(dtype, np.int64) or dtype.kind == "u"
+        ) and sman._dataset.file_format in INT32_FORMATS:
+            # Stored as int32 by iris, which would otherwise replace the placeholder
+            dtype = np.dtype(np.int32)
+        placeholder = da.empty(cube.shape, dtype=dtype, chunks=cube.shape)
+        cube.data = placeholder
+        sman.write(cube, **kwargs)
+        # Remove the placeholder from the Saver delayed writes
+        for i, (source, target) in enumerate(sman._delayed_writes):
+            if source is placeholder:
+                del sman._delayed_writes[i]
+                self._varnames.append(target.varname)
+                return target.varname
+        raise AmamiError(f"Unable to find the netCDF variable for '{cube.name()}'.")
+
+    def open(self, path):
+        """Open the netCDF file to write the data (use as a context manager)"""
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        self._file = None
+
+    def write_data(self, data, packing: dict = None) -> None:
+        """
+        Write the data (numpy or masked array) of the next variable, packing it
+        with the 'packing' parameters if not None (see `amami.packing.get_packing`),
+        which are also set as the packing attributes of the variable.
+        """
+        raise NotImplementedError
+
+
+class DirectChunkWriter(DeferredWriter):
+    """
+    Write the data of netCDF4 variables by compressing their chunks
+    on 'nthreads' threads and writing them with HDF5 direct chunk writes.
+    The data of a variable can also be copied from another file with `copy_data`.
+    """
+
+    def __init__(self, nthreads: int):
+        if h5py is None:
+            raise AmamiError(
+                "The 'h5py' package is needed to write compressed chunks directly. "
+                "Install 'h5py', or write the file with a single thread."
+            )
+        super().__init__()
+        self.nthreads = nthreads
+
+    def open(self, path):
+        """Open the netCDF4 file to write the data (use as a context manager)"""
+        self._file = h5py.File(path, "r+")
+        return self
+
+    def write_data(self, data, packing: dict = None) -> None:
+        """
+        Write the data (numpy or masked array) of the next variable, packing it
+        with the 'packing' parameters if not None (see `amami.packing.get_packing`),
+        which are also set as the packing attributes of the variable.
+        """
+        varname = self._varnames.popleft()
+        dset = self._file[varname]
+        if dset.shape != data.shape:
+            # Variables with unlimited dimensions are created with no records
+            dset.resize(data.shape)
+        if packing is not None:
+            # Packed variable, as netCDF4 would pack it
+            for name in ("scale_factor", "add_offset"):
+                # Keep the type and shape of the attributes written by netCDF4
+                dset.attrs.modify(name, np.array([packing[name]]))
+            data = pack(
+                data,
+                dset.dtype,
+                packing["scale_factor"],
+                packing["add_offset"],
+                dset.fillvalue,
+            )
+        check_cast(data, dset.dtype, varname)
+        data = np.ma.filled(data, dset.fillvalue).astype(dset.dtype, copy=False)
+        if (
+            dset.chunks is None
+            or dset.compression != "gzip"
+            or dset.fletcher32
+            or dset.scaleoffset is not None
+        ):
+            # Not a deflated variable, write it normally
+            dset[...] = data
+            return
+        chunks = dset.chunks
+        complevel = dset.compression_opts
+        shuffle = dset.shuffle
+
+        def compress(offset):
+            keys = tuple(slice(o, o + c) for o, c in zip(offset, chunks))
+            chunk = data[keys]
+            if chunk.shape != chunks:
+                # HDF5 edge chunks are stored with the full chunk shape
+                full = np.full(chunks, dset.fillvalue, dtype=data.dtype)
+                full[tuple(slice(0, n) for n in chunk.shape)] = chunk
+                chunk = full
+            return offset, _compress_chunk(chunk, complevel, shuffle)
+
+        offsets = itertools.product(
+            *(range(0, n, c) for n, c in zip(data.shape, chunks))
+        )
+        with ThreadPoolExecutor(self.nthreads) as pool:
+            for offset, payload in pool.map(compress, offsets):
+                dset.id.write_direct_chunk(offset, payload)
+        LOGGER.debug(f"Variable '{varname}' written with direct chunk writes.")
+
+    def copy_data(self, path: str, varname: str) -> None:
+        """
+        Write the data of the next variable by copying that of variable 'varname'
+        of the netCDF4 file 'path', with its packing attributes. If both variables
+        have the same chunks and filters, the compressed chunks are copied without
+        being decompressed.
+        """
+        dset = self._file[self._varnames.popleft()]
+        with h5py.File(path, "r") as fsource:
+            source = fsource[varname]
+            if dset.shape != source.shape:
+                dset.resize(source.shape)
+            for name in ("scale_factor", "add_offset"):
+                # Packing attributes, set once the data is read
+                if name in source.attrs and name in dset.attrs:
+                    dset.attrs.modify(name, source.attrs[name])
+            if not _same_storage(source, dset):
+                LOGGER.debug(
+                    f"Variable '{dset.name}' has a different storage in '{path}'. "
+                    "Copying its data uncompressed."
+                )
+                dset[...] = source[...]
+                return
+            for index in range(source.id.get_num_chunks()):
+                offset = source.id.get_chunk_info(index).chunk_offset
+                filter_mask, payload = source.id.read_direct_chunk(offset)
+                dset.id.write_direct_chunk(offset, payload, filter_mask)
+        LOGGER.debug(f"Variable '{dset.name}' copied with direct chunk writes.")
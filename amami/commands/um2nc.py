@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 """
-Original script (/g/data/access/projects/access/apps/pythonlib/um2netcdf4/2.1/um2netcdf4.py) 
+Original script (/g/data/access/projects/access/apps/pythonlib/um2netcdf4/2.1/um2netcdf4.py)
 created by Martin Dix.
 
 Modified by Davide Marchegiani at ACCESS-NRI - davide.marchegiani@anu.edu.au
@@ -10,9 +10,17 @@ Modified by Davide Marchegiani at ACCESS-NRI - davide.marchegiani@anu.edu.au
 Convert a UM fieldsfile to netCDF
 """
 
+import argparse
+import contextlib
 import datetime
+import multiprocessing
 import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import dask.array as da
 import cf_units
 import cftime
 import netCDF4
@@ -23,19 +31,217 @@ import iris.exceptions
 import iris.fileformats
 import amami
 import amami.um_utils as umutils
+import amami.um_load as umload
+import amami.remote_files as remote_files
+from amami.conversion_plan import ConversionPlan, get_layout_fingerprint
+from amami.pipeline import run_pipeline
+from amami.quantize import CF_ALGORITHMS, get_max_precision, quantize
+from amami.packing import get_packing, get_unset_packing, to_packable
+from amami.storage_policy import FieldStorage, StoragePolicy, convert_data
+from amami.chunk_writer import DirectChunkWriter
+from amami.netcdf3_writer import MemmapWriter
+from amami.shared_arrays import SharedArrayPool, attach
 from amami.um_utils import Stash
 from amami.exceptions import AmamiError, UMError
 from amami.loggers import LOGGER
-from amami.helpers import get_abspath
+from amami.helpers import get_abspath, publish_file
+
+
+# Attributes recording the quantization of a field (see `set_quantize_attrs`)
+QUANTIZE_ATTRS = ("quantization", "quantization_nsd", "quantization_nsb")
+# Coordinates named by the metadata decisions of a conversion plan
+PLAN_COORD_NAMES = (
+    "latitude",
+    "longitude",
+    "model_level_number",
+    "level_height",
+    "sigma",
+)
+# Reference fields of the iris load rules (orography and surface pressure),
+# used to build the hybrid height and pressure coordinates of other fields
+REFERENCE_STASH = (33, 1, 409)
+
+
+def _coord_key(coord, kind=None):
+    """
+    Get a hashable key identifying a coordinate by its type, metadata and values.
+    The DimCoord 'circular' flag is ignored, as it is not written to netCDF.
+    """
+    return (
+        kind,
+        type(coord),
+        coord.standard_name,
+        coord.long_name,
+        coord.var_name,
+        str(coord.units),
+        coord.units.calendar,
+        repr(coord.coord_system),
+        repr(sorted(coord.attributes.items())),
+        coord.climatological,
+        coord.points.dtype.str,
+        coord.points.shape,
+        coord.points.tobytes(),
+        None if coord.bounds is None else coord.bounds.tobytes(),
+    )
+
+
+def replace_cube_coord(cube, coord, new_coord):
+    """
+    Replace a coordinate of a cube with a new coordinate on the same dimensions,
+    updating the aux factories that depend on it.
+    """
+    dims = cube.coord_dims(coord)
+    is_dim = any(c is coord for c in cube.dim_coords)
+    for factory in cube.aux_factories:
+        factory.update(coord, new_coord)
+    cube.remove_coord(coord)
+    if is_dim:
+        cube.add_dim_coord(new_coord, dims[0])
+    else:
+        cube.add_aux_coord(new_coord, dims)
+
+
+class CoordCache:
+    """
+    Cache of canonicalised coordinates, shared between cubes.
+    Cubes from the same UM file often have identical coordinates (grids, pressure
+    levels, time axes). Each unique coordinate (identified by its type, metadata
+    and values) is canonicalised only once, and the result replaces the
+    coordinate in all the cubes that have it.
+    """
+
+    def __init__(self):
+        self._coords = {}
+        self.hits = 0
+
+    def get(self, coord, kind, fix):
+        """
+        Get the canonical version of 'coord', obtained by applying 'fix' to a copy
+        of it.
+        'kind' identifies the canonicalisation applied.
+        """
+        key = _coord_key(coord, kind)
+        try:
+            canonical = self._coords[key]
+            self.hits += 1
+        except KeyError:
+            canonical = coord.copy()
+            fix(canonical)
+            self._coords[key] = canonical
+        return canonical
+
+    def report(self):
+        """Log the cache usage"""
+        LOGGER.debug(
+            f"Coordinate cache: {len(self._coords)} unique coordinates "
+            f"canonicalised, {self.hits} reused."
+        )
+
+
+def canonicalise_coord(cube, coord, kind, fix, coord_cache=None):
+    """
+    Apply 'fix' to a cube coordinate and return the fixed coordinate.
+    If a 'coord_cache' is provided, the coordinate is replaced in the cube with
+    the (shared) canonical coordinate from the cache. Otherwise, the coordinate
+    is fixed in place.
+    """
+    if coord_cache is None:
+        fix(coord)
+        return coord
+    canonical = coord_cache.get(coord, kind, fix)
+    if canonical is not coord:
+        replace_cube_coord(cube, coord, canonical)
+    return canonical
+
+
+def share_coords(cubes):
+    """
+    Share identical coordinates (including the formula terms of the aux factories)
+    between the cubes, so that each of them is written only once and referenced
+    by all the variables.
+    Different coordinates with the same variable name are given numbered variable
+    names following the order of the cubes, so that the names are the same for
+    all the files with the same fields.
+    """
+    shared = {}
+    for cube in cubes:
+        for coord in cube.dim_coords + cube.aux_coords:
+            canonical = shared.setdefault(_coord_key(coord), coord)
+            if canonical is not coord:
+                replace_cube_coord(cube, coord, canonical)
+    names = {}
+    for coord in shared.values():
+        name = "_".join((coord.var_name or coord.name()).lower().split())
+        names.setdefault(name, []).append(coord)
+    for name, coords in names.items():
+        for n, coord in enumerate(coords[1:]):
+            coord.var_name = f"{name}_{n}"
+    LOGGER.debug(
+        f"Shared coordinates: {len(shared)} unique coordinates written for "
+        f"{len(cubes)} fields."
+    )
+
+
+def get_infile(infile: str) -> str:
+    """
+    Return the absolute path of the input UM file, checking that it exists.
+    For members of tar archives ('ARCHIVE::MEMBER'), only the archive path is made
+    absolute and checked. URLs are returned unchanged.
+    """
+    if remote_files.is_url(infile):
+        return infile
+    archive, sep, member = infile.partition(umutils.ARCHIVE_MEMBER_SEP)
+    return f"{get_abspath(archive)}{sep}{member}"
+
+
+def spool_infile(args, infile: str, directory: str = None):
+    """
+    Decompress or extract the input UM file into a temporary file in 'directory'
+    if it is compressed or a member of a tar archive, so that it is read only once.
+    Remote UM files (URLs) are downloaded, with only the data records of the fields
+    to convert (and of the heaviside fields used for masking and the reference
+    fields of the hybrid vertical coordinates).
+    Return the arguments with the path of the file to read, and the path of the
+    temporary file (None if the input file is read directly).
+    """
+    if remote_files.is_url(infile):
+        if umutils.needs_spool(infile):
+            raise UMError(
+                "Compressed and archived UM files can only be read from local paths."
+            )
+        include_list = set(args.include_list or ())
+        exclude_list = set(args.exclude_list or ())
+        select = None
+        if include_list or exclude_list:
+            required = set(REFERENCE_STASH)
+            if not args.nomask:
+                required |= {30301, 30304}
+
+            def is_selected(stash):
+                return stash in required or (
+                    (not include_list or stash in include_list)
+                    and stash not in exclude_list
+                )
+
+            select = is_selected
+        LOGGER.info(f"Downloading UM file {infile}")
+        spool = remote_files.fetch_fieldsfile(infile, select, directory)
+    elif umutils.needs_spool(infile):
+        LOGGER.info(f"Extracting UM file {infile}")
+        spool = umutils.spool_fieldsfile(infile, directory)
+    else:
+        return args, None
+    return argparse.Namespace(**{**vars(args), "infile": spool}), spool
 
 
 def get_nc_format(format_arg: str) -> str:
     """Convert format numbers to format strings"""
     nc_formats = {
-        1: 'NETCDF4',
-        2: 'NETCDF4_CLASSIC',
-        3: 'NETCDF3_CLASSIC',
-        4: 'NETCDF3_64BIT',
+        1: "NETCDF4",
+        2: "NETCDF4_CLASSIC",
+        3: "NETCDF3_CLASSIC",
+        4: "NETCDF3_64BIT",
+        5: "NETCDF3_64BIT_DATA",
     }
     try:
         return nc_formats[int(format_arg)]
@@ -43,40 +249,84 @@ def get_nc_format(format_arg: str) -> str:
         return format_arg
 
 
+def get_saver_format(nc_format: str) -> str:
+    """
+    Get the format passed to the iris Saver. CDF5 files ('NETCDF3_64BIT_DATA'), which
+    the Saver cannot create, are opened with netCDF4 and written as 64-bit offset files.
+    """
+    return "NETCDF3_64BIT" if nc_format == "NETCDF3_64BIT_DATA" else nc_format
+
+
 def check_ncformat(ncformat, use64bit):
     """
     Check whether the --64bit option was chosen along with
     the nc format 'NETCDF3_CLASSIC', as they are incompatible.
     """
-    if ncformat == 'NETCDF3_CLASSIC' and use64bit:
+    if ncformat == "NETCDF3_CLASSIC" and use64bit:
         LOGGER.error(
             "Chosen netCDF format 'NETCDF3_CLASSIC' is incompatible with"
             "the '--64bit' option, as it does not support 64-bit data."
         )
 
 
+def check_endian(args, nc_format):
+    """
+    Check whether a byte order was chosen with the --endian option along with a
+    netCDF3 format, whose variables are always stored big-endian (netCDF-C only
+    accepts the native byte order for them).
+    Return the arguments, with the native byte order for netCDF3 formats.
+    """
+    if nc_format.startswith("NETCDF3") and args.endian != "native":
+        LOGGER.warning(
+            f"The '--endian {args.endian}' option is ignored for the '{nc_format}' "
+            "format, whose data is always stored big-endian."
+        )
+        return argparse.Namespace(**{**vars(args), "endian": "native"})
+    return args
+
+
+def get_endian(endian_arg):
+    """
+    Get the byte order of the netCDF variables ('native' or 'big') from the
+    --endian option. UM files are big-endian, so 'source' is 'big'.
+    """
+    return "big" if endian_arg in ("big", "source") else "native"
+
+
 def add_global_attrs(infile, fid, nohist) -> None:
     """Add global attributes to converted NetCDF file"""
     if not nohist:
-        date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        history = f"File {infile} converted with 'amami um2nc' v{amami.__version__} "\
+        date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        history = (
+            f"File {infile} converted with 'amami um2nc' v{amami.__version__} "
             f"on {date}"
-        fid.update_global_attributes({'history': history})
-    fid.update_global_attributes({'Conventions': 'CF-1.6'})
+        )
+        fid.update_global_attributes({"history": history})
+    fid.update_global_attributes({"Conventions": "CF-1.6"})
 
 
-def get_heaviside_uv(cubes):
-    """Get heaviside_uv field if UM file has it, otherwise return None"""
+def get_itemcode(cube) -> int:
+    """Get the STASH item code of a cube loaded from a UM file"""
+    stash = cube.attributes["STASH"]
+    return stash.section * 1000 + stash.item
+
+
+def index_cubes(cubes) -> dict:
+    """Map each STASH item code to the first cube with that item code"""
+    cubes_index = {}
     for c in cubes:
-        if Stash(c.attributes['STASH']).itemcode == 30301:
-            return c
+        cubes_index.setdefault(get_itemcode(c), c)
+    return cubes_index
+
 
+def get_heaviside_uv(cubes_index):
+    """Get heaviside_uv field if UM file has it, otherwise return None"""
+    return cubes_index.get(30301)
 
-def get_heaviside_t(cubes):
+
+def get_heaviside_t(cubes_index):
     """Get heaviside_t field if UM file has it, otherwise return None"""
-    for c in cubes:
-        if Stash(c.attributes['STASH']).itemcode == 30304:
-            return c
+    return cubes_index.get(30304)
 
 
 def apply_mask(cube, heaviside, hcrit):
@@ -85,42 +335,68 @@ def apply_mask(cube, heaviside, hcrit):
     """
     # Function must handle case where the cube is defined only on
     # a subset of the levels of the heaviside function
-    LOGGER.debug(
-        f"Shape | cube: {cube.shape}, heaviside: {heaviside.shape}"
-    )
-    if cube.shape == heaviside.shape:
-        # If the shapes match it's simple
-        # Temporarily turn off warnings from 0/0
-        with np.errstate(divide='ignore', invalid='ignore'):
-            cube.data = np.ma.masked_array(
-                cube.data/heaviside.data,
-                heaviside.data <= hcrit
-            ).astype(np.float32)
-    else:
+    LOGGER.debug(f"Shape | cube: {cube.shape}, heaviside: {heaviside.shape}")
+    h_data = heaviside.data
+    if cube.shape != heaviside.shape:
         # Are the levels of c a subset of the levels of the heaviside variable?
-        c_p = cube.coord('pressure').points
-        h_p = heaviside.coord('pressure').points
-        LOGGER.debug(
-            f"Levels for masking | cube: {c_p}, heaviside: {h_p}"
-        )
-        if set(c_p).issubset(h_p):
-            # Match is possible
-            constraint = iris.Constraint(pressure=c_p)
-            h_tmp = heaviside.extract(constraint)
-            # Double check they're actually the same after extraction
-            if not np.all(c_p == h_tmp.coord('pressure').points):
-                raise UMError(
-                    "Unexpected mismatch in levels of extracted heaviside function.")
-
-            with np.errstate(divide='ignore', invalid='ignore'):
-                cube.data = np.ma.masked_array(
-                    cube.data/h_tmp.data,
-                    h_tmp.data <= hcrit
-                ).astype(np.float32)
-        else:
-            long_name = Stash(cube.attributes['STASH']).long_name
-            msg = f"Unable to match levels of heaviside function to variable {long_name}."
+        c_p = cube.coord("pressure").points
+        h_p = heaviside.coord("pressure").points
+        LOGGER.debug(f"Levels for masking | cube: {c_p}, heaviside: {h_p}")
+        if not np.isin(c_p, h_p).all():
+            long_name = Stash(cube.attributes["STASH"]).long_name
+            msg = (
+                f"Unable to match levels of heaviside function to variable {long_name}."
+            )
             raise UMError(msg)
+        # Match is possible
+        # Index the pressure dimension of the heaviside data directly (a Constraint
+        # with a list of values would compare every level against every requested
+        # level, and copy the whole cube)
+        levels = np.isin(h_p, c_p)
+        keys = [slice(None)] * heaviside.ndim
+        for pdim in heaviside.coord_dims("pressure"):
+            keys[pdim] = levels
+        h_data = h_data[tuple(keys)]
+        # Double check they're actually the same after extraction
+        if not np.all(c_p == h_p[levels]):
+            raise UMError(
+                "Unexpected mismatch in levels of extracted heaviside function."
+            )
+    # Divide in place on 32-bit data, to avoid full size 64-bit temporaries.
+    if cube.has_lazy_data():
+        # Lazy data is realised directly as 32-bit, storing its chunks in place
+        # (computing it would concatenate them into a second full size copy)
+        lazy = cube.lazy_data()
+        data = np.empty(lazy.shape, dtype=np.float32)
+        mask = np.empty(lazy.shape, dtype=bool)
+        da.store(
+            [da.ma.getdata(lazy).astype(np.float32), da.ma.getmaskarray(lazy)],
+            [data, mask],
+            lock=False,
+        )
+        mask |= np.ma.getmaskarray(h_data)
+    else:
+        data = cube.data
+        mask = np.ma.getmaskarray(data) | np.ma.getmaskarray(h_data)
+        data = np.ma.getdata(data).astype(np.float32, copy=False)
+    h_values = np.ma.getdata(h_data)
+    mask |= h_values <= hcrit
+    # Temporarily turn off warnings from 0/0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(data, h_values, out=data)
+    cube.data = np.ma.masked_array(data, mask=mask, copy=False)
+
+
+def get_mask_type(itemcode):
+    """
+    Get the heaviside function needed to mask a pressure level field
+    ('uv' or 't'), or None if the field doesn't need masking.
+    """
+    if (30201 <= itemcode <= 30288) or (30302 <= itemcode <= 30303):
+        return "uv"
+    if 30293 <= itemcode <= 30298:
+        return "t"
+    return None
 
 
 def apply_mask_to_pressure_level_field(
@@ -135,8 +411,9 @@ def apply_mask_to_pressure_level_field(
     using heaviside function and mask them.
     """
     itemcode = stash.itemcode
+    mask_type = get_mask_type(itemcode)
     # Heaviside_uv
-    if (30201 <= itemcode <= 30288) or (30302 <= itemcode <= 30303):
+    if mask_type == "uv":
         if heaviside_uv:
             LOGGER.info(
                 f"Masking field '{stash.long_name}' using heaviside_uv field "
@@ -154,7 +431,7 @@ def apply_mask_to_pressure_level_field(
             )
             return False
     # Heaviside_t
-    elif 30293 <= itemcode <= 30298:
+    elif mask_type == "t":
         if heaviside_t:
             LOGGER.info(
                 f"Masking field '{stash.long_name}' using heaviside_t field "
@@ -185,22 +462,20 @@ def name_cube(cube, stash, simple):
         cube.var_name = stash.unique_name
     # Cases with max or min
     if cube.var_name:
-        if any(m.method == 'maximum' for m in cube.cell_methods):
+        if any(m.method == "maximum" for m in cube.cell_methods):
             cube.var_name += "_max"
-        if any(m.method == 'minimum' for m in cube.cell_methods):
+        if any(m.method == "minimum" for m in cube.cell_methods):
             cube.var_name += "_min"
     # The iris name mapping seems wrong for these - perhaps assuming rotated grids?
-    if cube.standard_name == 'x_wind':
-        cube.standard_name = 'eastward_wind'
-    elif cube.standard_name == 'y_wind':
-        cube.standard_name = 'northward_wind'
+    if cube.standard_name == "x_wind":
+        cube.standard_name = "eastward_wind"
+    elif cube.standard_name == "y_wind":
+        cube.standard_name = "northward_wind"
     # If standard name mismatch use STASH
     if (
         cube.standard_name
-        and
-        stash.standard_name
-        and
-        (cube.standard_name != stash.standard_name)
+        and stash.standard_name
+        and (cube.standard_name != stash.standard_name)
     ):
         LOGGER.warning(
             f"Standard name mismatch for ITEMCODE: {stash.itemcode}.\n"
@@ -208,13 +483,7 @@ def name_cube(cube, stash, simple):
         )
         cube.standard_name = stash.standard_name
     # If unit mismatch use STASH
-    if (
-        cube.units
-        and
-        stash.units
-        and
-        (str(cube.units) != stash.units)
-    ):
+    if cube.units and stash.units and (str(cube.units) != stash.units):
         LOGGER.warning(
             f"Units mismatch for ITEMCODE: {stash.itemcode}.\n"
             f"iris units: {cube.units}, STASH units: {stash.units}."
@@ -235,335 +504,1188 @@ def fix_cell_methods(cube):
         newi = []
         for i in m.intervals:
             # Skip the misleading hour intervals
-            if i.find('hour') == -1:
+            if i.find("hour") == -1:
                 newi.append(i)
-        n = iris.coords.CellMethod(
-            m.method, m.coord_names, tuple(newi), m.comments)
+        n = iris.coords.CellMethod(m.method, m.coord_names, tuple(newi), m.comments)
         newm.append(n)
     cube.cell_methods = tuple(newm)
 
 
-def fix_latlon_coord(cube, grid_type):
-    """Get proper lat/lon coordinate names based on cube grid_type"""
+def prepare_latlon_coord(cube, coord_cache=None):
+    """
+    Force lat/lon coordinates to double and add their bounds.
+    Return the lat/lon coordinates.
+    """
+
     def _add_coord_bounds(coord):
+        # Force to double for consistency with CMOR
+        coord.points = coord.points.astype(np.float64)
         if not coord.has_bounds():
             if len(coord.points) > 1:
                 coord.guess_bounds()
             # For length 1, assume it's global. guess_bounds doesn't work in this case
-            elif coord.name() == 'latitude':
-                coord.bounds = np.array([[-90., 90.]])
-            elif coord.name() == 'longitude':
-                coord.bounds = np.array([[0., 360.]])
+            elif coord.name() == "latitude":
+                coord.bounds = np.array([[-90.0, 90.0]])
+            elif coord.name() == "longitude":
+                coord.bounds = np.array([[0.0, 360.0]])
+
     try:
-        lat = cube.coord('latitude')
-        # Force to double for consistency with CMOR
-        lat.points = lat.points.astype(np.float64)
-        _add_coord_bounds(lat)
-        lon = cube.coord('longitude')
-        lon.points = lon.points.astype(np.float64)
-        _add_coord_bounds(lon)
-
-        if len(lat.points) == 180:
-            lat.var_name = 'lat_river'
-        elif (
-            (lat.points[0] == -90 and grid_type == 'EG')
-            or
-            (
-                np.allclose(-90.+np.abs(0.5 *
-                            (lat.points[1]-lat.points[0])), lat.points[0])
-                and
-                grid_type == 'ND'
-            )
-        ):
-            lat.var_name = 'lat_v'
-        else:
-            lat.var_name = 'lat'
-
-        if len(lon.points) == 360:
-            lon.var_name = 'lon_river'
-        elif (
-            (lon.points[0] == 0 and grid_type == 'EG')
-            or
-            (
-                np.allclose(
-                    np.abs(0.5*(lon.points[1]-lon.points[0])), lon.points[0])
-                and
-                grid_type == 'ND'
-            )
-        ):
-            lon.var_name = 'lon_u'
-        else:
-            lon.var_name = 'lon'
+        lat = canonicalise_coord(
+            cube, cube.coord("latitude"), "latlon", _add_coord_bounds, coord_cache
+        )
+        lon = canonicalise_coord(
+            cube, cube.coord("longitude"), "latlon", _add_coord_bounds, coord_cache
+        )
     except iris.exceptions.CoordinateNotFoundError:
-        msg = ("File cannot be processed. UM files with time series currently unsupported. Consider"
-               " converting with convsh https://ncas-cms.github.io/xconv-doc/html/example1.html")
+        msg = (
+            "File cannot be processed. UM files with time series currently unsupported. Consider"
+            " converting with convsh https://ncas-cms.github.io/xconv-doc/html/example1.html"
+        )
         raise UMError(msg)
+    return lat, lon
+
+
+def fix_latlon_coord(cube, grid_type, coord_cache=None):
+    """Get proper lat/lon coordinate names based on cube grid_type"""
+    lat, lon = prepare_latlon_coord(cube, coord_cache)
+
+    if len(lat.points) == 180:
+        lat.var_name = "lat_river"
+    elif (lat.points[0] == -90 and grid_type == "EG") or (
+        np.allclose(
+            -90.0 + np.abs(0.5 * (lat.points[1] - lat.points[0])), lat.points[0]
+        )
+        and grid_type == "ND"
+    ):
+        lat.var_name = "lat_v"
+    else:
+        lat.var_name = "lat"
+
+    if len(lon.points) == 360:
+        lon.var_name = "lon_river"
+    elif (lon.points[0] == 0 and grid_type == "EG") or (
+        np.allclose(np.abs(0.5 * (lon.points[1] - lon.points[0])), lon.points[0])
+        and grid_type == "ND"
+    ):
+        lon.var_name = "lon_u"
+    else:
+        lon.var_name = "lon"
 
 
 def fix_level_coord(cube, z_rho, z_theta):
     """Rename model_level_number coordinates to better distinguish rho and theta levels"""
     try:
-        c_lev = cube.coord('model_level_number')
-        c_height = cube.coord('level_height')
-        c_sigma = cube.coord('sigma')
+        c_lev = cube.coord("model_level_number")
+        c_height = cube.coord("level_height")
+        c_sigma = cube.coord("sigma")
     except iris.exceptions.CoordinateNotFoundError:
         return
-    if abs(c_height.points[0]-z_rho).min() < 1e-6:
-        c_lev.var_name = 'model_rho_level_number'
-        c_height.var_name = 'rho_level_height'
-        c_sigma.var_name = 'sigma_rho'
-    elif abs(c_height.points[0]-z_theta).min() < 1e-6:
-        c_lev.var_name = 'model_theta_level_number'
-        c_height.var_name = 'theta_level_height'
-        c_sigma.var_name = 'sigma_theta'
+    if abs(c_height.points[0] - z_rho).min() < 1e-6:
+        c_lev.var_name = "model_rho_level_number"
+        c_height.var_name = "rho_level_height"
+        c_sigma.var_name = "sigma_rho"
+    elif abs(c_height.points[0] - z_theta).min() < 1e-6:
+        c_lev.var_name = "model_theta_level_number"
+        c_height.var_name = "theta_level_height"
+        c_sigma.var_name = "sigma_theta"
 
 
-def fix_pressure_coord(cube):
+def reverse_cube_dim(cube, dim, coord_cache=None):
+    """
+    Reverse a cube along a dimension, in place.
+    The data (lazy or real) is replaced with a reversed view instead of a copy.
+    """
+
+    def _reverse(coord, coord_dim):
+        bounds = coord.bounds
+        coord.bounds = None
+        coord.points = np.flip(coord.points, coord_dim)
+        if bounds is not None:
+            coord.bounds = np.flip(bounds, coord_dim)
+
+    keys = (slice(None),) * dim + (slice(None, None, -1),)
+    cube.data = cube.core_data()[keys]
+    for coord in cube.dim_coords + cube.aux_coords:
+        coord_dims = cube.coord_dims(coord)
+        if dim in coord_dims:
+            coord_dim = coord_dims.index(dim)
+            canonicalise_coord(
+                cube,
+                coord,
+                ("reverse", coord_dim),
+                lambda c: _reverse(c, coord_dim),
+                coord_cache,
+            )
+    return cube
+
+
+def fix_pressure_coord(cube, coord_cache=None):
     """Fix pressure coords"""
-    try:
-        plevs = cube.coord('pressure')
-        plevs.attributes['positive'] = 'down'
-        plevs.convert_units('Pa')
+
+    def _fix_plevs(plevs):
+        plevs.attributes["positive"] = "down"
+        plevs.convert_units("Pa")
         # Round coord points otherwise
         # they're off by 1e-10 which looks odd in ncdump
         plevs.points = np.round(plevs.points, 5)
+
+    try:
+        plevs = canonicalise_coord(
+            cube, cube.coord("pressure"), "pressure", _fix_plevs, coord_cache
+        )
         # If needed, flip to get pressure decreasing as in CMIP6 standard
         if plevs.points[0] < plevs.points[-1]:
-            cube = iris.util.reverse(cube, 'pressure')
+            reverse_cube_dim(cube, cube.coord_dims(plevs)[0], coord_cache)
     except iris.exceptions.CoordinateNotFoundError:
         pass
     return cube
 
 
 def to32bit_data(cube):
-    """Change data to 32 bit"""
-    if cube.data.dtype == 'float64':
-        cube.data = cube.data.astype(np.float32)
-    elif cube.data.dtype == 'int64':
-        cube.data = cube.data.astype(np.int32)
+    """Change data to 32 bit (keeping its byte order)"""
+    # Lazy data is cast before being realised, so that it is never held in 64-bit
+    data = cube.core_data()
+    if data.dtype.kind in ("f", "i") and data.dtype.itemsize == 8:
+        cube.data = data.astype(
+            np.dtype(f"{data.dtype.kind}4").newbyteorder(data.dtype.byteorder)
+        )
 
 
-def set_missing_value(cube):
+def set_missing_value(cube, dtype=None):
     """
-    Set the missing_value attribute. 
+    Set the missing_value attribute.
     Use an array to force the type to match the data type
+    (or the given 'dtype', if the data type will change before writing),
+    in native byte order as netCDF attributes are written as they are.
     """
-    kind = cube.data.dtype.kind
-    if kind == 'f':
-        fill_value = 1.e20
+    dtype = np.dtype(dtype or cube.dtype).newbyteorder("=")
+    kind = dtype.kind
+    if kind == "f":
+        fill_value = 1.0e20
     else:
         # Use netCDF defaults
-        key = f"{kind}{cube.data.dtype.itemsize:1d}"
+        key = f"{kind}{dtype.itemsize:1d}"
         fill_value = netCDF4.default_fillvals[key]
-    cube.attributes['missing_value'] = np.array([fill_value], cube.data.dtype)
+    cube.attributes["missing_value"] = np.array([fill_value], dtype)
 
 
-def convert_proleptic_calendar(cube):
+def convert_proleptic_calendar(cube, coord_cache=None):
     """
     If reference date is before 1600 use proleptic gregorian
     calendar and change units from hours to days
     """
+
     def _convert_proleptic(time):
         """Convert units from hours to days and shift origin from 1970 to 0001"""
         newunits = cf_units.Unit(
-            "days since 0001-01-01 00:00", calendar='proleptic_gregorian')
-        # Need a copy because can't assign to time.points[i]
-        tvals = np.array(time.points)
-        if time.bounds is not None:
-            tbnds = np.array(time.bounds)
-            has_bnds = True
-        else:
-            has_bnds = False
-        for i in range(len(time.points)):
-            date = time.units.num2date(tvals[i])
-            newdate = cftime.DatetimeProlepticGregorian(
-                date.year,
-                date.month,
-                date.day,
-                date.hour,
-                date.minute,
-                date.second
+            "days since 0001-01-01 00:00", calendar="proleptic_gregorian"
+        )
+        # Convert points and bounds (fields with instantaneous data don't have bounds)
+        # together, with a single date conversion for all the values
+        has_bnds = time.bounds is not None
+        tvals = time.points.ravel()
+        if has_bnds:
+            tvals = np.concatenate([tvals, time.bounds.ravel()])
+        newdates = [
+            cftime.DatetimeProlepticGregorian(
+                date.year, date.month, date.day, date.hour, date.minute, date.second
             )
-            tvals[i] = newunits.date2num(newdate)
-            if has_bnds:  # Fields with instantaneous data don't have bounds
-                for j in range(2):
-                    date = time.units.num2date(tbnds[i][j])
-                    newdate = cftime.DatetimeProlepticGregorian(
-                        date.year,
-                        date.month,
-                        date.day,
-                        date.hour,
-                        date.minute,
-                        date.second
-                    )
-                    tbnds[i][j] = newunits.date2num(newdate)
-        time.points = tvals
+            for date in time.units.num2date(tvals)
+        ]
+        newvals = np.asarray(newunits.date2num(newdates), dtype=tvals.dtype)
+        npoints = time.points.size
+        time.points = newvals[:npoints].reshape(time.shape)
         if has_bnds:
-            time.bounds = tbnds
+            time.bounds = newvals[npoints:].reshape(time.bounds.shape)
         time.units = newunits
 
+    def _convert_days(time):
+        """Convert units from hours to days"""
+        if time.units.calendar == "gregorian":
+            new_calendar = "proleptic_gregorian"
+        else:
+            new_calendar = time.units.calendar
+        time.units = cf_units.Unit("days since 1970-01-01 00:00", calendar=new_calendar)
+        time.points = time.points / 24.0
+        if time.bounds is not None:
+            time.bounds = time.bounds / 24.0
+
     try:
-        reftime = cube.coord('forecast_reference_time')
+        reftime = cube.coord("forecast_reference_time")
     except iris.exceptions.CoordinateNotFoundError:
         # Dump files don't have forecast_reference_time
         return
-    time = cube.coord('time')
+    time = cube.coord("time")
     refdate = reftime.units.num2date(reftime.points[0])
-    tuom = time.units.origin == 'hours since 1970-01-01 00:00:00'
-    LOGGER.debug(
-        f"Time units origin match: {tuom}"
-    )
-    if time.units.calendar == 'proleptic_gregorian' and refdate.year < 1600:
-        _convert_proleptic(time)
+    tuom = time.units.origin == "hours since 1970-01-01 00:00:00"
+    LOGGER.debug(f"Time units origin match: {tuom}")
+    if time.units.calendar == "proleptic_gregorian" and refdate.year < 1600:
+        canonicalise_coord(
+            cube, time, "time_proleptic", _convert_proleptic, coord_cache
+        )
     else:
-        if time.units.calendar == 'gregorian':
-            new_calendar = 'proleptic_gregorian'
-        else:
-            new_calendar = time.units.calendar
-        time.units = cf_units.Unit(
-            "days since 1970-01-01 00:00", calendar=new_calendar)
-        time.points = time.points/24.
-        if time.bounds is not None:
-            time.bounds = time.bounds/24.
-    cube.remove_coord('forecast_period')
-    cube.remove_coord('forecast_reference_time')
+        canonicalise_coord(cube, time, "time_days", _convert_days, coord_cache)
+    cube.remove_coord("forecast_period")
+    cube.remove_coord("forecast_reference_time")
+
+
+def set_time_first(cube):
+    """
+    Make time the first dimension of the cube, by transposing it (in place) or by
+    adding a new time axis.
+    Return the cube and the new order of its dimensions (None if unchanged).
+    Raise CoordinateNotFoundError if the cube has no time coordinate.
+    """
+    # If time is a dimension but not a coordinate dimension,
+    # coord_dims('time') returns an empty tuple
+    if tdim := cube.coord_dims("time"):
+        # For fields with a pseudo-level, time may not be the first dimension
+        if tdim != (0,):
+            tdim = tdim[0]
+            neworder = list(range(cube.ndim))
+            neworder.remove(tdim)
+            neworder.insert(0, tdim)
+            cube.transpose(neworder)
+            return cube, neworder
+        return cube, None
+    return iris.util.new_axis(cube, cube.coord("time")), None
 
 
-def cubewrite(cube, sman, compression):
-    """Write cube to file"""
-    fill_value = cube.attributes['missing_value']
+def cubewrite(
+    cube,
+    sman,
+    storage,
+    chunk_writer=None,
+    endian="native",
+    packing=None,
+):
+    """
+    Write cube to file, with the given byte order ('endian') and the 'storage'
+    settings of the field (compression, data type and chunks, see `get_field_storage`).
+    If a 'chunk_writer' (DirectChunkWriter) is provided, only the structure of
+    the cube is written, and the data is written later by the chunk writer.
+    In that case, return the name of the netCDF variable of the cube.
+    The data is packed with the 'packing' parameters, if not None
+    (see `get_field_packing`).
+    """
+    if storage.dtype is not None:
+        cube.data = convert_data(cube.core_data(), storage.dtype)
+        set_missing_value(cube)
+    if packing is not None:
+        # Missing values are marked with the fill value of the packed type
+        set_missing_value(cube, packing["dtype"])
+    kwargs = {
+        "zlib": storage.codec == "zlib",
+        "complevel": storage.level,
+        "fill_value": cube.attributes["missing_value"],
+        "endian": endian,
+        "packing": packing,
+        # Always write the quantization attributes as variable attributes
+        "local_keys": QUANTIZE_ATTRS,
+    }
     try:
-        # If time is a dimension but not a coordinate dimension,
-        # coord_dims('time') returns an empty tuple
-        if tdim := cube.coord_dims('time'):
-            # For fields with a pseudo-level, time may not be the first dimension
-            if tdim != (0,):
-                tdim = tdim[0]
-                neworder = list(range(cube.ndim))
-                neworder.remove(tdim)
-                neworder.insert(0, tdim)
-                LOGGER.warning(
-                    "Incorrect dimension order for ITEMCODE: "
-                    f"{Stash(cube.attributes['STASH']).itemcode}.\n"
-                    f"Changing dimension order to {neworder}."
-                )
-                cube.transpose(neworder)
-        else:
-            cube = iris.util.new_axis(cube, cube.coord('time'))
-        sman.write(
-            cube,
-            zlib=True,
-            complevel=compression,
-            unlimited_dimensions=['time'],
-            fill_value=fill_value)
+        cube, neworder = set_time_first(cube)
+        if neworder is not None:
+            LOGGER.warning(
+                "Incorrect dimension order for ITEMCODE: "
+                f"{Stash(cube.attributes['STASH']).itemcode}.\n"
+                f"Changing dimension order to {neworder}."
+            )
+        kwargs["unlimited_dimensions"] = ["time"]
     except iris.exceptions.CoordinateNotFoundError:
         # No time dimension (probably ancillary file)
-        sman.write(
-            cube,
-            zlib=True,
-            complevel=compression,
-            fill_value=fill_value
+        pass
+    kwargs["chunksizes"] = storage.get_chunksizes(cube.shape)
+    if storage.chunks is not None and kwargs["chunksizes"] is None:
+        LOGGER.warning(
+            "The chunks of the storage policy for ITEMCODE: "
+            f"{Stash(cube.attributes['STASH']).itemcode} do not match the "
+            f"dimensions of the variable {cube.shape}. Using the default chunks."
         )
+    if "quantization" in cube.attributes:
+        add_quantization_var(sman, storage.quantize_mode)
+    if chunk_writer is None:
+        if packing is not None:
+            cube.data = to_packable(cube.data, packing)
+        sman.write(cube, **kwargs)
+        return None
+    return chunk_writer.write_structure(sman, cube, **kwargs)
 
 
-def main(args):
+def read_field(cube, use64bit):
     """
-    Main function for `um2nc` command
+    Read the data of a field, casting it to 32 bit first unless 'use64bit' is True.
     """
-    # Get input path
-    LOGGER.debug(f"{args=}")
-    infile = get_abspath(args.infile)
-    LOGGER.debug(f"{infile=}")
-    # Get output path
-    outfile = get_abspath(args.outfile, checkdir=True)
-    # Get netCDF format
-    nc_format = get_nc_format(args.format)
-    check_ncformat(nc_format, args.use64bit)
+    # change data to 32bit
+    if not use64bit:
+        to32bit_data(cube)
+    # Realise the data
+    cube.data
+    return cube
+
+
+def get_quantize_digits(cube, storage):
+    """
+    Get the precision to quantize a field to with its 'storage' settings (None if it
+    is not quantized), limited to the maximum precision of its floating-point type.
+    """
+    if storage.quantize_digits is None:
+        return None
+    dtype = cube.dtype if storage.dtype is None else np.dtype(storage.dtype)
+    if dtype.kind != "f":
+        return None
+    return min(storage.quantize_digits, get_max_precision(dtype, storage.quantize_mode))
+
+
+def get_quantization_varname(quantize_mode) -> str:
+    """Get the name of the CF quantization variable of a quantize mode"""
+    return f"quantization_{CF_ALGORITHMS[quantize_mode]}"
+
+
+def set_quantize_attrs(cube, significant_digits, quantize_mode) -> None:
+    """
+    Record the quantization of a field in its attributes, following the CF
+    conventions, if 'significant_digits' is not None: the name of the quantization
+    variable recording the algorithm (see `add_quantization_var`), and the
+    number of significant digits or bits.
+    """
+    if significant_digits is None:
+        return
+    cube.attributes["quantization"] = get_quantization_varname(quantize_mode)
+    # BitRound keeps a number of significant bits, the other modes of digits
+    key = "quantization_nsb" if quantize_mode == "BitRound" else "quantization_nsd"
+    cube.attributes[key] = np.int32(significant_digits)
+
+
+def add_quantization_var(sman, quantize_mode) -> None:
+    """
+    Add the CF quantization variable of the given quantize mode to the netCDF file
+    of the iris Saver 'sman', if not already there. It is a scalar variable with
+    no data, whose attributes record the quantization algorithm.
+    """
+    varname = get_quantization_varname(quantize_mode)
+    if varname in sman._dataset.variables:
+        return
+    var = sman._dataset.createVariable(varname, "i4", ())
+    var.algorithm = CF_ALGORITHMS[quantize_mode]
+    var.implementation = f"amami version {amami.__version__ or 'unknown'}"
+
+
+def get_field_storage(args, stash) -> FieldStorage:
+    """Get the storage settings of a field, from the storage policy"""
+    return args.storage_policy.get(stash.itemcode)
+
+
+def load_storage_policy(args):
+    """
+    Load the storage policy of the fields (see `amami.storage_policy`), whose
+    settings update those of the command line options.
+    Return the arguments with the policy.
+    """
+    default = FieldStorage(
+        level=args.compression,
+        significant_digits=args.significant_digits,
+        quantize_mode=args.quantize_mode,
+        pack=args.pack,
+    )
+    if args.storage_policy is None:
+        policy = StoragePolicy(default)
+    else:
+        policy = StoragePolicy.load(get_abspath(args.storage_policy), default)
+        LOGGER.debug(f"Storage policy loaded from '{args.storage_policy}'.")
+    return argparse.Namespace(**{**vars(args), "storage_policy": policy})
+
+
+def get_field_packing(cube, storage):
+    """
+    Get the parameters to pack the data of a field with its 'storage' settings
+    (see `get_packing`), or None if it is not packed. The range of the field is
+    computed from the data of the cube (chunk by chunk for lazy data).
+    """
+    if storage.pack is None:
+        return None
+    data = cube.core_data()
+    if storage.dtype is not None:
+        data = convert_data(data, storage.dtype)
+    packing = get_packing(data, storage.pack, storage.significant_digits)
+    if packing is None and data.dtype.kind == "f":
+        LOGGER.info(
+            f"Field '{cube.var_name}' -- ITEMCODE: "
+            f"{Stash(cube.attributes['STASH']).itemcode} is not packed."
+        )
+    return packing
+
+
+def get_structure_packing(cube, storage):
+    """
+    Get the packing parameters to define the netCDF variable of a field before its
+    data is read (see `get_unset_packing`), or None if it is not packed with its
+    'storage' settings (no packing, or data that is not floating-point).
+    """
+    if storage.pack is None:
+        return None
+    dtype = cube.dtype if storage.dtype is None else np.dtype(storage.dtype)
+    if dtype.kind != "f":
+        return None
+    return get_unset_packing(dtype, storage.pack)
+
+
+def get_data_packing(cube, storage):
+    """
+    Get the parameters to pack the data of a field (once read) into its netCDF
+    variable, defined before the data was read (see `get_structure_packing`),
+    or None if the variable is not packed.
+    As the type of the variable is already set, a field that would not keep the
+    significant digits of its 'storage' settings is still packed, with a warning.
+    """
+    if get_structure_packing(cube, storage) is None:
+        return None
+    data = cube.data
+    packing = get_packing(data, storage.pack, storage.significant_digits)
+    if packing is None and storage.significant_digits is not None:
+        packing = get_packing(data, storage.pack)
+        if packing is not None:
+            LOGGER.warning(
+                f"Field '{cube.var_name}' -- ITEMCODE: "
+                f"{Stash(cube.attributes['STASH']).itemcode} is packed with less than "
+                f"{storage.significant_digits} significant digits, as its variable "
+                "is defined before its data is read."
+            )
+    if packing is None:
+        # No finite values, all the data is written as the fill value
+        ftype = data.dtype.type
+        packing = {
+            "dtype": np.dtype(storage.pack),
+            "scale_factor": ftype(1),
+            "add_offset": ftype(0),
+        }
+    return packing
+
+
+def transform_field(
+    cube,
+    stash,
+    step,
+    heaviside_uv,
+    heaviside_t,
+    hcrit,
+    storage,
+):
+    """
+    Mask a field (if required by its conversion plan step), convert its data to
+    the type of its 'storage' settings (if any), set its missing value and quantize
+    its data (if required by its storage settings).
+    Return None if the field cannot be masked and has to be skipped.
+    """
+    # Mask pressure level fields
+    if step["mask"]:
+        if not apply_mask_to_pressure_level_field(
+            cube, stash, heaviside_uv, heaviside_t, hcrit
+        ):
+            return None
+    if storage.dtype is not None:
+        cube.data = convert_data(cube.data, storage.dtype)
+    # Set missing value
+    set_missing_value(cube)
+    # Reduce the precision of the data
+    digits = get_quantize_digits(cube, storage)
+    if digits is not None:
+        if digits < storage.quantize_digits:
+            unit = "bits" if storage.quantize_mode == "BitRound" else "digits"
+            LOGGER.warning(
+                f"Field '{cube.var_name}' -- ITEMCODE: {stash.itemcode} is quantized "
+                f"to {digits} significant {unit}, the maximum for {cube.dtype} data."
+            )
+        quantize(cube.data, digits, storage.quantize_mode)
+        set_quantize_attrs(cube, digits, storage.quantize_mode)
+    return cube
+
+
+def compile_plan_step(
+    cube,
+    stash,
+    simple,
+    nomask,
+    grid_type,
+    z_rho,
+    z_theta,
+    coord_cache=None,
+) -> dict:
+    """
+    Take the metadata decisions for a cube (variable names, lat/lon and level
+    coordinate names, masking), apply them to the cube and return them
+    as a conversion plan step.
+    """
+    name_cube(cube, stash, simple)
+    fix_latlon_coord(cube, grid_type, coord_cache)
+    fix_level_coord(cube, z_rho, z_theta)
+    return {
+        "itemcode": stash.itemcode,
+        "convert": True,
+        "mask": not nomask and get_mask_type(stash.itemcode) is not None,
+        "var_name": cube.var_name,
+        "standard_name": cube.standard_name,
+        "long_name": cube.long_name,
+        "units": str(cube.units),
+        "coord_var_names": {
+            coord.name(): coord.var_name
+            for coord in cube.coords()
+            if coord.name() in PLAN_COORD_NAMES
+        },
+    }
+
+
+def replay_plan_step(cube, step, coord_cache=None):
+    """Apply the metadata decisions of a conversion plan step to a cube"""
+    cube.var_name = step["var_name"]
+    cube.standard_name = step["standard_name"]
+    cube.long_name = step["long_name"]
+    cube.units = step["units"]
+    prepare_latlon_coord(cube, coord_cache)
+    for name, var_name in step["coord_var_names"].items():
+        cube.coord(name).var_name = var_name
+
+
+def prepare_fields(args):
+    """
+    Load the cubes of the UM file and fix their metadata and coordinates
+    (without reading their data), following the conversion plan.
+    Return the list of the fields to convert (as (cube, stash, plan step) tuples),
+    the heaviside fields (by mask type), the conversion plan and whether the
+    plan was replayed from the cache.
+    """
+    infile = get_infile(args.infile)
     # Use mule to get the model levels to help with dimension naming
     LOGGER.info(f"Reading UM file {infile}")
-    ff = umutils.read_fieldsfile(infile)
-    try:
-        cubes = iris.load(infile)
-    except iris.exceptions.CannotAddError:
-        msg = ("UM file can not be processed. UM files with time series currently not supported."
-               "Convert with convsh https://ncas-cms.github.io/xconv-doc/html/example1.html.")
-        raise UMError(msg)
+    ff, lookup = umutils.read_fieldsfile(infile, return_lookup=True)
+    cubes = umload.load_cubes(
+        infile,
+        ff,
+        lookup,
+        engine=args.engine,
+        read_threads=args.read_threads,
+        # Keep the byte order of the UM file for big-endian outputs
+        byteorder=">" if get_endian(args.endian) == "big" else "=",
+    )
 
     # Get order of fields (from stash codes)
-    stash_order = list(dict.fromkeys([f.lbuser4 for f in ff.fields]))
+    stash_order = [stash for stash, in umutils.group_lookup(lookup, ("stash",))]
     LOGGER.debug(f"{stash_order=}")
     # Order the cubelist based on input order
-    cubes.sort(key=lambda c:
-               stash_order.index(c.attributes['STASH'].section*1000 + c.attributes['STASH'].item))
+    stash_rank = {stash: rank for rank, stash in enumerate(stash_order)}
+    cubes.sort(key=lambda c: stash_rank[get_itemcode(c)])
 
     # Get heaviside fields for pressure level masking
+    heaviside_uv = heaviside_t = None
     if not args.nomask:
-        heaviside_uv = get_heaviside_uv(cubes)
-        heaviside_t = get_heaviside_t(cubes)
+        cubes_index = index_cubes(cubes)
+        heaviside_uv = get_heaviside_uv(cubes_index)
+        heaviside_t = get_heaviside_t(cubes_index)
     # Get grid type
     grid_type = umutils.get_grid_type(ff)
     # Get sea level on rho levels
     z_rho = umutils.get_sealevel_rho(ff)
     # Get sea level on theta levels
     z_theta = umutils.get_sealevel_theta(ff)
-    # Write output file
-    LOGGER.info(f"Writing netCDF file {outfile}")
+    # Use sets for the --include/--exclude checks
+    include_list = set(args.include_list or ())
+    exclude_list = set(args.exclude_list or ())
+    # Get the conversion plan for the layout of the UM file and the chosen options.
+    # A cached plan is replayed, otherwise a new plan is compiled while converting.
+    fingerprint = get_layout_fingerprint(
+        lookup,
+        engine=args.engine,
+        simple=args.simple,
+        nomask=args.nomask,
+        include=sorted(include_list),
+        exclude=sorted(exclude_list),
+        grid_type=grid_type,
+        z_rho=np.atleast_1d(z_rho).tolist(),
+        z_theta=np.atleast_1d(z_theta).tolist(),
+    )
+    plan = (
+        ConversionPlan.load(args.plan_cache, fingerprint) if args.plan_cache else None
+    )
+    if plan is not None and not plan.matches(get_itemcode(c) for c in cubes):
+        LOGGER.info(
+            "Cached conversion plan does not match the UM file fields. "
+            "Compiling a new plan."
+        )
+        plan = None
+    replay = plan is not None
+    if replay:
+        LOGGER.info("Replaying cached conversion plan.")
+    else:
+        plan = ConversionPlan(fingerprint)
+    # Coordinates shared between cubes are canonicalised only once
+    coord_cache = CoordCache()
+    # Fix the pressure coordinates of the heaviside fields as those of the masked fields
+    if not args.nomask:
+        heaviside_uv, heaviside_t = (
+            h if h is None else fix_pressure_coord(h.copy(), coord_cache)
+            for h in (heaviside_uv, heaviside_t)
+        )
 
-    try:
-        with iris.fileformats.netcdf.Saver(outfile, nc_format) as sman:
+    # Fix the metadata and coordinates of all the fields, before writing any of them
+    converted = []
+    for i, c in enumerate(cubes):
+        stash = Stash(c.attributes["STASH"])
+        itemcode = stash.itemcode
+        LOGGER.debug(f"Processing STASH field: {itemcode}")
+        if replay:
+            step = plan.steps[i]
+        # Skip fields not specified with --include-list option
+        # or fields specified with --exclude-list option
+        elif (include_list and itemcode not in include_list) or (
+            itemcode in exclude_list
+        ):
+            step = {"itemcode": itemcode, "convert": False}
+            plan.steps.append(step)
+        else:
+            # Name cube, lat/lon and model_level_number coordinates
+            step = compile_plan_step(
+                c,
+                stash,
+                args.simple,
+                args.nomask,
+                grid_type,
+                z_rho,
+                z_theta,
+                coord_cache,
+            )
+            plan.steps.append(step)
+        if not step["convert"]:
+            LOGGER.debug(
+                f"Field with itemcode '{itemcode}' excluded from the conversion."
+            )
+            continue
+        if replay:
+            replay_plan_step(c, step, coord_cache)
+        # Remove unreliable intervals in cell methods
+        fix_cell_methods(c)
+        # Fix pressure coordinates
+        c = fix_pressure_coord(c, coord_cache)
+        # Convert proleptic calendar
+        convert_proleptic_calendar(c, coord_cache)
+        converted.append((c, stash, step))
+    coord_cache.report()
+    # Write each identical coordinate and formula term only once
+    share_coords([c for c, _, _ in converted])
+    heavisides = {"uv": heaviside_uv, "t": heaviside_t}
+    return converted, heavisides, plan, replay
+
+
+def get_pipeline_stages(args, heavisides) -> tuple:
+    """Get the read and transform stages of the conversion pipeline"""
+
+    def read_stage(item):
+        c, stash, step = item
+        return read_field(c, args.use64bit), stash, step
+
+    def transform_stage(item):
+        c, stash, step = item
+        c = transform_field(
+            c,
+            stash,
+            step,
+            heavisides["uv"],
+            heavisides["t"],
+            args.hcrit,
+            get_field_storage(args, stash),
+        )
+        return None if c is None else (c, stash)
+
+    return read_stage, transform_stage
+
+
+def is_writable(stash, step, heavisides) -> bool:
+    """Check whether a field can be written (fields to mask need a heaviside field)"""
+    return not step["mask"] or heavisides[get_mask_type(stash.itemcode)] is not None
+
+
+def write_netcdf(target, nc_format, fields, args, infile) -> None:
+    """
+    Write the fields to the netCDF file 'target' with the iris Saver.
+    'target' can be a path or an open netCDF4 Dataset, in which case all
+    the data must have been read already.
+    """
+    in_dataset = not isinstance(target, str)
+    with iris.fileformats.netcdf.Saver(
+        target,
+        get_saver_format(nc_format),
+        compute=not in_dataset,
+    ) as sman:
+        # Add global attributes
+        add_global_attrs(infile, sman, args.nohist)
+        for c, stash in fields:
+            LOGGER.info(f"Writing field '{c.var_name}' -- ITEMCODE: {stash.itemcode}")
+            storage = get_field_storage(args, stash)
+            cubewrite(
+                c,
+                sman,
+                storage,
+                endian=get_endian(args.endian),
+                packing=get_field_packing(c, storage),
+            )
+    if in_dataset and sman._delayed_writes:
+        raise AmamiError("Unable to write lazy data to an open netCDF dataset.")
+
+
+def write_structure(
+    path,
+    nc_format,
+    items,
+    args,
+    chunk_writer,
+    infile=None,
+) -> list:
+    """
+    Write the structure of a netCDF file with the fields in 'items', without
+    reading their data, to be written later with the 'chunk_writer'.
+    The packing attributes of the packed fields are set when their data is
+    written (see `write_data`).
+    Global attributes are added if the input file 'infile' is given.
+    Return the names of the netCDF variables of the fields.
+    """
+    varnames = []
+    target = path
+    if nc_format != get_saver_format(nc_format):
+        target = netCDF4.Dataset(path, "w", format=nc_format)
+    sman = iris.fileformats.netcdf.Saver(
+        target, get_saver_format(nc_format), compute=False
+    )
+    with sman:
+        if infile is not None:
             # Add global attributes
             add_global_attrs(infile, sman, args.nohist)
-            for c in cubes:
-                stash = Stash(c.attributes['STASH'])
-                itemcode = stash.itemcode
-                LOGGER.debug(
-                    f"Processing STASH field: {itemcode}"
-                )
-                # Skip fields not specified with --include-list option
-                # or fields specified with --exclude-list option
-                if (
-                    (args.include_list and itemcode not in args.include_list)
-                    or
-                    (args.exclude_list and itemcode in args.exclude_list)
-                ):
-                    LOGGER.debug(
-                        f"Field with itemcode '{itemcode}' excluded from the conversion."
-                    )
-                    continue
-                # Name cube
-                name_cube(c, stash, args.simple)
-                # Remove unreliable intervals in cell methods
-                fix_cell_methods(c)
-                # Properly name lat/lon coordinates
-                fix_latlon_coord(c, grid_type)
-                # Properly name model_level_number coordinates
-                fix_level_coord(c, z_rho, z_theta)
-                # Mask pressure level fields
-                if not args.nomask:
-                    if not apply_mask_to_pressure_level_field(
-                        c,
-                        stash,
-                        heaviside_uv,
-                        heaviside_t,
-                        args.hcrit
-                    ):
-                        continue
-                # Fix pressure coordinates
-                c = fix_pressure_coord(c)
-                # change data to 32bit
-                if not args.use64bit:
-                    to32bit_data(c)
-                # Set missing value
-                set_missing_value(c)
-                # Convert proleptic calendar
-                convert_proleptic_calendar(c)
-                LOGGER.info(
-                    f"Writing field '{c.var_name}' -- ITEMCODE: {itemcode}"
+        for c, stash, step in items:
+            storage = get_field_storage(args, stash)
+            # The structure is written from a copy of the cube whose data is a lazy
+            # placeholder, so that the data of the field is neither read nor copied
+            c = c.copy(da.empty(c.shape, dtype=c.dtype, chunks=c.shape))
+            if not args.use64bit:
+                to32bit_data(c)
+            if step["mask"]:
+                # Masked fields are converted to 32 bit (see `apply_mask`)
+                c.data = c.core_data().astype(np.float32, copy=False)
+            set_missing_value(c)
+            set_quantize_attrs(
+                c, get_quantize_digits(c, storage), storage.quantize_mode
+            )
+            varnames.append(
+                cubewrite(
+                    c,
+                    sman,
+                    storage,
+                    chunk_writer,
+                    get_endian(args.endian),
+                    get_structure_packing(c, storage),
                 )
-                cubewrite(c, sman, args.compression)
+            )
+    if target is not path:
+        target.close()
+    sman.complete()
+    return varnames
+
+
+def write_data(path, fields, chunk_writer, args) -> None:
+    """
+    Write the data of the 'fields' in the netCDF file whose structure was written
+    with 'write_structure', compressing the chunks on multiple threads.
+    The data of the packed fields is packed with parameters computed from the
+    data itself, once read.
+    """
+    with chunk_writer.open(path):
+        for c, stash in fields:
+            LOGGER.info(f"Writing field '{c.var_name}' -- ITEMCODE: {stash.itemcode}")
+            try:
+                c, _ = set_time_first(c)
+            except iris.exceptions.CoordinateNotFoundError:
+                pass
+            packing = get_data_packing(c, get_field_storage(args, stash))
+            chunk_writer.write_data(c.data, packing)
+
+
+def split_fields(converted, indices, nworkers) -> list:
+    """
+    Split the fields at the given 'indices' of the field list into 'nworkers'
+    groups with about the same amount of data.
+    """
+    groups = [[] for _ in range(nworkers)]
+    sizes = [0] * nworkers
+    # Largest fields first, each to the group with the least data
+    for i in sorted(indices, key=lambda i: -np.prod(converted[i][0].shape)):
+        group = sizes.index(min(sizes))
+        groups[group].append(i)
+        sizes[group] += np.prod(converted[i][0].shape)
+    return [sorted(group) for group in groups if group]
+
+
+def init_worker(log_level, command) -> None:
+    """Set up the logging of a worker process like that of the main process"""
+    amami.__command__ = command
+    LOGGER.setLevel(log_level)
+    if log_level >= 40:  # logging.ERROR
+        import warnings
+
+        warnings.filterwarnings("ignore")
+
+
+def convert_fields_worker(args, indices, path) -> list:
+    """
+    Convert the fields at the given 'indices' of the field list into the
+    netCDF file 'path' (run by the worker processes of the '--workers' option).
+    Each worker loads the UM file on its own, as cubes with lazy data
+    cannot be shared between processes.
+    Return the names of the netCDF variables of the fields.
+    """
+    converted, heavisides, _, _ = prepare_fields(args)
+    items = [converted[i] for i in indices]
+    chunk_writer = DirectChunkWriter(args.write_threads)
+    varnames = write_structure(
+        path, get_nc_format(args.format), items, args, chunk_writer
+    )
+    fields = run_pipeline(
+        items,
+        get_pipeline_stages(args, heavisides),
+        queue_size=args.prefetch,
+    )
+    write_data(path, fields, chunk_writer, args)
+    return varnames
+
+
+def convert_fields(args, groups, tmpdir) -> dict:
+    """
+    Convert each group of fields (indices of the field list) on its own worker
+    process, into a netCDF file in 'tmpdir'.
+    Return the netCDF file and variable of each field, by index.
+    """
+    with ProcessPoolExecutor(
+        len(groups),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(LOGGER.getEffectiveLevel(), amami.__command__),
+    ) as pool:
+        paths = [os.path.join(tmpdir, f"worker_{n}.nc") for n in range(len(groups))]
+        futures = [
+            pool.submit(convert_fields_worker, args, group, path)
+            for group, path in zip(groups, paths)
+        ]
+        return {
+            i: (path, varname)
+            for group, path, future in zip(groups, paths, futures)
+            for i, varname in zip(group, future.result())
+        }
+
+
+def write_fields_worker(args, indices, path, varnames) -> None:
+    """
+    Write the data of the fields at the given 'indices' of the field list directly
+    into their netCDF variables 'varnames' of the preallocated netCDF3 file 'path'
+    (run by the worker processes of the '--workers' option).
+    """
+    converted, heavisides, _, _ = prepare_fields(args)
+    fields = run_pipeline(
+        [converted[i] for i in indices],
+        get_pipeline_stages(args, heavisides),
+        queue_size=args.prefetch,
+    )
+    write_data(path, fields, MemmapWriter(varnames), args)
+
+
+def write_fields(args, groups, path, varnames) -> None:
+    """
+    Write the data of each group of fields (indices of the field list) on its own
+    worker process, directly into the netCDF3 file 'path', whose structure is
+    already written with the netCDF variable of each field in 'varnames' (by index).
+    """
+    with ProcessPoolExecutor(
+        max(len(groups), 1),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(LOGGER.getEffectiveLevel(), amami.__command__),
+    ) as pool:
+        futures = [
+            pool.submit(
+                write_fields_worker, args, group, path, [varnames[i] for i in group]
+            )
+            for group in groups
+        ]
+        for future in futures:
+            future.result()
+
+
+# Fields prepared by a worker process of the '--shared-memory' mode
+_WORKER_FIELDS = {}
+
+
+def init_shared_worker(log_level, command, args) -> None:
+    """Set up a worker process of the '--shared-memory' mode and prepare its fields"""
+    init_worker(log_level, command)
+    converted, heavisides, _, _ = prepare_fields(args)
+    _WORKER_FIELDS.update(args=args, converted=converted, heavisides=heavisides)
+
+
+def _write_shared_field(index, data, path) -> str:
+    args = _WORKER_FIELDS["args"]
+    heavisides = _WORKER_FIELDS["heavisides"]
+    c, stash, step = _WORKER_FIELDS["converted"][index]
+    # The cube takes the shared data as it is (without copying it)
+    c = c.copy(data)
+    chunk_writer = DirectChunkWriter(args.write_threads)
+    (varname,) = write_structure(
+        path,
+        get_nc_format(args.format),
+        [(c, stash, step)],
+        args,
+        chunk_writer,
+    )
+    c = transform_field(
+        c,
+        stash,
+        step,
+        heavisides["uv"],
+        heavisides["t"],
+        args.hcrit,
+        get_field_storage(args, stash),
+    )
+    write_data(path, [(c, stash)], chunk_writer, args)
+    return varname
+
+
+def convert_shared_field_worker(index, descriptor, path) -> str:
+    """
+    Convert the field at the given 'index' of the field list into the netCDF file
+    'path', using the data in shared memory described by 'descriptor'
+    (run by the worker processes of the '--shared-memory' mode).
+    Return the name of the netCDF variable of the field.
+    """
+    block, data = attach(descriptor)
+    try:
+        varname = _write_shared_field(index, data, path)
+    finally:
+        del data
+    block.close()
+    return varname
+
+
+def convert_fields_shared(args, converted, indices, tmpdir, nworkers) -> dict:
+    """
+    Convert the fields at the given 'indices' of the field list on 'nworkers'
+    worker processes. The data of the fields is read by this process and handed
+    over to the workers through shared memory. Each field is converted into its
+    own netCDF file in 'tmpdir'.
+    Return the netCDF file and variable of each field, by index.
+    """
+    # Blocks for the fields being converted, plus those read ahead
+    shared = SharedArrayPool(nworkers + max(args.prefetch, 1))
+    with shared, ProcessPoolExecutor(
+        nworkers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_shared_worker,
+        initargs=(LOGGER.getEffectiveLevel(), amami.__command__, args),
+    ) as pool:
+        futures = {}
+        for i in indices:
+            c, _, _ = converted[i]
+            # Read the data without keeping it in the cube
+            descriptor = shared.put(read_field(c.copy(), args.use64bit).data)
+            path = os.path.join(tmpdir, f"field_{i}.nc")
+            future = pool.submit(convert_shared_field_worker, i, descriptor, path)
+            future.add_done_callback(lambda _, d=descriptor: shared.release(d))
+            futures[i] = (path, future)
+        return {i: (path, future.result()) for i, (path, future) in futures.items()}
+
+
+def convert_to_memory(args) -> memoryview:
+    """
+    Convert the UM file into a netCDF file held in memory (netCDF4 in-memory mode),
+    and return its content.
+    """
+    infile = get_infile(args.infile)
+    nc_format = get_nc_format(args.format)
+    check_ncformat(nc_format, args.use64bit)
+    args = check_endian(args, nc_format)
+    args = load_storage_policy(args)
+    if args.write_threads > 1 or args.workers > 1 or args.stage_dir is not None:
+        LOGGER.warning(
+            "The '--write-threads', '--workers' and '--stage-dir' options are "
+            "ignored when the netCDF file is written in memory."
+        )
+    spool = None
+    try:
+        args, spool = spool_infile(args, infile)
+        converted, heavisides, plan, replay = prepare_fields(args)
+        LOGGER.info("Writing netCDF file in memory")
+        fields = run_pipeline(
+            converted,
+            get_pipeline_stages(args, heavisides),
+            queue_size=args.prefetch,
+        )
+        dataset = netCDF4.Dataset(
+            f"{os.path.basename(infile)}.nc",
+            "w",
+            format=nc_format,
+            memory=0,
+        )
+        try:
+            write_netcdf(dataset, nc_format, fields, args, infile)
+        finally:
+            content = dataset.close()
+    except Exception as ex:
+        raise AmamiError(ex)
+    finally:
+        if spool is not None:
+            os.remove(spool)
+    # Store the compiled conversion plan for the following files
+    if args.plan_cache and not replay:
+        plan.save(args.plan_cache)
+    return content
+
+
+def main(args):
+    """
+    Main function for `um2nc` command
+    """
+    LOGGER.debug(f"{args=}")
+    if args.outfile == "-":
+        # Write the netCDF file to stdout, sending all the log messages to stderr
+        stdout = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            content = convert_to_memory(args)
+        stdout.write(content)
+        stdout.flush()
+        return
+    # Get input path
+    infile = get_infile(args.infile)
+    LOGGER.debug(f"{infile=}")
+    # Get output path
+    remote = remote_files.is_url(args.outfile)
+    outfile = args.outfile if remote else get_abspath(args.outfile, checkdir=True)
+    # Get netCDF format
+    nc_format = get_nc_format(args.format)
+    check_ncformat(nc_format, args.use64bit)
+    args = check_endian(args, nc_format)
+    args = load_storage_policy(args)
+    # Compress the data chunks on multiple threads or processes if required
+    chunk_writer = None
+    nworkers = args.workers
+    if nc_format.startswith("NETCDF3"):
+        # Define the whole netCDF3 file before writing its data through memory maps
+        # (on multiple processes if required)
+        chunk_writer = MemmapWriter()
+    elif args.write_threads > 1 or nworkers > 1:
+        if args.compression == 0:
+            LOGGER.warning(
+                "Multithreaded and multiprocess compression are only available for "
+                "compressed 'NETCDF4' and 'NETCDF4_CLASSIC' files. The file will be "
+                "written with a single thread."
+            )
+            nworkers = 1
+        else:
+            chunk_writer = DirectChunkWriter(args.write_threads)
+    # Build the file in the staging directory (if any), and publish it when complete.
+    # Remote files are always built locally, and uploaded when complete.
+    stage_dir = None
+    workfile = outfile
+    if args.stage_dir is not None or remote:
+        stage_dir = tempfile.mkdtemp(
+            prefix="um2nc_",
+            dir=None if args.stage_dir is None else get_abspath(args.stage_dir),
+        )
+        workfile = os.path.join(stage_dir, os.path.basename(outfile))
+
+    spool = None
+    try:
+        # Compressed and archived UM files are extracted next to the staged file
+        args, spool = spool_infile(args, infile, stage_dir)
+        converted, heavisides, plan, replay = prepare_fields(args)
+        # Write output file
+        LOGGER.info(f"Writing netCDF file {workfile}")
+        # Read the next fields and mask them while the current one is written
+        stages = get_pipeline_stages(args, heavisides)
+        if chunk_writer is None:
+            fields = run_pipeline(converted, stages, queue_size=args.prefetch)
+            write_netcdf(workfile, nc_format, fields, args, infile)
+        elif nworkers == 1:
+            # Write the structure of the file first (without reading any data)
+            # Fields that cannot be masked are skipped
+            write_structure(
+                workfile,
+                nc_format,
+                [
+                    (c, stash, step)
+                    for c, stash, step in converted
+                    if is_writable(stash, step, heavisides)
+                ],
+                args,
+                chunk_writer,
+                infile,
+            )
+            # Write the data (compressing the chunks on multiple threads for netCDF4)
+            fields = run_pipeline(converted, stages, queue_size=args.prefetch)
+            write_data(workfile, fields, chunk_writer, args)
+        else:
+            indices = []
+            for i, (c, stash, step) in enumerate(converted):
+                if is_writable(stash, step, heavisides):
+                    indices.append(i)
+                else:
+                    # The heaviside field is missing: only warn that the field
+                    # is skipped
+                    apply_mask_to_pressure_level_field(c, stash, None, None, args.hcrit)
+            # Write the structure of the file first (without reading any data)
+            varnames = write_structure(
+                workfile,
+                nc_format,
+                [converted[i] for i in indices],
+                args,
+                chunk_writer,
+                infile,
+            )
+            groups = split_fields(converted, indices, nworkers)
+            LOGGER.info(f"Converting the fields on {len(groups)} worker processes.")
+            if isinstance(chunk_writer, MemmapWriter):
+                # Preallocate the file, and write the data directly from the workers
+                with chunk_writer.open(workfile):
+                    pass
+                write_fields(args, groups, workfile, dict(zip(indices, varnames)))
+            else:
+                # Convert the fields into temporary files on the worker processes,
+                # next to the output file
+                with tempfile.TemporaryDirectory(
+                    prefix=".um2nc_", dir=os.path.dirname(workfile)
+                ) as tmpdir:
+                    if not groups:
+                        sources = {}
+                    elif args.shared_memory:
+                        sources = convert_fields_shared(
+                            args, converted, indices, tmpdir, len(groups)
+                        )
+                    else:
+                        sources = convert_fields(args, groups, tmpdir)
+                    # Copy the compressed chunks into the output file
+                    LOGGER.info("Merging the converted fields into the output file.")
+                    with chunk_writer.open(workfile):
+                        for i in indices:
+                            chunk_writer.copy_data(*sources[i])
+        if stage_dir is not None:
+            LOGGER.info(f"Publishing netCDF file {outfile}")
+            if remote:
+                remote_files.upload_file(workfile, outfile)
+            else:
+                publish_file(workfile, outfile)
 
     # Catch any errors and remove the output file if it exists
     except Exception as ex:
-        if os.path.exists(outfile):
-            os.remove(outfile)
+        if os.path.exists(workfile):
+            os.remove(workfile)
         raise AmamiError(ex)
+    finally:
+        if spool is not None and os.path.exists(spool):
+            os.remove(spool)
+        if stage_dir is not None:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+    # Store the compiled conversion plan for the following files
+    if args.plan_cache and not replay:
+        plan.save(args.plan_cache)
@@ -0,0 +1,132 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to store the conversion plans of UM files.
+
+A conversion plan records the metadata decisions taken when converting the cubes
+of a UM file (variable and coordinate names, masking, fields to skip).
+All the files from the same model configuration have the same layout (STASH
+items, grids, levels and processing), so a plan compiled for one file can be
+replayed on the following ones, leaving only the data steps to run per file.
+Plans are serialised as JSON files in a cache directory, named after the
+fingerprint of the layout they were compiled for.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import amami
+from amami.um_load import MERGE_KEYS, PSEUDO_LEVEL_KEYS, LEVEL_KEYS
+from amami.loggers import LOGGER
+
+# Version of the plan format. Plans with a different version are recompiled.
+PLAN_VERSION = 1
+# Lookup words that define the layout of a UM file (all but the time words)
+LAYOUT_KEYS = MERGE_KEYS + PSEUDO_LEVEL_KEYS + LEVEL_KEYS + ("lbpack", "bmdi")
+
+
+def get_layout_fingerprint(lookup: np.ndarray, **options) -> str:
+    """
+    Get a fingerprint of the layout of a UM file from its lookup table,
+    combined with the given options (which must be JSON serialisable).
+    Files with the same STASH items, grids, levels and processing have the same
+    fingerprint, regardless of their times and of the number of fields.
+    """
+    layout = np.unique(
+        np.stack([lookup[key].astype(np.float64) for key in LAYOUT_KEYS], axis=1),
+        axis=0,
+    )
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(layout).tobytes())
+    sha.update(
+        json.dumps(
+            {"version": PLAN_VERSION, "amami": amami.__version__, **options},
+            sort_keys=True,
+            default=str,
+        ).encode()
+    )
+    return sha.hexdigest()
+
+
+class ConversionPlan:
+    """
+    Conversion plan of the cubes of a UM file.
+    Each step is a dictionary with the decisions for the cube at the same position
+    in the (ordered) cube list.
+    """
+
+    def __init__(self, fingerprint: str, steps: list = None):
+        self.fingerprint = fingerprint
+        self.steps = steps if steps is not None else []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def matches(self, itemcodes) -> bool:
+        """Check whether the plan was compiled for cubes with the given item codes"""
+        itemcodes = list(itemcodes)
+        return len(itemcodes) == len(self.steps) and all(
+            s["itemcode"] == i for s, i in zip(self.steps, itemcodes)
+        )
+
+    @staticmethod
+    def get_path(cache_dir: str, fingerprint: str) -> str:
+        """Get the path of the plan for the given fingerprint in the cache directory"""
+        return os.path.join(cache_dir, f"um2nc_plan_{fingerprint[:32]}.json")
+
+    @classmethod
+    def load(cls, cache_dir: str, fingerprint: str):
+        """
+        Load the plan for the given fingerprint from the cache directory.
+        Return None if no valid plan is found.
+        """
+        path = cls.get_path(cache_dir, fingerprint)
+        try:
+            with open(path, encoding="utf-8") as fplan:
+                content = json.load(fplan)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            LOGGER.warning(f"Unable to read conversion plan '{path}': {err}")
+            return None
+        if (
+            content.get("version") != PLAN_VERSION
+            or content.get("fingerprint") != fingerprint
+        ):
+            return None
+        LOGGER.debug(f"Conversion plan loaded from '{path}'.")
+        return cls(fingerprint, content["steps"])
+
+    def save(self, cache_dir: str) -> None:
+        """
+        Save the plan in the cache directory.
+        The file is written atomically, so concurrent conversions never read a
+        partial plan.
+        """
+        path = self.get_path(cache_dir, self.fingerprint)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w",
+                dir=cache_dir,
+                suffix=".tmp",
+                delete=False,
+                encoding="utf-8",
+            ) as fplan:
+                json.dump(
+                    {
+                        "version": PLAN_VERSION,
+                        "fingerprint": self.fingerprint,
+                        "steps": self.steps,
+                    },
+                    fplan,
+                    indent=1,
+                )
+            os.replace(fplan.name, path)
+        except OSError as err:
+            LOGGER.warning(f"Unable to save conversion plan '{path}': {err}")
+        else:
+            LOGGER.debug(f"Conversion plan saved to '{path}'.")
@@ -9,6 +9,7 @@ Miscellaneous module for different utility functions.
 
 import os
 import itertools
+import shutil
 from amami.exceptions import ParsingError
 
 
@@ -43,3 +44,40 @@ def create_unexistent_file(path):
     for n in itertools.count(1):
         if not os.path.exists(new_path := f"{path}_{n}"):
             return new_path
+
+
+def publish_file(path: str, target: str, bufsize: int = 64 * 1024**2) -> None:
+    """
+    Move the file 'path' to 'target', so that 'target' is never seen partially written.
+    Across file systems, the file is copied with large sequential writes next to
+    'target' and synced to disk, before being atomically renamed to 'target'.
+    """
+    target_dir = os.path.dirname(os.path.abspath(target))
+    if os.stat(path).st_dev == os.stat(target_dir).st_dev:
+        os.replace(path, target)
+    else:
+        tmp_path = os.path.join(
+            target_dir, f".{os.path.basename(target)}.{os.getpid()}.tmp"
+        )
+        try:
+            with open(path, "rb") as fsrc, open(tmp_path, "xb") as fdst:
+                shutil.copyfileobj(fsrc, fdst, bufsize)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.remove(path)
+    # Make the rename durable
+    try:
+        dir_fd = os.open(target_dir, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
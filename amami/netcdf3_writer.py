@@ -0,0 +1,316 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to write the data of netCDF3 variables through memory maps.
+
+In the netCDF3 formats (classic, 64-bit offset and CDF5) the data of each variable
+is stored uncompressed at an offset fixed by the header of the file.
+Once the whole file is defined (see `DeferredWriter`), the header is parsed here,
+the file is preallocated with its final number of records, and the data of each
+variable is copied into a `numpy.memmap` view of its place in the file,
+with no call to netCDF-C.
+As the offsets never change, several processes can write different variables
+of the same file at the same time.
+"""
+
+import os
+from typing import NamedTuple, Optional, Sequence, Tuple
+import numpy as np
+from amami.chunk_writer import DeferredWriter, check_cast
+from amami.exceptions import AmamiError
+from amami.loggers import LOGGER
+from amami.packing import pack
+
+# Header tags
+_NC_DIMENSION = 10
+_NC_VARIABLE = 11
+_NC_ATTRIBUTE = 12
+# Big-endian dtypes of the netCDF3 external types
+_NC_TYPES = {
+    1: ">i1",
+    2: "S1",
+    3: ">i2",
+    4: ">i4",
+    5: ">f4",
+    6: ">f8",
+    7: ">u1",
+    8: ">u2",
+    9: ">u4",
+    10: ">i8",
+    11: ">u8",
+}
+# netCDF-C default fill values, by kind and size of the dtype
+_DEFAULT_FILLS = {
+    "i1": -127,
+    "i2": -32767,
+    "i4": -2147483647,
+    "i8": -9223372036854775806,
+    "u1": 255,
+    "u2": 65535,
+    "u4": 4294967295,
+    "u8": 18446744073709551614,
+    "f4": 9.969209968386869e36,
+    "f8": 9.969209968386869e36,
+}
+
+
+class Variable(NamedTuple):
+    """Layout of a netCDF3 variable"""
+
+    dtype: np.dtype
+    # Shape, with 0 for the unlimited dimension
+    shape: Tuple[int, ...]
+    begin: int
+    is_record: bool
+    fill_value: Optional[object]
+    # Offset in the file and dtype of the values of each attribute
+    attributes: Optional[dict] = None
+
+
+class Header(NamedTuple):
+    """Layout of a netCDF3 file, parsed from its header"""
+
+    version: int
+    numrecs: int
+    variables: dict
+    begin_rec: int
+    recsize: int
+
+    @property
+    def numrecs_size(self) -> int:
+        """Size (bytes) of the number of records, stored after the magic number"""
+        return 8 if self.version == 5 else 4
+
+
+class _HeaderParser:
+    """Parser of the header of a netCDF3 file (see the netCDF file format spec)"""
+
+    def __init__(self, fobj):
+        self._fobj = fobj
+        magic = fobj.read(4)
+        if magic[:3] != b"CDF" or magic[3] not in (1, 2, 5):
+            raise AmamiError(f"'{fobj.name}' is not a netCDF3 file.")
+        self.version = magic[3]
+        # Sizes (bytes) of the counts and offsets
+        self._size = 8 if self.version == 5 else 4
+        self._offset_size = 4 if self.version == 1 else 8
+
+    def _int(self, size=4) -> int:
+        return int.from_bytes(self._fobj.read(size), "big", signed=True)
+
+    def _count(self) -> int:
+        return self._int(self._size)
+
+    def _name(self) -> str:
+        nchars = self._count()
+        name = self._fobj.read(nchars).decode()
+        self._fobj.read(-nchars % 4)
+        return name
+
+    def _list(self, tag, read_item) -> list:
+        list_tag = self._int()
+        nitems = self._count()
+        if list_tag not in (0, tag):
+            raise AmamiError(f"Invalid netCDF3 header in '{self._fobj.name}'.")
+        return [read_item() for _ in range(nitems)]
+
+    def _attribute(self):
+        name = self._name()
+        dtype = np.dtype(_NC_TYPES[self._int()])
+        nvalues = self._count()
+        nbytes = nvalues * dtype.itemsize
+        offset = self._fobj.tell()
+        values = np.frombuffer(self._fobj.read(nbytes), dtype=dtype)
+        self._fobj.read(-nbytes % 4)
+        return name, values, offset
+
+    def _dimension(self):
+        return self._name(), self._count()
+
+    def parse(self) -> Header:
+        numrecs = self._count()
+        dimensions = self._list(_NC_DIMENSION, self._dimension)
+        self._list(_NC_ATTRIBUTE, self._attribute)
+        variables = {}
+
+        def variable():
+            name = self._name()
+            dimids = [self._count() for _ in range(self._count())]
+            attributes = {}
+            offsets = {}
+            for attr_name, values, offset in self._list(_NC_ATTRIBUTE, self._attribute):
+                attributes[attr_name] = values
+                offsets[attr_name] = (offset, values.dtype)
+            dtype = np.dtype(_NC_TYPES[self._int()])
+            self._count()  # vsize, may be clipped for large variables
+            begin = self._int(self._offset_size)
+            shape = tuple(dimensions[dimid][1] for dimid in dimids)
+            is_record = bool(dimids) and dimensions[dimids[0]][1] == 0
+            fill_value = attributes.get("_FillValue", attributes.get("missing_value"))
+            if fill_value is None:
+                fill_value = _DEFAULT_FILLS.get(f"{dtype.kind}{dtype.itemsize}")
+            else:
+                fill_value = fill_value[0]
+            variables[name] = Variable(
+                dtype, shape, begin, is_record, fill_value, offsets
+            )
+
+        self._list(_NC_VARIABLE, variable)
+        records = [var for var in variables.values() if var.is_record]
+        if not records:
+            return Header(self.version, numrecs, variables, 0, 0)
+        sizes = [var.dtype.itemsize * int(np.prod(var.shape[1:])) for var in records]
+        if len(records) == 1:
+            # A single record variable is not padded
+            recsize = sizes[0]
+        else:
+            recsize = sum(-(-size // 4) * 4 for size in sizes)
+        begin_rec = min(var.begin for var in records)
+        return Header(self.version, numrecs, variables, begin_rec, recsize)
+
+
+def read_header(path: str) -> Header:
+    """Parse the header of the netCDF3 file 'path'"""
+    with open(path, "rb") as fobj:
+        return _HeaderParser(fobj).parse()
+
+
+def _set_numrecs(path: str, header: Header, numrecs: int) -> None:
+    """Set the number of records of the file, and extend it to its final size"""
+    size = max(
+        [header.begin_rec + numrecs * header.recsize]
+        + [
+            var.begin + var.dtype.itemsize * int(np.prod(var.shape))
+            for var in header.variables.values()
+            if not var.is_record
+        ]
+    )
+    with open(path, "r+b") as fobj:
+        fobj.seek(4)
+        fobj.write(numrecs.to_bytes(header.numrecs_size, "big"))
+        if os.fstat(fobj.fileno()).st_size < size:
+            # Preallocated as a sparse file
+            fobj.truncate(size)
+
+
+def set_attribute(path: str, header: Header, name: str, attr_name: str, value) -> None:
+    """
+    Set the value of the attribute 'attr_name' of the variable 'name' of the
+    netCDF3 file 'path', in place in its header (keeping the type of the attribute).
+    """
+    offset, dtype = header.variables[name].attributes[attr_name]
+    with open(path, "r+b") as fobj:
+        fobj.seek(offset)
+        fobj.write(np.array([value], dtype=dtype).tobytes())
+
+
+def map_variable(path: str, header: Header, name: str) -> np.ndarray:
+    """
+    Map the data of the variable 'name' of the netCDF3 file 'path' as an array,
+    writing to which writes the file.
+    """
+    var = header.variables[name]
+    if not var.is_record:
+        return np.memmap(
+            path, dtype=var.dtype, mode="r+", offset=var.begin, shape=var.shape
+        )
+    # The records of all the record variables are interleaved
+    records = np.memmap(
+        path,
+        dtype=np.uint8,
+        mode="r+",
+        offset=header.begin_rec,
+        shape=(header.numrecs, header.recsize),
+    )
+    start = var.begin - header.begin_rec
+    size = var.dtype.itemsize * int(np.prod(var.shape[1:]))
+    shape = var.shape[1:]
+    strides = tuple(
+        var.dtype.itemsize * int(np.prod(shape[i + 1 :])) for i in range(len(shape))
+    )
+    return np.lib.stride_tricks.as_strided(
+        records[:, start : start + size].view(var.dtype),
+        shape=(header.numrecs,) + shape,
+        strides=(header.recsize,) + strides,
+    )
+
+
+class MemmapWriter(DeferredWriter):
+    """
+    Write the data of netCDF3 variables through memory maps of the file.
+    The number of records of the file is set, and the file preallocated, by `open`,
+    for the variables whose structure was written with this writer.
+    'varnames' are the names of variables whose structure was written elsewhere
+    (e.g. to write their data from another process, once the file is preallocated).
+    """
+
+    def __init__(self, varnames: Sequence[str] = ()):
+        super().__init__()
+        self._varnames.extend(varnames)
+        self._shapes = {}
+        self._path = None
+        self._header = None
+
+    def write_structure(self, sman, cube, **kwargs) -> str:
+        varname = super().write_structure(sman, cube, **kwargs)
+        self._shapes[varname] = cube.shape
+        return varname
+
+    def open(self, path):
+        """Open the netCDF3 file to write the data (use as a context manager)"""
+        header = read_header(path)
+        numrecs = max(
+            (
+                shape[0]
+                for name, shape in self._shapes.items()
+                if header.variables[name].is_record
+            ),
+            default=0,
+        )
+        if numrecs > header.numrecs:
+            _set_numrecs(path, header, numrecs)
+            header = header._replace(numrecs=numrecs)
+        self._path = path
+        self._header = header
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._path = None
+        self._header = None
+
+    def write_data(self, data, packing: dict = None) -> None:
+        """
+        Write the data (numpy or masked array) of the next variable, packing it
+        with the 'packing' parameters if not None (see `amami.packing.get_packing`),
+        which are also set as the packing attributes of the variable.
+        Masked values, and the records of the file beyond those of the data,
+        are written as the variable fill value.
+        """
+        varname = self._varnames.popleft()
+        var = self._header.variables[varname]
+        if packing is not None:
+            for name in ("scale_factor", "add_offset"):
+                set_attribute(self._path, self._header, varname, name, packing[name])
+            data = pack(
+                data,
+                var.dtype,
+                packing["scale_factor"],
+                packing["add_offset"],
+                var.fill_value,
+            )
+        target = map_variable(self._path, self._header, varname)
+        check_cast(data, var.dtype, varname)
+        if var.is_record:
+            nrecs = data.shape[0]
+            if nrecs > self._header.numrecs:
+                raise AmamiError(
+                    f"Variable '{varname}' has more records than the netCDF file."
+                )
+            # The file is preallocated as a sparse file, whose unwritten
+            # records would read as zeros
+            target[nrecs:] = var.fill_value
+            target = target[:nrecs]
+        target[...] = np.ma.filled(data, var.fill_value)
+        del target
+        LOGGER.debug(f"Variable '{varname}' written through a memory map.")
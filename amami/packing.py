@@ -0,0 +1,127 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to pack floating-point data into small integers, with the CF 'scale_factor'
+and 'add_offset' attributes (unpacked = packed * scale_factor + add_offset).
+
+The packing parameters of a field are computed from the range of its data, found
+in a single pass over the data (chunk by chunk for lazy data). Variables defined
+before their data is read are defined with unset packing parameters, which are
+replaced once the data is read.
+The packed values never take the netCDF default fill value of the integer type,
+which marks the missing values.
+"""
+
+import math
+from typing import Optional, Tuple
+import numpy as np
+import dask.array as da
+import netCDF4
+
+PACK_TYPES = ("int16", "int8")
+
+
+def get_fill_value(dtype) -> int:
+    """Get the netCDF default fill value of an integer type"""
+    dtype = np.dtype(dtype)
+    return netCDF4.default_fillvals[f"{dtype.kind}{dtype.itemsize:1d}"]
+
+
+def get_packed_range(dtype) -> Tuple[int, int]:
+    """Get the range of the packed values of an integer type (above its fill value)"""
+    return get_fill_value(dtype) + 1, np.iinfo(dtype).max
+
+
+def get_data_range(data) -> Optional[Tuple[float, float]]:
+    """
+    Get the minimum and maximum of the non-masked values of 'data' (numpy, masked
+    or dask array), or None if there is no finite value.
+    """
+    if isinstance(data, da.Array):
+        # Both reductions are computed in the same pass over the chunks
+        vmin, vmax = da.compute(data.min(), data.max())
+    else:
+        vmin, vmax = data.min(), data.max()
+    if np.ma.is_masked(vmin) or not np.isfinite([vmin, vmax]).all():
+        return None
+    return float(vmin), float(vmax)
+
+
+def get_packing(data, pack_type: str, significant_digits: int = None) -> Optional[dict]:
+    """
+    Get the parameters to pack the floating-point 'data' into 'pack_type' integers,
+    as the 'packing' dictionary of the iris Saver (dtype, scale_factor and add_offset).
+    Return None if the data cannot be packed: not floating-point, with no finite values,
+    or if the packed values would not keep 'significant_digits' significant digits
+    of the largest values (if not None).
+    """
+    if data.dtype.kind != "f":
+        return None
+    data_range = get_data_range(data)
+    if data_range is None:
+        return None
+    vmin, vmax = data_range
+    dtype = np.dtype(pack_type)
+    pmin, pmax = get_packed_range(dtype)
+    scale = (vmax - vmin) / (pmax - pmin) if vmax > vmin else 1.0
+    if significant_digits is not None and vmax > vmin:
+        magnitude = max(abs(vmin), abs(vmax))
+        # Half a unit of the last significant digit
+        tolerance = 0.5 * 10.0 ** (
+            math.floor(math.log10(magnitude)) - significant_digits + 1
+        )
+        if scale / 2 > tolerance:
+            return None
+    # The packing attributes have the type of the unpacked data
+    ftype = data.dtype.type
+    return {
+        "dtype": dtype,
+        "scale_factor": ftype(scale),
+        "add_offset": ftype(vmin - pmin * scale),
+    }
+
+
+def get_unset_packing(dtype, pack_type: str) -> dict:
+    """
+    Get unset (NaN) packing parameters for floating-point data of type 'dtype',
+    to define a variable packed into 'pack_type' integers before its data, and so
+    its packing parameters, are known. Both packing attributes are then written
+    (the iris Saver only writes those that are not zero), to be replaced later.
+    """
+    ftype = np.dtype(dtype).type
+    return {
+        "dtype": np.dtype(pack_type),
+        "scale_factor": ftype(np.nan),
+        "add_offset": ftype(np.nan),
+    }
+
+
+def to_packable(data, packing: dict):
+    """
+    Convert the floating-point 'data' (numpy or masked array) to float64 values
+    within the range of the 'packing' parameters, so that netCDF4 (whose automatic
+    packing computes in the type of the data) packs them exactly as `pack`.
+    Non-finite values are masked.
+    """
+    scale_factor = np.float64(packing["scale_factor"])
+    add_offset = np.float64(packing["add_offset"])
+    pmin, pmax = get_packed_range(packing["dtype"])
+    values = np.ma.masked_invalid(np.ma.asarray(data, dtype=np.float64))
+    return np.ma.clip(
+        values, add_offset + pmin * scale_factor, add_offset + pmax * scale_factor
+    )
+
+
+def pack(data, dtype, scale_factor, add_offset, fill_value):
+    """
+    Pack the floating-point 'data' (numpy or masked array) into 'dtype' integers.
+    Masked and non-finite values are set to 'fill_value'.
+    """
+    values = np.ma.getdata(data).astype(np.float64)
+    missing = np.ma.getmaskarray(data) | ~np.isfinite(values)
+    packed = np.around((values - np.float64(add_offset)) / np.float64(scale_factor))
+    pmin, pmax = get_packed_range(dtype)
+    np.clip(packed, pmin, pmax, out=packed)
+    packed[missing] = fill_value
+    return packed.astype(dtype)
@@ -6,10 +6,13 @@ Module to define the parser for the 'um2nc' command.
 """
 
 import argparse
+import os
 from typing import List
 from amami.helpers import create_unexistent_file
 from amami.parsers import ParserWithCallback
 from amami.exceptions import ParsingError
+from amami.quantize import get_max_precision
+from amami.um_utils import ARCHIVE_MEMBER_SEP, COMPRESSED_SUFFIXES
 
 
 DESCRIPTION = """\
@@ -30,47 +33,87 @@ Converts INPUT_FILE to a NETCDF3 CLASSIC netCDF, using "simple" variable names \
 """
 
 
-def callback_function(known_args: argparse.Namespace, unknown_args: List[str]) -> argparse.Namespace:
+def get_default_outfile(infile: str) -> str:
+    """
+    Generate the output path from the input path, by appending '.nc' to it.
+    Compression suffixes are removed, and members of tar archives ('ARCHIVE::MEMBER')
+    are converted next to the archive.
+    """
+    archive, _, member = infile.partition(ARCHIVE_MEMBER_SEP)
+    if member:
+        infile = os.path.join(os.path.dirname(archive), os.path.basename(member))
+    for suffix in COMPRESSED_SUFFIXES:
+        if infile.endswith(suffix):
+            infile = infile[: -len(suffix)]
+            break
+    return create_unexistent_file(f"{infile}.nc")
+
+
+def callback_function(
+    known_args: argparse.Namespace, unknown_args: List[str]
+) -> argparse.Namespace:
     """
     Preprocessing for `um2nc` parser.
     Does the following tasks:
     -   Checks optional and positional parameters to understand input and output;
     -   Checks if the output path has been provided, otherwise generates it by
-        appending '.nc' to the input file.
+        appending '.nc' to the input file;
+    -   Checks that the number of prefetched fields is not negative;
+    -   Checks that the number of read threads is positive;
+    -   Checks that the number of write threads is positive;
+    -   Checks that the number of worker processes is positive;
+    -   Checks that the number of significant digits (or bits) is positive, and
+        within the precision of 64-bit data.
     """
 
     # Convert known_args to dict to be able to modify them
     known_args_dict = vars(known_args)
     # Check optional and positional parameters to determine input and output paths.
     if (
-        len(unknown_args) > 2
-    ) or (
-        (None not in [known_args_dict['infile'], known_args_dict['outfile']])
-        and
-        (len(unknown_args) > 0)
-    ) or (
-        ((known_args_dict['infile'] is None) ^
-         (known_args_dict['outfile'] is None))
-        and
-        (len(unknown_args) > 1)
+        (len(unknown_args) > 2)
+        or (
+            (None not in [known_args_dict["infile"], known_args_dict["outfile"]])
+            and (len(unknown_args) > 0)
+        )
+        or (
+            ((known_args_dict["infile"] is None) ^ (known_args_dict["outfile"] is None))
+            and (len(unknown_args) > 1)
+        )
     ):
         raise ParsingError("Too many arguments.")
-    elif (known_args_dict['infile'] is None) and (len(unknown_args) == 0):
+    elif (known_args_dict["infile"] is None) and (len(unknown_args) == 0):
         raise ParsingError("No input file provided.")
-    elif known_args_dict['infile'] is None:
-        known_args_dict['infile'] = unknown_args[0]
-        if known_args_dict['outfile'] is None:
+    elif known_args_dict["infile"] is None:
+        known_args_dict["infile"] = unknown_args[0]
+        if known_args_dict["outfile"] is None:
             if len(unknown_args) == 2:
-                known_args_dict['outfile'] = unknown_args[1]
+                known_args_dict["outfile"] = unknown_args[1]
             else:
-                known_args_dict['outfile'] = create_unexistent_file(
-                    f"{known_args_dict['infile']}.nc")
-    elif known_args_dict['outfile'] is None:
+                known_args_dict["outfile"] = get_default_outfile(
+                    known_args_dict["infile"]
+                )
+    elif known_args_dict["outfile"] is None:
         if len(unknown_args) == 1:
-            known_args_dict['outfile'] = unknown_args[0]
+            known_args_dict["outfile"] = unknown_args[0]
         else:
-            known_args_dict['outfile'] = create_unexistent_file(
-                f"{known_args_dict['infile']}.nc")
+            known_args_dict["outfile"] = get_default_outfile(known_args_dict["infile"])
+    if known_args_dict["prefetch"] < 0:
+        raise ParsingError("The number of prefetched fields cannot be negative.")
+    if known_args_dict["read_threads"] < 1:
+        raise ParsingError("The number of read threads must be at least 1.")
+    if known_args_dict["write_threads"] < 1:
+        raise ParsingError("The number of write threads must be at least 1.")
+    if known_args_dict["workers"] < 1:
+        raise ParsingError("The number of worker processes must be at least 1.")
+    significant_digits = known_args_dict["significant_digits"]
+    if significant_digits is not None:
+        quantize_mode = known_args_dict["quantize_mode"]
+        unit = "bits" if quantize_mode == "BitRound" else "digits"
+        maximum = get_max_precision("float64", quantize_mode)
+        if not 1 <= significant_digits <= maximum:
+            raise ParsingError(
+                f"The number of significant {unit} must be between 1 and {maximum}."
+            )
     return argparse.Namespace(**known_args_dict)
 
 
@@ -81,120 +124,361 @@ PARSER = ParserWithCallback(
 )
 # Add arguments
 PARSER.add_argument(
-    '-i', '--input',
-    dest='infile',
+    "-i",
+    "--input",
+    dest="infile",
     required=False,
     type=str,
     metavar="INPUT_FILE",
     help="""Path to the UM fieldsfile to be converted.
+Files compressed with gzip ('.gz') or zstd ('.zst', '.zstd', needs the 'zstandard'
+package) are decompressed on the fly. A file within a tar archive can be converted
+with 'ARCHIVE::MEMBER' (e.g. 'run.tar::history/atm/aiihca.pa0001').
+Remote UM files can be given as fsspec URLs (e.g. 's3://bucket/aiihca.pa0001', needs
+the 'fsspec' package), and only the records of the converted fields are downloaded
+(with those of the masking and the orography and surface pressure reference fields).
 Note: Can also be inserted as a positional argument.
 
-"""
+""",
 )
 PARSER.add_argument(
-    '-o', '--output',
+    "-o",
+    "--output",
     required=False,
-    dest='outfile',
+    dest="outfile",
     type=str,
     metavar="OUTPUT_FILE",
     help="""Path for the converted netCDF in output.
 If not provided, the output will be generated by appending '.nc' to the input file.
+Use '-' to write the netCDF file to the standard output (the file is built
+in memory, without writing it to disk).
+Remote paths can be given as fsspec URLs (e.g. 's3://bucket/aiihca.pa0001.nc'): the file
+is built locally, in the staging directory if any, and uploaded when complete.
 Note: Can also be inserted as a positional argument.
 
-"""
+""",
 )
 PARSER.add_argument(
-    '-f', '--format',
-    dest='format',
+    "-f",
+    "--format",
+    dest="format",
     required=False,
     type=str,
-    default='NETCDF4',
-    choices=['NETCDF4', 'NETCDF4_CLASSIC', 'NETCDF3_CLASSIC',
-             'NETCDF3_64BIT', '1', '2', '3', '4'],
+    default="NETCDF4",
+    choices=[
+        "NETCDF4",
+        "NETCDF4_CLASSIC",
+        "NETCDF3_CLASSIC",
+        "NETCDF3_64BIT",
+        "NETCDF3_64BIT_DATA",
+        "1",
+        "2",
+        "3",
+        "4",
+        "5",
+    ],
     help="""Specify netCDF format among 1 ('NETCDF4'), 2 ('NETCDF4_CLASSIC'),
-3 ('NETCDF3_CLASSIC') or 4 ('NETCDF3_64BIT').
-Either numbers or strings are accepted. 
+3 ('NETCDF3_CLASSIC'), 4 ('NETCDF3_64BIT') or 5 ('NETCDF3_64BIT_DATA', also known as
+CDF5, for variables larger than 4 GB).
+Either numbers or strings are accepted.
 Default: 1 ('NETCDF4').
 
-"""
+""",
 )
 PARSER.add_argument(
-    '-c', '--compression',
-    dest='compression',
+    "-c",
+    "--compression",
+    dest="compression",
     required=False,
     type=int,
     default=4,
     help="""Compression level (0=none, 9=max). Default 4.
 
-"""
+""",
+)
+PARSER.add_argument(
+    "--significant-digits",
+    dest="significant_digits",
+    required=False,
+    type=int,
+    default=None,
+    metavar="N",
+    help="""Reduce the precision of the floating-point fields to N significant digits
+(N significant bits with '--quantize-mode BitRound'), setting the unneeded mantissa bits
+so that the data compresses much better. N is at most 15 (52 bits), and 32-bit fields
+are quantized to at most 7 digits (23 bits). The quantization is recorded following
+the CF conventions: the algorithm in a 'quantization' variable, and the precision
+in the 'quantization_nsd' (or 'quantization_nsb') attribute of each variable.
+Default: full precision.
+
+""",
+)
+PARSER.add_argument(
+    "--quantize-mode",
+    dest="quantize_mode",
+    required=False,
+    type=str,
+    default="BitGroom",
+    choices=["BitGroom", "BitRound", "GranularBitRound"],
+    help="""Quantization algorithm used with '--significant-digits' (as in netCDF-C).
+Default: BitGroom.
+
+""",
 )
 PARSER.add_argument(
-    '--64bit',
-    dest='use64bit',
-    action='store_true',
+    "--pack",
+    dest="pack",
+    required=False,
+    type=str,
+    default=None,
+    choices=["int16", "int8"],
+    help="""Pack the floating-point fields into 16-bit or 8-bit integers, with the
+'scale_factor' and 'add_offset' attributes computed from the range of each field.
+With '--significant-digits N', the fields are only packed if they keep N significant
+digits (fields that would lose them are written unpacked), and are not quantized.
+With the netCDF3 formats, or '--write-threads' or '--workers' greater than 1,
+the variables are defined before the data is read, and the packing parameters
+are computed when the data is written: fields that would lose the significant
+digits are then packed anyway, with a warning.
+Default: no packing.
+
+""",
+)
+PARSER.add_argument(
+    "--storage-policy",
+    dest="storage_policy",
+    required=False,
+    type=str,
+    metavar="FILE",
+    default=None,
+    help="""JSON file with the storage settings of the fields, by STASH item code,
+range of item codes (e.g. '30201-30288'), STASH code or STASH variable name.
+For each field, it can set the compression ('codec': 'zlib' or 'none', 'level'),
+the quantization ('significant_digits', 'quantize_mode'), the packing ('pack'),
+the data type the data is converted to ('dtype') and the chunks ('chunks'),
+overriding the corresponding options. A "default" entry applies to all the fields.
+Example: {"default": {"level": 6}, "30": {"dtype": "int8"},
+"30201-30288": {"significant_digits": 3}}.
+Default: the options apply to all the fields.
+
+""",
+)
+PARSER.add_argument(
+    "--64bit",
+    dest="use64bit",
+    action="store_true",
     help="""Use 64 bit netCDF for 64 bit input.
 
-"""
+""",
 )
 PARSER.add_argument(
-    '--nohist',
-    dest='nohist',
-    action='store_true',
+    "--nohist",
+    dest="nohist",
+    action="store_true",
     help="""Don't update history attribute.
 
-"""
+""",
 )
 PARSER.add_argument(
-    '--simple',
-    dest='simple',
-    action='store_true',
+    "--simple",
+    dest="simple",
+    action="store_true",
     help="""Use 'simple' variable names of form 'fld_s01i123'.
 
-"""
+""",
+)
+PARSER.add_argument(
+    "--engine",
+    dest="engine",
+    required=False,
+    type=str,
+    default="iris",
+    choices=["iris", "amami", "structured"],
+    help="""Engine used to load the UM fields into variables.
+'iris' uses the generic iris loading and merging.
+'amami' groups the fields using the UM file lookup table and builds
+each variable directly. It is faster on large files and can also merge
+fields that iris refuses (duplicated or missing fields).
+'structured' uses the iris structured UM loading, which is much faster
+for files whose fields are regularly ordered (all levels for each time,
+or all times for each level). It is only used if the file lookup table
+shows a regular ordering.
+If the chosen engine fails, the 'iris' and then the 'amami' engines are used.
+Default: 'iris'.
+
+""",
+)
+PARSER.add_argument(
+    "--prefetch",
+    dest="prefetch",
+    required=False,
+    type=int,
+    metavar="N",
+    default=2,
+    help="""Number of fields read and masked ahead of the field being written.
+Reading, masking and writing run in separate threads, so that reading
+the next fields overlaps with compressing and writing the current one.
+Higher values use more memory. Use 0 to process one field at a time.
+Default: 2.
+
+""",
+)
+PARSER.add_argument(
+    "--endian",
+    dest="endian",
+    required=False,
+    type=str,
+    choices=["native", "big", "source"],
+    default="native",
+    help="""Byte order of the netCDF4 variables (ignored for the netCDF3 formats,
+whose data is always stored big-endian).
+'source' is the byte order of the UM file (big-endian).
+With a big-endian output, '--engine amami' and '--read-threads' greater than 1,
+the data of unpacked fields is kept in its original byte order when read.
+It is then written without being byte-swapped only with direct chunk writes
+('--write-threads' or '--workers' greater than 1, with compression): netCDF4
+byte-swaps non-native data when writing it, so on the default path
+a big-endian output takes extra byte swaps.
+Default: 'native'.
+
+""",
+)
+PARSER.add_argument(
+    "--read-threads",
+    dest="read_threads",
+    required=False,
+    type=int,
+    metavar="N",
+    default=1,
+    help="""Number of threads used to read and unpack the UM fields
+(only with the 'amami' engine).
+With more than 1 thread, the records of each variable are read in file
+order, merging nearby records into large reads, and unpacked (WGDOS)
+concurrently.
+Default: 1.
+
+""",
+)
+PARSER.add_argument(
+    "--write-threads",
+    dest="write_threads",
+    required=False,
+    type=int,
+    metavar="N",
+    default=1,
+    help="""Number of threads used to compress the data.
+With more than 1 thread, the data of each variable is split into its
+netCDF chunks, which are compressed in parallel and written directly
+to the file. Only available for compressed 'NETCDF4' and
+'NETCDF4_CLASSIC' files, and requires the 'h5py' package.
+Default: 1.
+
+""",
+)
+PARSER.add_argument(
+    "--workers",
+    dest="workers",
+    required=False,
+    type=int,
+    metavar="N",
+    default=1,
+    help="""Number of worker processes used to convert the fields.
+With more than 1 worker, each worker process converts a subset of the fields.
+For compressed 'NETCDF4' and 'NETCDF4_CLASSIC' files, each worker writes its
+fields into a temporary netCDF file, and the compressed data chunks are then
+copied into the output file without being recompressed (requires the 'h5py'
+package). For the netCDF3 formats ('NETCDF3_CLASSIC', 'NETCDF3_64BIT' and
+'NETCDF3_64BIT_DATA'), the output file is defined and preallocated first, and
+each worker writes the data of its fields directly into it through memory maps.
+Default: 1.
+
+""",
+)
+PARSER.add_argument(
+    "--shared-memory",
+    dest="shared_memory",
+    action="store_true",
+    help="""With '--workers' and the netCDF4 formats, read the data of the fields
+in the main process and hand it over to the worker processes through
+shared memory, instead of having each worker read its own fields.
+
+""",
+)
+PARSER.add_argument(
+    "--stage-dir",
+    dest="stage_dir",
+    required=False,
+    type=str,
+    metavar="DIR",
+    default=None,
+    help="""Directory where the netCDF file is built before being published
+to the output path (e.g. a node-local disk or /dev/shm).
+The complete file is copied to the output directory with large
+sequential writes, synced to disk and atomically renamed, so that the
+output file is never seen partially written.
+Default: None.
+
+""",
+)
+PARSER.add_argument(
+    "--plan-cache",
+    dest="plan_cache",
+    required=False,
+    type=str,
+    metavar="DIR",
+    default=None,
+    help="""Directory where the conversion plans are cached.
+A conversion plan records the naming and masking decisions taken for the
+variables of a UM file. Files with the same layout (STASH items, grids,
+levels and processing) converted with the same options reuse the cached
+plan, so only the data is processed for each file.
+If not provided, no plan is cached.
+
+""",
 )
 mutual1 = PARSER.add_mutually_exclusive_group()
 mutual1.add_argument(
-    '--nomask',
-    dest='nomask',
-    action='store_true',
+    "--nomask",
+    dest="nomask",
+    action="store_true",
     help="""Don't apply heavyside function mask to pressure level fields.
 Cannot be used together with --hcrit.
 
-"""
+""",
 )
 mutual1.add_argument(
-    '--hcrit',
-    dest='hcrit',
+    "--hcrit",
+    dest="hcrit",
     type=float,
     default=0.5,
     help="""Critical value of heavyside function for pressure level masking.
 Default: 0.5.
 Cannot be used together with --nomask.
 
-"""
+""",
 )
 mutual2 = PARSER.add_mutually_exclusive_group()
 mutual2.add_argument(
-    '--include',
-    dest='include_list',
+    "--include",
+    dest="include_list",
     type=int,
     metavar=("STASH_CODE1", "STASH_CODE2"),
-    nargs='+',
+    nargs="+",
     help="""List of STASH codes to include in the netCDF conversion.
 Only the variables with the included STASH codes will be converted.
 Cannot be used together with --exclude.
 
-"""
+""",
 )
 mutual2.add_argument(
-    '--exclude',
-    dest='exclude_list',
+    "--exclude",
+    dest="exclude_list",
     type=int,
     metavar=("STASH_CODE1", "STASH_CODE2"),
-    nargs='+',
+    nargs="+",
     help="""List of STASH codes to exclude from the netCDF conversion.
 The variables with the excluded STASH codes will not be converted.
 Cannot be used together with --include.
 
-"""
+""",
 )
@@ -0,0 +1,133 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to run items through a sequence of processing stages.
+
+Each stage runs in its own thread and the stages are connected by bounded queues,
+so that a stage can work on the next items while the following stages process the
+previous ones (e.g. reading a field while the previous one is written).
+When a queue is full the upstream stage waits, which keeps the number of items in
+memory bounded.
+"""
+
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, Sequence
+
+# Marker for the end of the items
+_DONE = object()
+# Timeout (s) used to periodically check whether the pipeline was stopped
+_POLL = 0.1
+
+
+class _Failure:
+    """Exception raised by a stage, passed downstream to the consumer"""
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _put(out_queue, item, stop) -> bool:
+    """Put an item in a queue, unless the pipeline is stopped"""
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=_POLL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(in_queue, stop):
+    """Get an item from a queue, unless the pipeline is stopped"""
+    while not stop.is_set():
+        try:
+            return in_queue.get(timeout=_POLL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def _run_source(items, out_queue, stop):
+    try:
+        for item in items:
+            if not _put(out_queue, item, stop):
+                return
+    except Exception as exc:
+        _put(out_queue, _Failure(exc), stop)
+        return
+    _put(out_queue, _DONE, stop)
+
+
+def _run_stage(stage, in_queue, out_queue, stop):
+    while True:
+        item = _get(in_queue, stop)
+        if item is _DONE or isinstance(item, _Failure):
+            _put(out_queue, item, stop)
+            return
+        try:
+            result = stage(item)
+        except Exception as exc:
+            _put(out_queue, _Failure(exc), stop)
+            return
+        if result is not None and not _put(out_queue, result, stop):
+            return
+
+
+def run_pipeline(
+    items: Iterable,
+    stages: Sequence[Callable],
+    queue_size: int = 2,
+) -> Iterator:
+    """
+    Run 'items' through the 'stages' (functions taking the output of the previous
+    stage) and yield the outputs of the last stage, in the order of the items.
+    Items for which a stage returns None are dropped.
+
+    Each stage runs in its own thread, with up to 'queue_size' items waiting
+    between consecutive stages. If 'queue_size' is 0, the stages run sequentially
+    in the calling thread.
+    Exceptions raised by a stage are re-raised in the calling thread.
+    """
+    if queue_size == 0:
+        for item in items:
+            for stage in stages:
+                item = stage(item)
+                if item is None:
+                    break
+            else:
+                yield item
+        return
+
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = [
+        threading.Thread(
+            target=_run_source,
+            args=(iter(items), queues[0], stop),
+            daemon=True,
+        )
+    ]
+    threads += [
+        threading.Thread(
+            target=_run_stage,
+            args=(stage, queues[i], queues[i + 1], stop),
+            daemon=True,
+        )
+        for i, stage in enumerate(stages)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,130 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to reduce the precision of floating-point data (quantization).
+
+The mantissa bits that are not needed to keep the requested precision are set to
+zero (or alternately to zero and one), which makes the data much more compressible.
+The algorithms are those of netCDF-C (`nc_def_var_quantize`), vectorised with NumPy:
+-   'BitGroom': keeps 'nsd' significant decimal digits, shaving (zeroing) the
+    unneeded bits of even values and setting them of odd values;
+-   'BitRound': keeps 'nsb' significant bits, rounding to the nearest value;
+-   'GranularBitRound': keeps 'nsd' significant decimal digits, rounding each value
+    with the number of bits needed for its own magnitude.
+The precision is limited as in netCDF-C (see `get_max_precision`). Within these
+limits, the results are the same as those of netCDF-C 4.9.3, except for 'BitGroom'
+with 7 digits on 32-bit data: no bit can be removed then, and the data is left
+unchanged (netCDF-C overflows its bit masks and overwrites the values).
+Masked and non-finite values are left unchanged.
+"""
+
+import math
+import numpy as np
+
+QUANTIZE_MODES = ("BitGroom", "BitRound", "GranularBitRound")
+# Names of the algorithms in the CF conventions (quantization variable)
+CF_ALGORITHMS = {
+    "BitGroom": "bitgroom",
+    "BitRound": "bitround",
+    "GranularBitRound": "granular_bitround",
+}
+
+# Explicit mantissa bits and unsigned integer types of the floating-point types
+_MANTISSA_BITS = {4: 23, 8: 52}
+# Maximum significant decimal digits of the floating-point types (as netCDF-C)
+_MAX_DIGITS = {4: 7, 8: 15}
+_UINT_TYPES = {4: np.uint32, 8: np.uint64}
+_BITS_PER_DIGIT = math.log2(10)
+_DIGITS_PER_BIT = math.log10(2)
+
+
+def get_max_precision(dtype, mode: str) -> int:
+    """
+    Get the maximum precision that the quantize 'mode' can keep for floating-point
+    data of type 'dtype': significant bits for 'BitRound', digits otherwise.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    return _MANTISSA_BITS[itemsize] if mode == "BitRound" else _MAX_DIGITS[itemsize]
+
+
+def _masks(zero_bits, utype):
+    """Get the masks to shave, set and round the lowest 'zero_bits' bits"""
+    shave = np.left_shift(
+        utype(np.iinfo(utype).max), np.asarray(zero_bits, dtype=utype)
+    )
+    setbits = ~shave
+    half = setbits & (shave >> utype(1))
+    return shave, setbits, half
+
+
+def _bitgroom(bits, valid, nsd, itemsize):
+    required = math.ceil(nsd * _BITS_PER_DIGIT) + 1
+    zero_bits = _MANTISSA_BITS[itemsize] - required
+    if zero_bits <= 0:
+        return
+    utype = _UINT_TYPES[itemsize]
+    shave, setbits, _ = _masks(zero_bits, utype)
+    parity = np.arange(bits.size) % 2 == 0
+    bits[valid & parity] &= shave
+    bits[valid & ~parity & (bits != 0)] |= setbits
+
+
+def _bitround(bits, valid, nsb, itemsize):
+    zero_bits = _MANTISSA_BITS[itemsize] - nsb
+    if zero_bits <= 0:
+        return
+    utype = _UINT_TYPES[itemsize]
+    shave, _, half = _masks(zero_bits, utype)
+    bits[valid] = (bits[valid] + half) & shave
+
+
+def _granular_bitround(values, bits, valid, nsd, itemsize):
+    valid &= values != 0
+    mantissa, exponent = np.frexp(values[valid].astype(np.float64))
+    mantissa_log10 = np.log10(np.abs(mantissa))
+    digits = np.floor(exponent * _DIGITS_PER_BIT + mantissa_log10) + 1
+    power = np.floor(_BITS_PER_DIGIT * (digits - nsd))
+    required = np.abs(np.floor(exponent - _BITS_PER_DIGIT * mantissa_log10) - power) - 1
+    zero_bits = _MANTISSA_BITS[itemsize] - required.astype(np.int64)
+    # Values that need all their bits are left unchanged
+    zero_bits = np.clip(zero_bits, 0, _MANTISSA_BITS[itemsize])
+    utype = _UINT_TYPES[itemsize]
+    shave, _, half = _masks(zero_bits, utype)
+    bits[valid] = (bits[valid] + half) & shave
+
+
+def quantize(data, nsd: int, mode: str = "BitGroom"):
+    """
+    Quantize the floating-point 'data' (numpy or masked array) in place, keeping
+    'nsd' significant digits ('BitGroom' and 'GranularBitRound' modes) or bits
+    ('BitRound' mode). Other data types are left unchanged.
+    Raise a ValueError if 'nsd' is above the maximum precision of the data type.
+    Return the data.
+    """
+    values = np.ma.getdata(data)
+    if values.dtype.kind != "f" or values.dtype.itemsize not in _MANTISSA_BITS:
+        return data
+    if not 1 <= nsd <= get_max_precision(values.dtype, mode):
+        raise ValueError(
+            f"Invalid precision {nsd} for the '{mode}' quantization "
+            f"of {values.dtype} data."
+        )
+    itemsize = values.dtype.itemsize
+    # Work on the bits of the values, in native byte order
+    native = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("=")).reshape(
+        -1
+    )
+    bits = native.view(_UINT_TYPES[itemsize])
+    valid = np.isfinite(native) & ~np.ma.getmaskarray(data).reshape(-1)
+    if mode == "BitGroom":
+        _bitgroom(bits, valid, nsd, itemsize)
+    elif mode == "BitRound":
+        _bitround(bits, valid, nsd, itemsize)
+    elif mode == "GranularBitRound":
+        _granular_bitround(native, bits, valid, nsd, itemsize)
+    else:
+        raise ValueError(f"Unknown quantize mode '{mode}'.")
+    if not np.shares_memory(native, values):
+        values[...] = native.reshape(values.shape)
+    return data
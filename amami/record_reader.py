@@ -0,0 +1,186 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to read and decode the data records of UM files on multiple threads.
+
+mule reads and unpacks the fields one at a time, through a file object shared by
+all the fields, so its reads cannot run concurrently.
+Here the records of well-formed files (fields with their position in the lookup)
+are read independently with positional reads, and unpacked (WGDOS) or decoded
+(32 and 64-bit IEEE) in a thread pool.
+The records are read in file order, and records close to each other are read
+together in large reads (see `plan_reads`), which are announced to the kernel
+in advance. Each read buffer is then split into its records without copying.
+Records with other packings are read by mule, one at a time.
+The IEEE records can be kept in the big-endian byte order of the UM file, so that
+they are not byte-swapped when their compressed chunks are written directly to
+big-endian netCDF4 variables (see `DirectChunkWriter`).
+"""
+
+import collections
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Sequence
+import numpy as np
+
+try:
+    from mule.packing import wgdos_unpack
+except ImportError:
+    wgdos_unpack = None
+
+# Size (bytes) of a word of the UM file
+WORD_SIZE = 8
+# Maximum size (bytes) of a single read
+MAX_READ_SIZE = 64 * 1024**2
+# Maximum gap (bytes) between two records read together
+MAX_READ_GAP = 1024**2
+
+
+def _decode_record(field, raw):
+    """Decode the raw bytes of a record into a 2D array"""
+    if field.lbpack == 1:
+        # The unpacker may not accept buffers other than bytes
+        data = wgdos_unpack(raw if isinstance(raw, bytes) else bytes(raw), field.bmdi)
+    else:
+        if field.lbpack == 2:
+            dtype = ">f4"
+        else:
+            # Reals, integers and logicals are stored as 64-bit words
+            dtype = ">f8" if field.lbuser1 == 1 else ">i8"
+        data = np.frombuffer(raw, dtype=dtype, count=field.lbrow * field.lbnpt)
+    return np.reshape(data, (field.lbrow, field.lbnpt))
+
+
+def plan_reads(extents, max_size=MAX_READ_SIZE, max_gap=MAX_READ_GAP) -> list:
+    """
+    Plan the reads of a set of records, given their (index, start, stop) byte
+    extents in the file.
+    The records are sorted by offset, and records separated by at most 'max_gap'
+    bytes are merged into reads of up to 'max_size' bytes (larger records are
+    read on their own).
+    Return a list of reads as [start, stop, extents of the records].
+    """
+    reads = []
+    for index, start, stop in sorted(extents, key=lambda extent: extent[1]):
+        if (
+            reads
+            and start - reads[-1][1] <= max_gap
+            and stop - reads[-1][0] <= max_size
+        ):
+            reads[-1][1] = max(reads[-1][1], stop)
+            reads[-1][2].append((index, start, stop))
+        else:
+            reads.append([start, stop, [(index, start, stop)]])
+    return reads
+
+
+def _advise(fd, reads) -> None:
+    """Tell the kernel which parts of the file are going to be read"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for start, stop, _ in reads:
+            os.posix_fadvise(fd, start, stop - start, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        # Hints are optional (e.g. not supported by the file system)
+        pass
+
+
+def _read_extent(fd, start, stop) -> memoryview:
+    """Read the bytes between 'start' and 'stop' (zeros beyond the end of the file)"""
+    buffer = memoryview(bytearray(stop - start))
+    nread = 0
+    while nread < len(buffer):
+        if hasattr(os, "preadv"):
+            count = os.preadv(fd, [buffer[nread:]], start + nread)
+        else:
+            chunk = os.pread(fd, len(buffer) - nread, start + nread)
+            count = len(chunk)
+            buffer[nread : nread + count] = chunk
+        if count == 0:
+            break
+        nread += count
+    return buffer
+
+
+class RecordReader:
+    """
+    Read and decode the data of mule fields from the UM file 'path'
+    on 'nthreads' threads.
+    The data is meant to be stored in arrays with the given 'byteorder'
+    ('=' for native, '>' to keep the byte order of the UM file).
+    """
+
+    def __init__(self, path: str, nthreads: int, byteorder: str = "="):
+        self.path = path
+        self.nthreads = nthreads
+        self.byteorder = byteorder
+        # Serialises the reads through mule
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_direct(field) -> bool:
+        """Check whether a field record can be read and decoded without mule"""
+        packings = (0, 2) if wgdos_unpack is None else (0, 1, 2)
+        return field.lbpack in packings and field.lbegin > 0 and field.lbnrec > 0
+
+    def _read_with_mule(self, field):
+        with self._lock:
+            return field.get_data()
+
+    def read(self, fields: Sequence, store: Callable) -> None:
+        """
+        Read and decode the data of the 'fields', calling 'store(i, data)' with the
+        data of the i-th field as soon as it is decoded (from the reading threads).
+        """
+        extents = [
+            (i, field.lbegin * WORD_SIZE, (field.lbegin + field.lbnrec) * WORD_SIZE)
+            for i, field in enumerate(fields)
+            if self.is_direct(field)
+        ]
+        reads = plan_reads(extents)
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            _advise(fd, reads)
+            with ThreadPoolExecutor(self.nthreads) as pool:
+                direct = {i for i, _, _ in extents}
+                futures = [
+                    pool.submit(
+                        lambda i, field: store(i, self._read_with_mule(field)),
+                        i,
+                        field,
+                    )
+                    for i, field in enumerate(fields)
+                    if i not in direct
+                ]
+                # Keep at most 'nthreads' reads in flight, in file order,
+                # and decode the records of each read as soon as it completes
+                pending = collections.deque()
+                reads = iter(reads)
+
+                def submit_read():
+                    read = next(reads, None)
+                    if read is not None:
+                        pending.append((pool.submit(_read_extent, fd, *read[:2]), read))
+
+                for _ in range(self.nthreads):
+                    submit_read()
+                while pending:
+                    future, (start, _, records) = pending.popleft()
+                    buffer = future.result()
+                    submit_read()
+                    futures += [
+                        pool.submit(
+                            lambda i, raw: store(i, _decode_record(fields[i], raw)),
+                            i,
+                            buffer[rstart - start : rstop - start],
+                        )
+                        for i, rstart, rstop in records
+                    ]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
@@ -0,0 +1,162 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to read UM files from, and write netCDF files to, object storage and other
+remote file systems, given as fsspec URLs (e.g. 's3://bucket/path/aiihca.pa0001').
+
+mule needs a local seekable file, so a remote UM file is copied into a sparse
+local file. Only its headers and lookup table are downloaded in full.
+The data records of the selected fields are then downloaded with concurrent ranged
+reads driven by the lookup offsets (records close to each other are merged into
+a single read, see `plan_reads`), and written at the same offsets in the local file.
+The records that are not needed are never downloaded.
+Local files are uploaded in large parts (multipart uploads on S3), so that the
+remote file only appears when the upload is complete.
+
+This requires the optional 'fsspec' package, and the package implementing the
+remote file system (e.g. 's3fs' for S3).
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+import numpy as np
+from amami.exceptions import AmamiError, UMError
+from amami.loggers import LOGGER
+from amami.record_reader import WORD_SIZE, plan_reads
+from amami.um_utils import (
+    DATA_START,
+    FIXED_HEADER_LENGTH,
+    LOOKUP_DIM1,
+    LOOKUP_DIM2,
+    LOOKUP_DTYPE,
+    LOOKUP_START,
+)
+
+try:
+    import fsspec
+except ImportError:
+    fsspec = None
+
+# Number of ranged reads run concurrently
+MAX_REQUESTS = 8
+# Size (bytes) of the parts of the uploads
+UPLOAD_PART_SIZE = 64 * 1024**2
+
+
+def is_url(path: str) -> bool:
+    """Check whether a path is a URL (with a protocol, e.g. 's3://')"""
+    return re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*://", path) is not None
+
+
+def _get_fs(url: str):
+    """Get the fsspec file system of a URL and the path within it"""
+    if fsspec is None:
+        raise AmamiError(
+            f"The 'fsspec' package is needed to access '{url}'. "
+            "Install 'fsspec' and the package of the file system (e.g. 's3fs')."
+        )
+    return fsspec.core.url_to_fs(url)
+
+
+def _read_lookup(fs, path: str, url: str, fout):
+    """
+    Download the headers and lookup table of the UM file, write them to 'fout'
+    and return the lookup table (as a big-endian structured array).
+    """
+    # The byte range is given by keywords, as some file systems take other
+    # positional arguments (e.g. the object version on S3)
+    header = fs.cat_file(path, start=0, end=FIXED_HEADER_LENGTH * WORD_SIZE)
+    fixed = np.frombuffer(header, dtype=">i8", count=FIXED_HEADER_LENGTH)
+    start, dim1, dim2, data_start = (
+        int(fixed[i]) for i in (LOOKUP_START, LOOKUP_DIM1, LOOKUP_DIM2, DATA_START)
+    )
+    if start <= 0 or dim1 != len(LOOKUP_DTYPE.names):
+        raise UMError(f"'{url}' does not appear to be a UM file.")
+    lookup_offset = (start - 1) * WORD_SIZE
+    lookup_end = lookup_offset + dim1 * dim2 * WORD_SIZE
+    # All the headers come before the data
+    header_end = max(lookup_end, (data_start - 1) * WORD_SIZE)
+    header += fs.cat_file(path, start=len(header), end=header_end)
+    fout.write(header)
+    return np.frombuffer(
+        header,
+        dtype=LOOKUP_DTYPE.newbyteorder(">"),
+        count=dim2,
+        offset=lookup_offset,
+    )
+
+
+def fetch_fieldsfile(
+    url: str,
+    select: Optional[Callable[[int], bool]] = None,
+    directory: str = None,
+    max_requests: int = MAX_REQUESTS,
+) -> str:
+    """
+    Copy the remote UM file 'url' into a sparse temporary file in 'directory'
+    (the system temporary directory if None), downloading only the headers and
+    the data records of the fields whose STASH code satisfies 'select'
+    (all the fields if None), with up to 'max_requests' concurrent ranged reads.
+    Return the path of the temporary file, which must be removed by the caller.
+    """
+    fs, path = _get_fs(url)
+    fd, spool = tempfile.mkstemp(prefix="um_", suffix=".spool", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            lookup = _read_lookup(fs, path, url, fout)
+            lookup = lookup[lookup["lbrel"] != -99]
+            if select is not None:
+                lookup = lookup[[select(int(stash)) for stash in lookup["lbuser4"]]]
+            if np.any(lookup["lbegin"] <= 0):
+                # Records positions are not in the lookup, download the whole file
+                LOGGER.debug(f"Downloading the whole UM file '{url}'.")
+                fout.seek(0)
+                with fs.open(path, "rb") as fin:
+                    shutil.copyfileobj(fin, fout, UPLOAD_PART_SIZE)
+                return spool
+            lengths = np.where(lookup["lbnrec"] > 0, lookup["lbnrec"], lookup["lblrec"])
+            # Only adjacent records are merged, so that no other bytes are downloaded
+            reads = plan_reads(
+                (
+                    (i, int(start) * WORD_SIZE, int(start + length) * WORD_SIZE)
+                    for i, (start, length) in enumerate(zip(lookup["lbegin"], lengths))
+                ),
+                max_gap=0,
+            )
+            LOGGER.debug(
+                f"Downloading {len(lookup)} records of '{url}' "
+                f"with {len(reads)} ranged reads."
+            )
+            # Sparse file with the size of the remote file
+            fout.truncate(fs.size(path))
+            with ThreadPoolExecutor(max_requests) as pool:
+                for (start, _, _), data in zip(
+                    reads,
+                    pool.map(
+                        lambda read: fs.cat_file(path, start=read[0], end=read[1]),
+                        reads,
+                    ),
+                ):
+                    os.pwrite(fout.fileno(), data, start)
+    except FileNotFoundError as err:
+        os.remove(spool)
+        raise UMError(f"Unable to read '{url}': {err}")
+    except BaseException:
+        os.remove(spool)
+        raise
+    return spool
+
+
+def upload_file(path: str, url: str, part_size: int = UPLOAD_PART_SIZE) -> None:
+    """
+    Upload the local file 'path' to 'url', in parts of 'part_size' bytes.
+    On object storage, the remote file only appears once all the parts are uploaded.
+    """
+    fs, target = _get_fs(url)
+    with open(path, "rb") as fin, fs.open(target, "wb", block_size=part_size) as fout:
+        shutil.copyfileobj(fin, fout, part_size)
@@ -0,0 +1,139 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to hand arrays over to other processes through shared memory.
+
+An array is copied once into a shared memory block, and only a small descriptor
+(block name, shape, dtype and offsets) is sent to the other process, which maps
+the block and uses the array in place, with no pickling of the data.
+The blocks are recycled from a pool, so that creating and mapping new shared
+memory is only needed when no free block is large enough.
+"""
+
+import threading
+from multiprocessing import shared_memory
+from typing import NamedTuple, Optional, Tuple
+import numpy as np
+from amami.loggers import LOGGER
+
+# Alignment (bytes) of the arrays within a block
+_ALIGN = 64
+
+
+class SharedArray(NamedTuple):
+    """Descriptor of an array (and its mask, if any) stored in a shared memory block"""
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+    offset: int = 0
+    mask_offset: Optional[int] = None
+
+
+def _aligned(nbytes: int) -> int:
+    return -(-nbytes // _ALIGN) * _ALIGN
+
+
+class SharedArrayPool:
+    """
+    Pool of at most 'max_blocks' shared memory blocks holding arrays.
+    When all the blocks are in use, `put` waits until one of them is released.
+    Use as a context manager, to free all the blocks at the end.
+    """
+
+    def __init__(self, max_blocks: int):
+        self.max_blocks = max(max_blocks, 1)
+        self._blocks = {}
+        self._free = set()
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _acquire(self, nbytes: int):
+        """Get a free block of at least 'nbytes' bytes (called with the lock held)"""
+        while True:
+            fitting = [n for n in self._free if self._blocks[n].size >= nbytes]
+            if fitting:
+                name = min(fitting, key=lambda n: self._blocks[n].size)
+                self._free.remove(name)
+                return self._blocks[name]
+            if self._free and len(self._blocks) >= self.max_blocks:
+                # Replace the largest free block with a larger one
+                name = max(self._free, key=lambda n: self._blocks[n].size)
+                self._free.remove(name)
+                self._unlink(name)
+            if len(self._blocks) < self.max_blocks:
+                block = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+                self._blocks[block.name] = block
+                LOGGER.debug(
+                    f"Shared memory block '{block.name}' of {block.size} bytes created."
+                )
+                return block
+            self._condition.wait()
+
+    def _unlink(self, name: str) -> None:
+        block = self._blocks.pop(name)
+        block.close()
+        block.unlink()
+
+    def put(self, array) -> SharedArray:
+        """Copy a (numpy or masked) array into a free block and return its descriptor"""
+        data = np.ma.getdata(array)
+        mask = np.ma.getmask(array)
+        nbytes = _aligned(data.nbytes)
+        mask_offset = None
+        if mask is not np.ma.nomask:
+            mask_offset = nbytes
+            nbytes += mask.nbytes
+        with self._condition:
+            block = self._acquire(nbytes)
+        descriptor = SharedArray(block.name, data.shape, data.dtype.str, 0, mask_offset)
+        _, shared = attach(descriptor, block)
+        np.copyto(np.ma.getdata(shared), data)
+        if mask_offset is not None:
+            np.copyto(shared.mask, mask)
+        return descriptor
+
+    def release(self, descriptor: SharedArray) -> None:
+        """Return the block of an array to the pool"""
+        with self._condition:
+            if descriptor.name in self._blocks:
+                self._free.add(descriptor.name)
+            self._condition.notify()
+
+    def close(self) -> None:
+        """Free all the blocks"""
+        with self._condition:
+            for name in list(self._blocks):
+                self._unlink(name)
+            self._free.clear()
+
+
+def attach(descriptor: SharedArray, block=None) -> tuple:
+    """
+    Map the array described by 'descriptor' (without copying it).
+    Return the shared memory block and the array, which must be deleted before
+    the block is closed.
+    """
+    if block is None:
+        block = shared_memory.SharedMemory(name=descriptor.name)
+    data = np.ndarray(
+        descriptor.shape,
+        dtype=np.dtype(descriptor.dtype),
+        buffer=block.buf,
+        offset=descriptor.offset,
+    )
+    if descriptor.mask_offset is None:
+        return block, data
+    mask = np.ndarray(
+        descriptor.shape,
+        dtype=np.bool_,
+        buffer=block.buf,
+        offset=descriptor.mask_offset,
+    )
+    return block, np.ma.masked_array(data, mask=mask, copy=False)
@@ -0,0 +1,204 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to set how each field is stored in the netCDF file (storage policy).
+
+A storage policy is a JSON file mapping STASH items to storage settings, e.g.:
+
+    {
+        "default": {"codec": "zlib", "level": 4},
+        "30201-30288": {"significant_digits": 3, "chunks": [1, 1, 145, 192]},
+        "m01s00i030": {"dtype": "int8"},
+        "ts": {"level": 9, "significant_digits": null}
+    }
+
+The STASH items are given as item codes ('30'), ranges of item codes ('30201-30288'),
+STASH codes ('m01s00i030') or variable names from the STASH list ('ts').
+The settings are:
+-   'codec': compression of the data, 'zlib' or 'none';
+-   'level': compression level (0-9);
+-   'significant_digits' and 'quantize_mode': quantization of the data
+    (see `amami.quantize`), null for full precision;
+-   'pack': packing of the floating-point data, 'int16', 'int8' or null
+    (see `amami.packing`);
+-   'dtype': type the data is converted to ('int8', 'int16', 'int32', 'float32'
+    or 'float64'), null to keep the type of the field. Floating-point data converted
+    to integers is rounded, and the values that do not fit are set as missing;
+-   'chunks': chunk shape of the variable (netCDF4 only), one size per dimension
+    in the order of the netCDF variable, null for the default chunks.
+The settings of a field are those of the command line options, updated with the
+'default' settings, then with those of the ranges including the field (in the
+order of the file), then with those of the field itself.
+"""
+
+import json
+from typing import NamedTuple, Optional, Tuple
+import numpy as np
+import dask.array as da
+from amami._atm_stashlist import ATM_STASHLIST
+from amami.exceptions import AmamiError
+from amami.packing import PACK_TYPES, get_packed_range
+from amami.quantize import QUANTIZE_MODES
+from amami.um_utils import Stash
+
+CODECS = ("zlib", "none")
+DTYPES = ("int8", "int16", "int32", "float32", "float64")
+
+
+class FieldStorage(NamedTuple):
+    """Storage settings of a field"""
+
+    codec: str = "zlib"
+    level: int = 4
+    significant_digits: Optional[int] = None
+    quantize_mode: str = "BitGroom"
+    pack: Optional[str] = None
+    dtype: Optional[str] = None
+    chunks: Optional[Tuple[int, ...]] = None
+
+    @property
+    def quantize_digits(self) -> Optional[int]:
+        """
+        Significant digits to quantize the data to (None for full precision).
+        Packed data and data converted to integers are not quantized.
+        """
+        if self.pack is not None or (
+            self.dtype is not None and self.dtype.startswith("int")
+        ):
+            return None
+        return self.significant_digits
+
+    def get_chunksizes(self, shape) -> Optional[Tuple[int, ...]]:
+        """Get the chunk sizes of a variable of the given shape (None for default)"""
+        if self.chunks is None or len(self.chunks) != len(shape):
+            return None
+        return tuple(
+            max(1, min(chunk, size)) for chunk, size in zip(self.chunks, shape)
+        )
+
+
+def _check_settings(key: str, settings) -> dict:
+    """Check the storage settings of the STASH item 'key' of a policy"""
+
+    def check(name, valid):
+        if name in settings and not valid(settings[name]):
+            raise AmamiError(
+                f"Invalid '{name}' for '{key}' in storage policy: {settings[name]!r}."
+            )
+
+    if not isinstance(settings, dict):
+        raise AmamiError(
+            f"The settings of '{key}' in storage policy must be an object."
+        )
+    unknown = set(settings) - set(FieldStorage._fields)
+    if unknown:
+        raise AmamiError(
+            f"Unknown settings for '{key}' in storage policy: "
+            f"{', '.join(sorted(unknown))}."
+        )
+    check("codec", lambda value: value in CODECS)
+    check("level", lambda value: isinstance(value, int) and 0 <= value <= 9)
+    check(
+        "significant_digits",
+        lambda value: value is None or (isinstance(value, int) and value >= 1),
+    )
+    check("quantize_mode", lambda value: value in QUANTIZE_MODES)
+    check("pack", lambda value: value is None or value in PACK_TYPES)
+    check("dtype", lambda value: value is None or value in DTYPES)
+    check(
+        "chunks",
+        lambda value: value is None
+        or (
+            isinstance(value, list)
+            and all(isinstance(size, int) and size > 0 for size in value)
+        ),
+    )
+    if settings.get("chunks") is not None:
+        settings = {**settings, "chunks": tuple(settings["chunks"])}
+    return settings
+
+
+def _get_itemcodes(key: str) -> list:
+    """Get the item codes of the STASH item 'key' of a policy"""
+    if key.isdigit():
+        return [int(key)]
+    if key.startswith("m") and len(key) == 10:
+        try:
+            return [Stash(key).itemcode]
+        except ValueError:
+            pass
+    itemcodes = [
+        itemcode for itemcode, var in ATM_STASHLIST.items() if key in (var[1], var[4])
+    ]
+    if not itemcodes:
+        raise AmamiError(f"Unknown STASH item '{key}' in storage policy.")
+    return itemcodes
+
+
+class StoragePolicy:
+    """
+    Storage settings of the fields, by STASH item code.
+    'default' are the settings of the fields not in the policy.
+    """
+
+    def __init__(self, default: FieldStorage, ranges: list = None, items: dict = None):
+        self.default = default
+        # Settings of ranges of item codes, as (first, last, settings)
+        self.ranges = ranges if ranges is not None else []
+        # Settings by item code
+        self.items = items if items is not None else {}
+
+    @classmethod
+    def load(cls, path: str, default: FieldStorage):
+        """
+        Load the storage policy in the JSON file 'path', whose settings
+        update the 'default' ones.
+        """
+        try:
+            with open(path, encoding="utf-8") as fpolicy:
+                content = json.load(fpolicy)
+        except (OSError, ValueError) as err:
+            raise AmamiError(f"Unable to read storage policy '{path}': {err}")
+        if not isinstance(content, dict):
+            raise AmamiError(f"Storage policy '{path}' must be a JSON object.")
+        ranges = []
+        items = {}
+        for key, settings in content.items():
+            settings = _check_settings(key, settings)
+            if key == "default":
+                default = default._replace(**settings)
+            elif "-" in key:
+                first, _, last = key.partition("-")
+                if not (first.isdigit() and last.isdigit()):
+                    raise AmamiError(f"Invalid range '{key}' in storage policy.")
+                ranges.append((int(first), int(last), settings))
+            else:
+                for itemcode in _get_itemcodes(key):
+                    items.setdefault(itemcode, {}).update(settings)
+        return cls(default, ranges, items)
+
+    def get(self, itemcode: int) -> FieldStorage:
+        """Get the storage settings of the field with the given item code"""
+        storage = self.default
+        for first, last, settings in self.ranges:
+            if first <= itemcode <= last:
+                storage = storage._replace(**settings)
+        return storage._replace(**self.items.get(itemcode, {}))
+
+
+def convert_data(data, dtype):
+    """
+    Convert 'data' (numpy, masked or dask array) to 'dtype'.
+    Floating-point data converted to integers is rounded, and the values that
+    are not finite or do not fit in the integer type (above its netCDF fill value)
+    are masked.
+    """
+    dtype = np.dtype(dtype)
+    if data.dtype == dtype:
+        return data
+    if dtype.kind == "i" and data.dtype.kind == "f":
+        ma = da.ma if isinstance(data, da.Array) else np.ma
+        data = ma.masked_invalid(np.around(data))
+        data = ma.masked_outside(data, *get_packed_range(dtype))
+    return data.astype(dtype)
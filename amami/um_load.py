@@ -0,0 +1,665 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Module to load UM fieldsfiles into iris cubes.
+
+Three loading engines are available:
+-   'iris': the generic iris loading, which converts every field to a 2D cube
+    and merges them with the iris merge logic;
+-   'amami': a header-driven merge engine, which groups the fields using the
+    lookup table, builds the time, pseudo-level and level axes as arrays and
+    assembles the lazy cubes directly;
+-   'structured': the iris structured UM loading
+    (`iris.fileformats.um.structured_um_loading`), only used for files whose
+    fields are regularly ordered (see `is_structured`).
+"""
+
+import threading
+import time
+import numpy as np
+import dask.array as da
+import iris
+import iris.coords
+import iris.cube
+import iris.exceptions
+import iris.fileformats.pp
+import iris.fileformats.pp_load_rules as pp_rules
+import iris.fileformats.rules
+import iris.fileformats.um
+import amami.um_utils as umutils
+from amami.record_reader import RecordReader
+from amami.exceptions import UMError
+from amami.loggers import LOGGER
+
+# Lookup words that identify a single variable.
+# Fields with the same values of these words are merged into the same cube.
+MERGE_KEYS = (
+    "lbuser4",
+    "lbuser7",
+    "lbuser1",
+    "lbproc",
+    "lbtim",
+    "lbcode",
+    "lbhem",
+    "lbvc",
+    "lbfc",
+    "lbsrce",
+    "lbrsvd4",
+    "lbrow",
+    "lbnpt",
+    "bplat",
+    "bplon",
+    "bzy",
+    "bdy",
+    "bzx",
+    "bdx",
+)
+# Lookup words that define the time, pseudo-level and level of a field
+TIME_KEYS = ("time", "data_time", "lbft")
+PSEUDO_LEVEL_KEYS = ("lbuser5",)
+LEVEL_KEYS = ("lblev", "blev", "brlev", "bhlev", "bhrlev", "bulev", "bhulev")
+# Lookup words that identify a phenomenon in the iris structured UM loading
+STRUCTURED_KEYS = ("lbuser4", "lbuser7", "lbproc", "lbuser5")
+# Preferred dimension coordinates for the merged axes
+DIM_COORD_NAMES = ("time", "pseudo_level", "model_level_number", "pressure")
+# The cached converter reuses the building blocks of the iris PP load rules
+# (`iris.fileformats.pp_load_rules.convert`). If they are not available in the
+# installed iris version, the plain iris PP load rules are used.
+_CACHEABLE_RULES = all(
+    hasattr(pp_rules, name)
+    for name in (
+        "_convert_time_coords",
+        "_convert_vertical_coords",
+        "_convert_scalar_realization_coords",
+        "_convert_scalar_pseudo_level_coords",
+        "_all_other_rules",
+    )
+)
+
+
+class CachedConverter:
+    """
+    Drop-in replacement for the iris PP load rules
+    (`iris.fileformats.pp_load_rules.convert`) that caches the translation of the
+    field headers into cube metadata.
+
+    The rules are split as in iris into time, vertical and all other rules,
+    and each part is cached on the lookup words it depends on.
+    Thousands of fields sharing the same variable, grid and processing then run
+    the (expensive) name, units, cell methods and horizontal coordinates rules
+    only once, and the time and vertical rules once per unique time and level.
+    Cached coordinates are shared by the 2D field cubes. This is safe because these
+    cubes are only an input to the merge step, which builds new coordinates for the
+    merged cubes in both engines.
+    """
+
+    def __init__(self):
+        self._time_coords = {}
+        self._vertical_coords = {}
+        self._other_rules = {}
+        self.nfields = 0
+        self.nrules = 0
+        self.elapsed = 0.0
+
+    def __call__(self, field):
+        start = time.perf_counter()
+        self.nfields += 1
+        if _CACHEABLE_RULES:
+            metadata = self._convert(field)
+        else:
+            self.nrules += 1
+            metadata = pp_rules.convert(field)
+        self.elapsed += time.perf_counter() - start
+        return metadata
+
+    def _cached(self, cache, key, rules):
+        """Get the result of 'rules' from 'cache', running them if 'key' is missing"""
+        try:
+            return cache[key]
+        except KeyError:
+            self.nrules += 1
+            cache[key] = result = rules()
+            return result
+
+    def _convert(self, f):
+        """Same as `iris.fileformats.pp_load_rules.convert`, with cached rules"""
+        lbcode, lbtim, lbproc = int(f.lbcode), int(f.lbtim), int(f.lbproc)
+        time_coords = self._cached(
+            self._time_coords,
+            (lbcode, lbtim, f.t1, f.t2, f.lbft),
+            lambda: pp_rules._convert_time_coords(
+                lbcode=f.lbcode,
+                lbtim=f.lbtim,
+                epoch_hours_unit=f.time_unit("hours"),
+                t1=f.t1,
+                t2=f.t2,
+                lbft=f.lbft,
+            ),
+        )
+        vertical_coords, factories = self._cached(
+            self._vertical_coords,
+            (
+                lbcode,
+                f.lbvc,
+                f.blev,
+                f.lblev,
+                f.stash,
+                f.bhlev,
+                f.bhrlev,
+                f.brsvd[0],
+                f.brsvd[1],
+                f.brlev,
+            ),
+            lambda: pp_rules._convert_vertical_coords(
+                lbcode=f.lbcode,
+                lbvc=f.lbvc,
+                blev=f.blev,
+                lblev=f.lblev,
+                stash=f.stash,
+                bhlev=f.bhlev,
+                bhrlev=f.bhrlev,
+                brsvd1=f.brsvd[0],
+                brsvd2=f.brsvd[1],
+                brlev=f.brlev,
+            ),
+        )
+        if (
+            f.lbtim.ib == 3
+            or f.lbyr == 0
+            or len(f.lbcode) == 5
+            or getattr(f, "x", None) is not None
+            or getattr(f, "y", None) is not None
+        ):
+            # Climatological and cross-section fields have rules depending on time,
+            # and fields with explicit grid vectors cannot be identified by the header
+            self.nrules += 1
+            other_rules = pp_rules._all_other_rules(f)
+        else:
+            other_rules = self._cached(
+                self._other_rules,
+                (
+                    lbcode,
+                    lbtim,
+                    lbproc,
+                    f.lbhem,
+                    f.lbrow,
+                    f.lbnpt,
+                    f.lbfc,
+                    f.lbsrce,
+                    f.lbuser[0],
+                    f.lbuser[3],
+                    f.lbuser[6],
+                    f.bplat,
+                    f.bplon,
+                    f.bzy,
+                    f.bdy,
+                    f.bzx,
+                    f.bdx,
+                    f.bmdi,
+                ),
+                lambda: pp_rules._all_other_rules(f),
+            )
+        (
+            references,
+            standard_name,
+            long_name,
+            units,
+            attributes,
+            cell_methods,
+            dim_coords_and_dims,
+            other_aux_coords_and_dims,
+        ) = other_rules
+        aux_coords_and_dims = (
+            time_coords
+            + vertical_coords
+            + pp_rules._convert_scalar_realization_coords(lbrsvd4=f.lbrsvd[3])
+            + pp_rules._convert_scalar_pseudo_level_coords(lbuser5=f.lbuser[4])
+            + other_aux_coords_and_dims
+        )
+        return iris.fileformats.rules.ConversionMetadata(
+            list(factories),
+            list(references),
+            standard_name,
+            long_name,
+            units,
+            dict(attributes),
+            list(cell_methods),
+            list(dim_coords_and_dims),
+            aux_coords_and_dims,
+        )
+
+    def report(self):
+        """Log the time spent translating field headers with the PP load rules"""
+        LOGGER.debug(
+            f"PP load rules: {self.nfields} fields translated in {self.elapsed:.3f} s, "
+            f"running {self.nrules} rules ({len(self._other_rules)} unique signatures)."
+        )
+
+
+class _RecordArray:
+    """
+    Array-like object that lazily reads a set of UM field records
+    arranged on a grid of leading dimensions.
+    Missing records (-1 in the grid) are returned as masked.
+    If a 'reader' (RecordReader) is given, the records are read and decoded
+    concurrently by the reader, otherwise they are read one at a time by mule.
+    """
+
+    def __init__(self, fields, records, field_shape, dtype, mdi, reader=None):
+        self.fields = fields
+        self.records = records
+        self.shape = records.shape + tuple(field_shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.mdi = mdi
+        self.reader = reader
+
+    def __getitem__(self, keys):
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        nlead = self.records.ndim
+        records = self.records[keys[:nlead]]
+        field_keys = keys[nlead:]
+        field_shape = np.empty(self.shape[nlead:], dtype=bool)[field_keys].shape
+        values = np.zeros(records.shape + field_shape, dtype=self.dtype)
+        mask = np.ones(values.shape, dtype=bool)
+        present = [ind for ind in np.ndindex(records.shape) if records[ind] >= 0]
+
+        def store(i, field_data):
+            ind = present[i]
+            field_data = np.asarray(field_data, dtype=self.dtype)
+            field_data = field_data.reshape(self.shape[nlead:])[field_keys]
+            values[ind] = field_data
+            mask[ind] = field_data == self.mdi
+
+        fields = [self.fields[records[ind]] for ind in present]
+        if self.reader is None:
+            for i, field in enumerate(fields):
+                store(i, field.get_data())
+        else:
+            self.reader.read(fields, store)
+        return np.ma.masked_array(values, mask=mask)
+
+
+def _get_axis(lookup, indices, keys):
+    """
+    Get the position of each record along the axis defined by the lookup 'keys'.
+    Return the number of points in the axis and the index of each record.
+    """
+    group_lookup = lookup[indices]
+    columns = np.stack(
+        [umutils.get_lookup_key(group_lookup, k).astype(np.float64) for k in keys],
+        axis=1,
+    )
+    values, inverse = np.unique(columns, axis=0, return_inverse=True)
+    return len(values), inverse.ravel()
+
+
+def _get_representatives(records, axis):
+    """
+    Get one record for each point of the 'axis' of the records grid
+    (the first available one).
+    """
+    rows = np.moveaxis(records, axis, 0).reshape(records.shape[axis], -1)
+    return rows[np.arange(len(rows)), np.argmax(rows >= 0, axis=1)]
+
+
+def _get_dtype(lookup):
+    """Get the data type of the records in lookup"""
+    if np.all(lookup["lbuser1"] != 1):
+        return np.int64
+    # WGDOS and 32-bit packed data is unpacked as 32-bit floats, as done by iris
+    if np.all(np.isin(umutils.get_packing(lookup), (1, 2))):
+        return np.float32
+    return np.float64
+
+
+def _build_axis_coords(template, rep_cubes):
+    """
+    Build the coordinates that vary along a merged axis, from the template
+    scalar coordinates of the representative cubes for each point of the axis.
+    """
+    coords = []
+    for coord in template.coords(dimensions=()):
+        try:
+            rep_coords = [c.coord(coord.name()) for c in rep_cubes]
+        except iris.exceptions.CoordinateNotFoundError:
+            raise UMError(f"Coordinate '{coord.name()}' missing from some fields.")
+        points = np.concatenate([c.points for c in rep_coords])
+        if np.all(points == points[0]):
+            continue
+        bounds = (
+            np.concatenate([c.bounds for c in rep_coords])
+            if coord.has_bounds()
+            else None
+        )
+        try:
+            new_coord = coord.copy(points=points, bounds=bounds)
+        except ValueError:
+            # Not monotonic, cannot be a dimension coordinate
+            new_coord = iris.coords.AuxCoord.from_coord(coord).copy(
+                points=points, bounds=bounds
+            )
+        coords.append((coord, new_coord))
+    # Put the preferred dimension coordinate first
+    coords.sort(
+        key=lambda c: (
+            not isinstance(c[1], iris.coords.DimCoord),
+            DIM_COORD_NAMES.index(c[1].name())
+            if c[1].name() in DIM_COORD_NAMES
+            else len(DIM_COORD_NAMES),
+        )
+    )
+    return coords
+
+
+def _merge_group(template, records, rep_cubes, data):
+    """
+    Assemble the cube of a group of records from its template 2D cube,
+    the representative cubes for each merged axis and the lazy data.
+    """
+    nlead = records.ndim
+    cube = iris.cube.Cube(
+        data,
+        standard_name=template.standard_name,
+        long_name=template.long_name,
+        var_name=template.var_name,
+        units=template.units,
+        attributes=dict(template.attributes),
+        cell_methods=template.cell_methods,
+    )
+    # Map template coordinates to the new cube coordinates
+    new_coords = {}
+    varying = set()
+    for dim, reps in enumerate(rep_cubes):
+        for i, (coord, new_coord) in enumerate(_build_axis_coords(template, reps)):
+            if id(coord) in varying:
+                raise UMError(
+                    f"Coordinate '{coord.name()}' varies along more than one dimension."
+                )
+            varying.add(id(coord))
+            if i == 0 and isinstance(new_coord, iris.coords.DimCoord):
+                cube.add_dim_coord(new_coord, dim)
+            else:
+                cube.add_aux_coord(new_coord, dim)
+            new_coords[id(coord)] = new_coord
+    for coord in template.dim_coords:
+        new_coord = coord.copy()
+        cube.add_dim_coord(new_coord, template.coord_dims(coord)[0] + nlead)
+        new_coords[id(coord)] = new_coord
+    for coord in template.aux_coords:
+        if id(coord) in varying:
+            continue
+        new_coord = coord.copy()
+        cube.add_aux_coord(
+            new_coord,
+            tuple(d + nlead for d in template.coord_dims(coord)),
+        )
+        new_coords[id(coord)] = new_coord
+    # Rebuild the aux factories (e.g. hybrid height) on the new coordinates
+    for factory in template.aux_factories:
+        cube.add_aux_factory(
+            type(factory)(
+                **{
+                    name: dep if dep is None else new_coords[id(dep)]
+                    for name, dep in factory.dependencies.items()
+                }
+            )
+        )
+    return cube
+
+
+def merge_cubes(
+    um_file,
+    lookup,
+    converter=pp_rules.convert,
+    reader=None,
+) -> iris.cube.CubeList:
+    """
+    Load the fields of a mule UMFile into cubes, using the header-driven merge engine.
+
+    The fields are grouped by variable using the lookup table (see MERGE_KEYS) and
+    the time, pseudo-level and level axes of each group are built from the lookup.
+    The iris PP load rules (or the given 'converter') are only run on one field for
+    each point of each axis, while the data is assembled lazily for all the fields
+    of the group.
+    Duplicated fields are discarded, and missing fields are masked.
+    If a 'reader' (RecordReader) is given, the data of all the fields of a group
+    is read and decoded concurrently by the reader, in the byte order of the reader.
+    """
+    if um_file.fixed_length_header.dataset_type == 5:
+        raise UMError("UM lateral boundary condition files are not supported.")
+    if getattr(um_file, "row_dependent_constants", None) is not None:
+        raise UMError("UM files with variable resolution grids are not supported.")
+    if np.any(lookup["lbpack"] // 10 % 10 == 2):
+        raise UMError("UM files with land/sea packed fields are not supported.")
+    if np.any(np.isin(lookup["bdx"], (0, umutils.RMDI))):
+        raise UMError(
+            "UM files without grid definitions in the lookup are not supported."
+        )
+
+    groups = []
+    representatives = {}
+    # Without a reader, the records are read one at a time under a lock shared by
+    # all the fields of the file, as mule reads are not thread-safe
+    lock = threading.Lock() if reader is None else False
+    # Position of each record in the records grid of its group
+    record_position = np.full(len(lookup), -1)
+    for indices in umutils.group_lookup(lookup, MERGE_KEYS).values():
+        axes = [
+            _get_axis(lookup, indices, keys)
+            for keys in (TIME_KEYS, PSEUDO_LEVEL_KEYS, LEVEL_KEYS)
+        ]
+        # Axes with a single point are not merged (the coordinates stay scalar)
+        lead_shape = tuple(n for n, _ in axes if n > 1)
+        positions = tuple(inv for n, inv in axes if n > 1)
+        if lead_shape:
+            flat = np.ravel_multi_index(positions, lead_shape)
+        else:
+            flat = np.zeros(len(indices), dtype=int)
+        _, first = np.unique(flat, return_index=True)
+        if len(first) < len(indices):
+            LOGGER.warning(
+                f"{len(indices) - len(first)} duplicated fields for "
+                f"{umutils.Stash(int(lookup['lbuser4'][indices[0]]))}. "
+                "Only the first occurrence of each field will be converted."
+            )
+        records = np.full(np.prod(lead_shape, dtype=int), -1)
+        records[flat[first]] = indices[first]
+        record_position[indices[first]] = flat[first]
+        records = records.reshape(lead_shape)
+        if np.any(records < 0):
+            LOGGER.warning(
+                f"{np.count_nonzero(records < 0)} missing fields for "
+                f"{umutils.Stash(int(lookup['lbuser4'][indices[0]]))}. "
+                "The missing fields will be masked."
+            )
+        reps = [_get_representatives(records, dim) for dim in range(records.ndim)]
+        template = records.flat[np.argmax(records.ravel() >= 0)]
+        group_lookup = lookup[indices]
+        dtype = np.dtype(_get_dtype(group_lookup))
+        if reader is not None:
+            dtype = dtype.newbyteorder(reader.byteorder)
+        data = da.from_array(
+            _RecordArray(
+                um_file.fields,
+                records,
+                (group_lookup["lbrow"][0], group_lookup["lbnpt"][0]),
+                dtype,
+                group_lookup["bmdi"][0],
+                reader,
+            ),
+            # Without a reader, each record is read on its own
+            chunks=-1 if reader else (1,) * records.ndim + (-1, -1),
+            name=False,
+            asarray=False,
+            lock=lock,
+            meta=np.ma.masked_array(np.empty((0,) * (records.ndim + 2), dtype=dtype)),
+        )
+        for rec in np.concatenate([[template], *reps]):
+            representatives.setdefault(
+                rec, data[np.unravel_index(record_position[rec], records.shape)]
+            )
+        groups.append((template, records, reps, data))
+
+    # Run the iris PP load rules only on the representative fields
+    pp_fields = {}
+    try:
+        for rec, rec_data in representatives.items():
+            field = iris.fileformats.pp.make_pp_field(lookup[rec].item())
+            field.data = rec_data
+            pp_fields[id(field)] = (rec, field)
+        for cube, field in iris.fileformats.rules.load_pairs_from_fields(
+            (field for _, field in pp_fields.values()),
+            converter,
+        ):
+            representatives[pp_fields[id(field)][0]] = cube
+    except (ValueError, iris.exceptions.CannotAddError) as err:
+        raise UMError(f"Unable to convert fields to cubes: {err}")
+
+    cubes = iris.cube.CubeList()
+    for template, records, reps, data in groups:
+        template_cube = representatives[template]
+        if any(
+            template_cube.coord_dims(c) not in ((), (0,), (1,), (0, 1))
+            for c in template_cube.coords()
+        ):
+            raise UMError("Unexpected coordinate dimensions for a 2D field.")
+        cubes.append(
+            _merge_group(
+                template_cube,
+                records,
+                [[representatives[r] for r in rep] for rep in reps],
+                data,
+            )
+        )
+    return cubes
+
+
+def load_cubes_iris(infile, converter=pp_rules.convert) -> iris.cube.CubeList:
+    """
+    Load a UM fieldsfile into cubes, using the generic iris loading and merging
+    (as in `iris.load`), with the given PP load rules 'converter'.
+    """
+    pairs = iris.fileformats.rules.load_pairs_from_fields(
+        iris.fileformats.um.um_to_pp(infile),
+        converter,
+    )
+    return iris.cube.CubeList(cube for cube, _ in pairs).merge(unique=False)
+
+
+def _is_regular(first, second):
+    """
+    Check whether two sequences of axis indices (ordered as the records in the file)
+    form a complete grid, with the 'second' index repeating regularly within each
+    point of the 'first' one.
+    """
+    nfirst, nsecond = first.max() + 1, second.max() + 1
+    return (
+        len(first) == nfirst * nsecond
+        and np.array_equal(first, np.repeat(np.arange(nfirst), nsecond))
+        and np.array_equal(second, np.tile(np.arange(nsecond), nfirst))
+    )
+
+
+def _appearance_index(lookup, indices, keys):
+    """
+    Get the position of each record along the axis defined by the lookup 'keys',
+    with the axis points in order of first appearance in the file.
+    """
+    _, inverse = _get_axis(lookup, indices, keys)
+    _, first = np.unique(inverse, return_index=True)
+    rank = np.empty(len(first), dtype=int)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse]
+
+
+def is_structured(lookup) -> bool:
+    """
+    Check whether the fields in the lookup table are suitable for the iris structured
+    UM loading.
+    The fields of each phenomenon (see STRUCTURED_KEYS) must have the same grid and
+    header metadata (see MERGE_KEYS), and must cover all the combinations of their
+    times and levels, in a regular repeating order (levels within times, or times
+    within levels).
+    """
+    groups = umutils.group_lookup(lookup, STRUCTURED_KEYS)
+    if len(groups) != len(umutils.group_lookup(lookup, MERGE_KEYS + PSEUDO_LEVEL_KEYS)):
+        return False
+    for indices in groups.values():
+        times = _appearance_index(lookup, indices, TIME_KEYS)
+        levels = _appearance_index(lookup, indices, LEVEL_KEYS)
+        if not (_is_regular(times, levels) or _is_regular(levels, times)):
+            return False
+    return True
+
+
+def load_cubes_structured(infile, lookup) -> iris.cube.CubeList:
+    """
+    Load a UM fieldsfile into cubes, using the iris structured UM loading.
+    Raise UMError if the fields are not regularly ordered, or if iris
+    could not build a dimension coordinate for every merged axis.
+    """
+    if not is_structured(lookup):
+        raise UMError("The fields are not regularly ordered for structured loading.")
+    try:
+        with iris.fileformats.um.structured_um_loading():
+            cubes = iris.load(infile)
+    except (ValueError, iris.exceptions.IrisError) as err:
+        raise UMError(f"Structured loading failed: {err}")
+    for cube in cubes:
+        if any(
+            not cube.coords(dimensions=dim, dim_coords=True) for dim in range(cube.ndim)
+        ):
+            raise UMError(
+                "Structured loading produced an anonymous dimension "
+                f"for '{cube.name()}'."
+            )
+    return cubes
+
+
+def load_cubes(
+    infile,
+    um_file,
+    lookup,
+    engine="iris",
+    read_threads=1,
+    byteorder="=",
+) -> iris.cube.CubeList:
+    """
+    Load a UM fieldsfile into cubes using the chosen engine ('iris', 'amami' or
+    'structured').
+    With the 'amami' engine, the data records are read and decoded on
+    'read_threads' threads (see `RecordReader`), in the given 'byteorder'.
+    If the chosen engine cannot process the file, the 'iris' and then the 'amami'
+    engines are used.
+    The translation of the field headers into cube metadata is cached
+    (see `CachedConverter`), except for the 'structured' engine which uses
+    its own iris rules.
+    """
+    converter = CachedConverter()
+    engines = {
+        "iris": lambda: load_cubes_iris(infile, converter),
+        "amami": lambda: merge_cubes(
+            um_file,
+            lookup,
+            converter,
+            RecordReader(infile, read_threads, byteorder) if read_threads > 1 else None,
+        ),
+        "structured": lambda: load_cubes_structured(infile, lookup),
+    }
+    fallbacks = [name for name in ("iris", "amami") if name != engine]
+    for name in [engine] + fallbacks:
+        try:
+            cubes = engines[name]()
+        except (UMError, iris.exceptions.CannotAddError) as err:
+            LOGGER.warning(f"Unable to load UM file with the '{name}' engine: {err}")
+        else:
+            LOGGER.info(f"UM file loaded with the '{name}' engine.")
+            converter.report()
+            return cubes
+    raise UMError(
+        "UM file can not be processed. "
+        "UM files with time series currently not supported. "
+        "Convert with convsh https://ncas-cms.github.io/xconv-doc/html/example1.html."
+    )
@@ -7,17 +7,126 @@ Script created by Davide Marchegiani (davide.marchegiani@anu.edu.au) at ACCESS-N
 Utility module for UM fieldsfiles and STASH-related functionalities
 """
 
+import gzip
+import os
 import re
+import shutil
+import tarfile
+import tempfile
+import weakref
 import mule
-from typing import Union, List
+import numpy as np
+from typing import Union, List, Dict, Sequence, Tuple
 from iris.fileformats.pp import STASH as irisSTASH
 from amami.loggers import LOGGER
 from amami._atm_stashlist import ATM_STASHLIST
 from amami.exceptions import UMError
+from amami.record_reader import WORD_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Separator between a tar archive and the path of a UM file within it
+ARCHIVE_MEMBER_SEP = "::"
+# Suffixes of the compressed UM files
+COMPRESSED_SUFFIXES = (".gz", ".zst", ".zstd")
+# Buffer size (bytes) used to spool compressed and archived UM files
+SPOOL_BUFSIZE = 16 * 1024**2
 
 IMDI = -32768  # (-2.0**15)
 RMDI = -1073741824.0  # (-2.0**30)
 
+# Names of the 64 words of a UM lookup entry (UMDP F03).
+# The first 45 words are integers, the last 19 are reals.
+LOOKUP_INT_NAMES = (
+    "lbyr",
+    "lbmon",
+    "lbdat",
+    "lbhr",
+    "lbmin",
+    "lbsec",
+    "lbyrd",
+    "lbmond",
+    "lbdatd",
+    "lbhrd",
+    "lbmind",
+    "lbsecd",
+    "lbtim",
+    "lbft",
+    "lblrec",
+    "lbcode",
+    "lbhem",
+    "lbrow",
+    "lbnpt",
+    "lbext",
+    "lbpack",
+    "lbrel",
+    "lbfc",
+    "lbcfc",
+    "lbproc",
+    "lbvc",
+    "lbrvc",
+    "lbexp",
+    "lbegin",
+    "lbnrec",
+    "lbproj",
+    "lbtyp",
+    "lblev",
+    "lbrsvd1",
+    "lbrsvd2",
+    "lbrsvd3",
+    "lbrsvd4",
+    "lbsrce",
+    "lbuser1",
+    "lbuser2",
+    "lbuser3",
+    "lbuser4",
+    "lbuser5",
+    "lbuser6",
+    "lbuser7",
+)
+LOOKUP_REAL_NAMES = (
+    "bulev",
+    "bhulev",
+    "brsvd3",
+    "brsvd4",
+    "bdatum",
+    "bacc",
+    "blev",
+    "brlev",
+    "bhlev",
+    "bhrlev",
+    "bplat",
+    "bplon",
+    "bgor",
+    "bzy",
+    "bdy",
+    "bzx",
+    "bdx",
+    "bmdi",
+    "bmks",
+)
+LOOKUP_DTYPE = np.dtype(
+    [(name, np.int64) for name in LOOKUP_INT_NAMES]
+    + [(name, np.float64) for name in LOOKUP_REAL_NAMES]
+)
+# Length (words) of the UM fixed length header
+FIXED_HEADER_LENGTH = 256
+# Positions (0-based words) of the lookup table and data in the fixed length header
+LOOKUP_START, LOOKUP_DIM1, LOOKUP_DIM2, DATA_START = 149, 150, 151, 159
+# Derived keys that can be used, together with the lookup word names,
+# to filter, sort and group the lookup table
+LOOKUP_KEYS = {
+    "stash": lambda lookup: lookup["lbuser4"],
+    "time": lambda lookup: get_validity_time(lookup),
+    "data_time": lambda lookup: get_data_time(lookup),
+    "level": lambda lookup: lookup["blev"],
+    "pseudo_level": lambda lookup: lookup["lbuser5"],
+    "packing": lambda lookup: get_packing(lookup),
+}
+
 
 class Stash:
     """
@@ -45,23 +154,29 @@ class Stash:
                 code = int(code)
                 if code > 54999 or code < 0:
                     # TODO: refactor to single message
-                    msg = (f"Invalid STASH item code '{code}'. For item codes reference please "
-                           "check the UM Documentation Paper C04 about 'Storage Handling and "
-                           "Diagnostic System (STASH)' --> "
-                           "https://code.metoffice.gov.uk/doc/um/latest/papers/umdp_C04.pdf")
+                    msg = (
+                        f"Invalid STASH item code '{code}'. For item codes reference please "
+                        "check the UM Documentation Paper C04 about 'Storage Handling and "
+                        "Diagnostic System (STASH)' --> "
+                        "https://code.metoffice.gov.uk/doc/um/latest/papers/umdp_C04.pdf"
+                    )
                     raise UMError(msg)
                 self.model, self.section, self.item = self._from_itemcode(code)
             else:
-                msg = ("STASH code needs to be either an integer between 0 and 54999, or a string "
-                       "in the format '[m--]s--i---', with each '-' being an integer between 0-9.\n"
-                       "The part wrapped in squared brackets ('[]') is optional.")
+                msg = (
+                    "STASH code needs to be either an integer between 0 and 54999, or a string "
+                    "in the format '[m--]s--i---', with each '-' being an integer between 0-9.\n"
+                    "The part wrapped in squared brackets ('[]') is optional."
+                )
                 raise UMError(msg)
         elif isinstance(code, int):
             if code > 54999 or code < 0:
-                msg = (f"Invalid STASH item code '{code}'. For item codes reference please "
-                       "check the UM Documentation Paper C04 about 'Storage Handling and "
-                       "Diagnostic System (STASH)' --> "
-                       "https://code.metoffice.gov.uk/doc/um/latest/papers/umdp_C04.pdf")
+                msg = (
+                    f"Invalid STASH item code '{code}'. For item codes reference please "
+                    "check the UM Documentation Paper C04 about 'Storage Handling and "
+                    "Diagnostic System (STASH)' --> "
+                    "https://code.metoffice.gov.uk/doc/um/latest/papers/umdp_C04.pdf"
+                )
                 raise UMError(msg)
             self.model, self.section, self.item = self._from_itemcode(code)
         elif isinstance(code, irisSTASH):
@@ -99,7 +214,11 @@ class Stash:
         elif isinstance(other, int):
             return self.itemcode == other
         elif isinstance(other, irisSTASH):
-            return self.model == other.model and self.section == other.section and self.item == other.item
+            return (
+                self.model == other.model
+                and self.section == other.section
+                and self.item == other.item
+            )
         else:
             return False
 
@@ -121,11 +240,11 @@ class Stash:
 
     def _to_itemcode(self) -> int:
         """Function to return the STASH item code from section and item"""
-        return self.section*1000+self.item
+        return self.section * 1000 + self.item
 
     def _get_names(self):
         """
-        Get STASH variable names based on the UM STASH Registry 
+        Get STASH variable names based on the UM STASH Registry
         (https://reference.metoffice.gov.uk/um/stash)
         """
         try:
@@ -143,23 +262,239 @@ class Stash:
         self.unique_name = var[4] if var[4] else self.name
 
 
-def read_fieldsfile(um_filename: str, check_ancil: bool = False) -> type[mule.UMFile]:
-    """Read UM fieldsfile with mule, and optionally check if type is AncilFile"""
+def needs_spool(um_filename: str) -> bool:
+    """
+    Check whether a UM file is compressed (gzip or zstd) or a member of a tar archive
+    (given as 'ARCHIVE::MEMBER'), and has to be spooled to be read.
+    """
+    return ARCHIVE_MEMBER_SEP in um_filename or um_filename.endswith(
+        COMPRESSED_SUFFIXES
+    )
+
 
+def _copy_tar_member(archive: str, member: str, fout) -> None:
+    """Copy a member of a tar archive to the file 'fout'"""
+    try:
+        # Members of uncompressed archives are copied by offset, within the kernel
+        with tarfile.open(archive, "r:") as tar:
+            info = tar.getmember(member)
+            if info.isfile() and not info.sparse and hasattr(os, "copy_file_range"):
+                with open(archive, "rb") as fin:
+                    offset, remaining = info.offset_data, info.size
+                    while remaining:
+                        count = os.copy_file_range(
+                            fin.fileno(), fout.fileno(), remaining, offset
+                        )
+                        if count == 0:
+                            raise UMError(f"Archive '{archive}' is truncated.")
+                        offset += count
+                        remaining -= count
+                return
+    except tarfile.ReadError:
+        # Compressed archive
+        pass
+    with tarfile.open(archive) as tar:
+        fin = tar.extractfile(member)
+        if fin is None:
+            raise UMError(f"'{member}' is not a regular file in archive '{archive}'.")
+        shutil.copyfileobj(fin, fout, SPOOL_BUFSIZE)
+
+
+def spool_fieldsfile(um_filename: str, directory: str = None) -> str:
+    """
+    Decompress a compressed UM file, or extract a member of a tar archive
+    (given as 'ARCHIVE::MEMBER'), into a temporary file in 'directory' (the system
+    temporary directory if None), streaming the data.
+    Return the path of the temporary file, which must be removed by the caller.
+    """
+    fd, spool = tempfile.mkstemp(prefix="um_", suffix=".spool", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            archive, _, member = um_filename.partition(ARCHIVE_MEMBER_SEP)
+            if member:
+                _copy_tar_member(archive, member, fout)
+            elif um_filename.endswith(".gz"):
+                with gzip.open(um_filename, "rb") as fin:
+                    shutil.copyfileobj(fin, fout, SPOOL_BUFSIZE)
+            else:
+                if zstandard is None:
+                    raise UMError(
+                        "The 'zstandard' package is needed to read zstd compressed "
+                        "UM files."
+                    )
+                with open(um_filename, "rb") as fcompressed:
+                    with zstandard.ZstdDecompressor().stream_reader(fcompressed) as fin:
+                        shutil.copyfileobj(fin, fout, SPOOL_BUFSIZE)
+    except (OSError, EOFError, tarfile.TarError, KeyError) as err:
+        os.remove(spool)
+        raise UMError(f"Unable to read '{um_filename}': {err}")
+    except BaseException:
+        os.remove(spool)
+        raise
+    LOGGER.debug(f"UM file '{um_filename}' spooled to '{spool}'.")
+    return spool
+
+
+def read_fieldsfile(
+    um_filename: str,
+    check_ancil: bool = False,
+    return_lookup: bool = False,
+) -> Union[type[mule.UMFile], Tuple[type[mule.UMFile], np.ndarray]]:
+    """
+    Read UM fieldsfile with mule, and optionally check if type is AncilFile.
+    If return_lookup is True, also return the lookup table of the file
+    as a structured NumPy array (see `get_lookup_table`).
+    Compressed UM files and members of tar archives are spooled to a temporary file
+    first (see `spool_fieldsfile`), which is removed with the returned UMFile.
+    """
+    spool = spool_fieldsfile(um_filename) if needs_spool(um_filename) else None
+    ufile = None
     try:
-        ufile = mule.load_umfile(um_filename)
+        ufile = mule.load_umfile(spool or um_filename)
         ufile.remove_empty_lookups()
     except ValueError:
         raise UMError(
-            f"'{um_filename.resolve()}' does not appear to be a UM file.")
+            f"'{os.path.abspath(um_filename)}' does not appear to be a UM file."
+        )
+    finally:
+        if spool is not None and ufile is None:
+            os.remove(spool)
+    if spool is not None:
+        weakref.finalize(ufile, os.remove, spool)
 
     if check_ancil and (not isinstance(ufile, mule.ancil.AncilFile)):
-        raise UMError(
-            f"'{um_filename}' does not appear to be a UM ancillary file.")
+        raise UMError(f"'{um_filename}' does not appear to be a UM ancillary file.")
 
+    if return_lookup:
+        return ufile, get_lookup_table(spool or um_filename)
     return ufile
 
 
+def _read_lookup(um_filename: str, dtype: np.dtype) -> np.ndarray:
+    """
+    Read all the entries of the lookup table of the UM file 'um_filename' at once,
+    as records of the big-endian structured 'dtype' (which may hold only some of
+    the lookup words), using the lookup position and size in the fixed length header.
+    Empty lookup entries are dropped (as with mule's `remove_empty_lookups`).
+    """
+    fixed = np.fromfile(um_filename, dtype=">i8", count=FIXED_HEADER_LENGTH)
+    if len(fixed) < FIXED_HEADER_LENGTH:
+        raise UMError(
+            f"'{os.path.abspath(um_filename)}' does not appear to be a UM file."
+        )
+    start, dim1, dim2 = (
+        int(fixed[i]) for i in (LOOKUP_START, LOOKUP_DIM1, LOOKUP_DIM2)
+    )
+    if start <= 0 or dim1 != len(LOOKUP_DTYPE.names) or dim2 < 0:
+        raise UMError(
+            f"'{os.path.abspath(um_filename)}' does not appear to be a UM file."
+        )
+    lookup = np.fromfile(
+        um_filename, dtype=dtype, count=dim2, offset=(start - 1) * WORD_SIZE
+    )
+    return lookup[lookup["lbrel"] != -99]
+
+
+def get_lookup_table(um_filename: str) -> np.ndarray:
+    """
+    Read the lookup table of the UM file 'um_filename' as a structured NumPy array
+    with dtype LOOKUP_DTYPE (one record per non-empty lookup entry, in the same order
+    as the fields of the mule UMFile). Single lookup words can be accessed by name
+    (e.g. `lookup['lbuser4']`).
+    """
+    return _read_lookup(um_filename, LOOKUP_DTYPE.newbyteorder(">")).astype(
+        LOOKUP_DTYPE
+    )
+
+
+def _datetime_key(lookup: np.ndarray, names: Sequence[str]) -> np.ndarray:
+    """
+    Combine the lookup date/time words in 'names' into a sortable integer
+    (YYYYMMDDhhmmss)
+    """
+    key = np.zeros(len(lookup), dtype=np.int64)
+    for name, factor in zip(names, (1, 100, 100, 100, 100, 100)):
+        key = key * factor + lookup[name]
+    return key
+
+
+def get_validity_time(lookup: np.ndarray) -> np.ndarray:
+    """Get the validity time of the lookup records as integers (YYYYMMDDhhmmss)"""
+    return _datetime_key(lookup, LOOKUP_INT_NAMES[:6])
+
+
+def get_data_time(lookup: np.ndarray) -> np.ndarray:
+    """Get the data time of each lookup record as a sortable integer (YYYYMMDDhhmmss)"""
+    return _datetime_key(lookup, LOOKUP_INT_NAMES[6:12])
+
+
+def get_packing(lookup: np.ndarray) -> np.ndarray:
+    """Get the packing type (last digit of LBPACK) of each lookup record"""
+    return lookup["lbpack"] % 10
+
+
+def get_lookup_key(lookup: np.ndarray, key: str) -> np.ndarray:
+    """
+    Get the values of 'key' for each lookup record.
+    'key' can be either a lookup word name (e.g. 'lbproc') or one of the
+    derived keys in LOOKUP_KEYS (e.g. 'stash' or 'time').
+    """
+    if key in LOOKUP_KEYS:
+        return LOOKUP_KEYS[key](lookup)
+    try:
+        return lookup[key]
+    except ValueError:
+        raise UMError(f"Invalid lookup key '{key}'.")
+
+
+def filter_lookup(lookup: np.ndarray, **conditions) -> np.ndarray:
+    """
+    Get the indices of the lookup records matching all the given conditions.
+    Each condition is a lookup key (see `get_lookup_key`) with either a single
+    value or a sequence of accepted values
+    (e.g. `filter_lookup(lookup, stash=[2, 3], lbproc=128)`).
+    """
+    selected = np.ones(len(lookup), dtype=bool)
+    for key, values in conditions.items():
+        selected &= np.isin(get_lookup_key(lookup, key), values)
+    return np.flatnonzero(selected)
+
+
+def sort_lookup(
+    lookup: np.ndarray, keys: Sequence[str] = ("stash", "time", "level")
+) -> np.ndarray:
+    """
+    Get the indices that sort the lookup records by the given keys
+    (the first key being the primary sort key).
+    The sort is stable, so records with equal keys keep the file order.
+    """
+    if len(keys) == 0:
+        return np.arange(len(lookup))
+    return np.lexsort([get_lookup_key(lookup, k) for k in reversed(keys)])
+
+
+def group_lookup(
+    lookup: np.ndarray, keys: Sequence[str] = ("stash",)
+) -> Dict[tuple, np.ndarray]:
+    """
+    Group the lookup records by the given keys.
+    Return a dictionary mapping each unique combination of key values to the
+    indices of the matching records (in file order). The groups are ordered
+    by their first occurrence in the file.
+    """
+    if len(lookup) == 0:
+        return {}
+    columns = [get_lookup_key(lookup, k) for k in keys]
+    order = np.lexsort(columns[::-1])
+    # A new group starts wherever any of the sorted keys changes
+    changes = np.zeros(len(lookup) - 1, dtype=bool)
+    for col in columns:
+        changes |= col[order][1:] != col[order][:-1]
+    groups = np.split(order, np.flatnonzero(changes) + 1)
+    groups.sort(key=lambda g: g[0])
+    return {tuple(col[g[0]].item() for col in columns): g for g in groups}
+
+
 def get_grid_type(um_file: type[mule.UMFile]) -> str:
     """Get UM grid type from mule UMFile"""
     gs = um_file.fixed_length_header.grid_staggering
@@ -169,7 +504,8 @@ def get_grid_type(um_file: type[mule.UMFile]) -> str:
         return "ND"  # New Dynamics
 
     raise UMError(
-        f"Unrecognised grid staggering in UM Fieldsfile header: '{gs}' not supported.")
+        f"Unrecognised grid staggering in UM Fieldsfile header: '{gs}' not supported."
+    )
 
 
 def get_sealevel_rho(um_file: type[mule.UMFile]) -> float:
@@ -177,7 +513,7 @@ def get_sealevel_rho(um_file: type[mule.UMFile]) -> float:
     try:
         return um_file.level_dependent_constants.zsea_at_rho
     except AttributeError:
-        return 0.
+        return 0.0
 
 
 def get_sealevel_theta(um_file: type[mule.UMFile]) -> float:
@@ -185,15 +521,27 @@ def get_sealevel_theta(um_file: type[mule.UMFile]) -> float:
     try:
         return um_file.level_dependent_constants.zsea_at_theta
     except AttributeError:
-        return 0.
+        return 0.0
 
 
-def get_stash(um_file: type[mule.UMFile], repeat: bool = True) -> List:
+def get_stash(um_filename: str, repeat: bool = True) -> List:
     """
-    Get ordered list of stash codes in mule UMFile
+    Get ordered list of stash codes in the UM file 'um_filename'
     with (repeat = True) or without (repeat = False) repetitions.
+    Only the lookup words needed are read (not the whole lookup table).
     """
-    stash_codes = [f.lbuser4 for f in um_file.fields]
+    big_endian = LOOKUP_DTYPE.newbyteorder(">")
+    names = ["lbrel", "lbuser4"]
+    dtype = np.dtype(
+        {
+            "names": names,
+            "formats": [big_endian[name] for name in names],
+            "offsets": [big_endian.fields[name][1] for name in names],
+            "itemsize": big_endian.itemsize,
+        }
+    )
+    stash_codes = _read_lookup(um_filename, dtype)["lbuser4"].astype(np.int64)
     if not repeat:
-        return list(dict.fromkeys(stash_codes))
-    return stash_codes
+        _, first = np.unique(stash_codes, return_index=True)
+        stash_codes = stash_codes[np.sort(first)]
+    return stash_codes.tolist()
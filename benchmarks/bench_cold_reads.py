@@ -0,0 +1,97 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Benchmark of the reads of the data records of a UM file from a cold page cache:
+one read per record in STASH order (as when reading the fields variable by
+variable), one read per record in file order, and the coalesced reads planned
+by `plan_reads` (as done by `RecordReader`).
+
+The UM file is evicted from the page cache before each run (where supported).
+Use '--directory' to put the synthetic file on the file system of interest
+(e.g. Lustre).
+
+Usage: python -m benchmarks.bench_cold_reads [UM_FILE] [--max-size MIB] [--max-gap MIB]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import amami.um_utils as umutils
+from amami.record_reader import MAX_READ_GAP, MAX_READ_SIZE, WORD_SIZE, plan_reads
+from benchmarks.synthetic import drop_cache, get_fields, get_items, write_fieldsfile
+
+
+def time_reads(infile, reads) -> float:
+    """Read the (start, stop) byte ranges of the UM file in order, and return the time (s)"""
+    drop_cache(infile)
+    start = time.perf_counter()
+    fd = os.open(infile, os.O_RDONLY)
+    try:
+        for rstart, rstop in reads:
+            os.pread(fd, rstop - rstart, rstart)
+    finally:
+        os.close(fd)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("infile", nargs="?", help="UM file (default: synthetic file)")
+    parser.add_argument(
+        "--max-size",
+        type=float,
+        default=MAX_READ_SIZE / 1024**2,
+        help="Maximum size of a coalesced read (MiB)",
+    )
+    parser.add_argument(
+        "--max-gap",
+        type=float,
+        default=MAX_READ_GAP / 1024**2,
+        help="Maximum gap between records read together (MiB)",
+    )
+    parser.add_argument(
+        "--ntimes", type=int, default=4, help="Times of the synthetic file"
+    )
+    parser.add_argument(
+        "--directory", default=None, help="Directory of the temporary files"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        infile = args.infile
+        if infile is None:
+            infile = os.path.join(tmpdir, "cold_reads.ff")
+            nfields = args.ntimes * len(get_items(pressure_levels=True))
+            write_fieldsfile(infile, get_fields(nfields, pressure_levels=True))
+        lookup = umutils.get_lookup_table(infile)
+        lookup = lookup[(lookup["lbegin"] > 0) & (lookup["lbnrec"] > 0)]
+        starts = lookup["lbegin"].astype(np.int64) * WORD_SIZE
+        stops = starts + lookup["lbnrec"].astype(np.int64) * WORD_SIZE
+        size = int((stops - starts).sum())
+        by_stash = np.argsort(lookup["lbuser4"], kind="stable")
+        by_offset = np.argsort(starts, kind="stable")
+        planned = plan_reads(
+            zip(range(len(lookup)), starts.tolist(), stops.tolist()),
+            max_size=int(args.max_size * 1024**2),
+            max_gap=int(args.max_gap * 1024**2),
+        )
+        orders = {
+            "stash": list(zip(starts[by_stash].tolist(), stops[by_stash].tolist())),
+            "offset": list(zip(starts[by_offset].tolist(), stops[by_offset].tolist())),
+            "planned": [(rstart, rstop) for rstart, rstop, _ in planned],
+        }
+        print(f"{infile}: {len(lookup)} records, {size / 1024**2:.1f} MiB")
+        print(f"{'order':>8} {'reads':>8} {'time (s)':>9} {'MiB/s':>8}")
+        for name, reads in orders.items():
+            elapsed = time_reads(infile, reads)
+            print(
+                f"{name:>8} {len(reads):>8} {elapsed:>9.2f} "
+                f"{size / 1024**2 / elapsed:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Benchmark of the UM loading engines of `amami um2nc` ('iris', 'structured' and
+'amami'), on UM files given on the command line (e.g. ACCESS-CM2 or ACCESS-ESM1.5
+output) or on a synthetic file laid out as their monthly output (single-level and
+pressure level fields on the N96 grid).
+
+For each engine, the time to load the fields into cubes and the time of the
+whole conversion are reported. Whether the file is regularly ordered, and so
+eligible for the 'structured' engine, is reported as well (otherwise that
+engine falls back to the 'iris' one).
+
+Usage: python -m benchmarks.bench_engines [UM_FILE ...] [--engines iris structured amami]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import warnings
+import amami.um_utils as umutils
+from amami.um_load import is_structured, load_cubes
+from benchmarks.synthetic import get_fields, get_items, run_um2nc, write_fieldsfile
+
+ENGINES = ("iris", "structured", "amami")
+
+
+def time_load(infile, engine) -> float:
+    """Load the UM file into cubes with the 'engine', and return the time (s)"""
+    start = time.perf_counter()
+    um_file, lookup = umutils.read_fieldsfile(infile, return_lookup=True)
+    load_cubes(infile, um_file, lookup, engine)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("infiles", nargs="*", help="UM files (default: synthetic file)")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=ENGINES)
+    parser.add_argument(
+        "--ntimes", type=int, default=4, help="Times of the synthetic file"
+    )
+    parser.add_argument(
+        "--directory", default=None, help="Directory of the temporary files"
+    )
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        infiles = args.infiles
+        if not infiles:
+            infile = os.path.join(tmpdir, "engines.ff")
+            nfields = args.ntimes * len(get_items(pressure_levels=True))
+            write_fieldsfile(infile, get_fields(nfields, pressure_levels=True))
+            infiles = [infile]
+        outfile = os.path.join(tmpdir, "engines.nc")
+        for infile in infiles:
+            lookup = umutils.get_lookup_table(infile)
+            print(
+                f"{infile}: {len(lookup)} fields, "
+                f"{'regularly' if is_structured(lookup) else 'not regularly'} ordered"
+            )
+            print(f"{'engine':>12} {'load (s)':>10} {'convert (s)':>12}")
+            for engine in args.engines:
+                load = time_load(infile, engine)
+                convert = run_um2nc(
+                    ["-i", infile, "-o", outfile, "--engine", engine, "--nohist", "-s"]
+                )
+                os.remove(outfile)
+                print(f"{engine:>12} {load:>10.2f} {convert:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
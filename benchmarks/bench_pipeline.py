@@ -0,0 +1,85 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Benchmark of the read/transform/write pipeline of `amami um2nc`: throughput of the
+conversion with the fields processed one at a time ('--prefetch 0') and with
+reading and masking running ahead of compressing and writing ('--prefetch N').
+
+The UM file is evicted from the page cache before each conversion ('--cold'),
+so that reading it is I/O bound. Use '--directory' to put the files on the
+file system of interest (e.g. Lustre).
+
+Usage: python -m benchmarks.bench_pipeline [UM_FILE] [--prefetch 0 1 2 4] [--cold]
+"""
+
+import argparse
+import os
+import tempfile
+from benchmarks.synthetic import (
+    drop_cache,
+    get_fields,
+    get_items,
+    run_um2nc,
+    write_fieldsfile,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("infile", nargs="?", help="UM file (default: synthetic file)")
+    parser.add_argument("--prefetch", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument(
+        "--ntimes", type=int, default=4, help="Times of the synthetic file"
+    )
+    parser.add_argument(
+        "--engine", default="amami", choices=["iris", "amami", "structured"]
+    )
+    parser.add_argument("--compression", type=int, default=4)
+    parser.add_argument(
+        "--cold", action="store_true", help="Read the UM file from disk"
+    )
+    parser.add_argument(
+        "--directory", default=None, help="Directory of the temporary files"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        infile = args.infile
+        if infile is None:
+            infile = os.path.join(tmpdir, "pipeline.ff")
+            nfields = args.ntimes * len(get_items(pressure_levels=True))
+            write_fieldsfile(infile, get_fields(nfields, pressure_levels=True))
+        size = os.path.getsize(infile) / 1024**2
+        outfile = os.path.join(tmpdir, "pipeline.nc")
+        print(f"{'prefetch':>8} {'time (s)':>9} {'MiB/s':>7} {'speedup':>8}")
+        reference = None
+        for prefetch in args.prefetch:
+            if args.cold:
+                drop_cache(infile)
+            elapsed = run_um2nc(
+                [
+                    "-i",
+                    infile,
+                    "-o",
+                    outfile,
+                    "--engine",
+                    args.engine,
+                    "-c",
+                    str(args.compression),
+                    "--prefetch",
+                    str(prefetch),
+                    "--nohist",
+                    "-s",
+                ]
+            )
+            os.remove(outfile)
+            reference = reference or elapsed
+            print(
+                f"{prefetch:>8} {elapsed:>9.2f} {size / elapsed:>7.1f} "
+                f"{reference / elapsed:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
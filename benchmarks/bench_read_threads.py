@@ -0,0 +1,92 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Benchmark of the read throughput of WGDOS-packed UM files against the number of
+read threads ('--read-threads' of `amami um2nc`).
+
+The data of all the fields is read and unpacked by mule one field at a time, then
+by `RecordReader` on 1, 2, 4 and 8 threads. The throughput is given in MiB/s of
+unpacked (64-bit) data. The synthetic file is WGDOS-packed, unless '--ieee' is
+given (which does not need the mule unpacker).
+
+Usage: python -m benchmarks.bench_read_threads [UM_FILE] [--threads 1 2 4 8] [--cold]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import amami.um_utils as umutils
+from amami.record_reader import RecordReader
+from benchmarks.synthetic import drop_cache, get_fields, get_items, write_fieldsfile
+
+
+def time_read(infile, fields, nthreads=None, cold=False) -> tuple:
+    """
+    Read the data of the 'fields' with mule (no 'nthreads') or with a `RecordReader`
+    on 'nthreads' threads, and return the time (s) and the size (bytes) of the data.
+    """
+    if cold:
+        drop_cache(infile)
+    sizes = [0] * len(fields)
+
+    def store(i, data):
+        sizes[i] = data.size * 8
+
+    start = time.perf_counter()
+    if nthreads is None:
+        for i, field in enumerate(fields):
+            store(i, field.get_data())
+    else:
+        RecordReader(infile, nthreads).read(fields, store)
+    return time.perf_counter() - start, sum(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("infile", nargs="?", help="UM file (default: synthetic file)")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--ntimes", type=int, default=4, help="Times of the synthetic file"
+    )
+    parser.add_argument(
+        "--ieee", action="store_true", help="Do not pack the synthetic file"
+    )
+    parser.add_argument(
+        "--cold", action="store_true", help="Read the UM file from disk"
+    )
+    parser.add_argument(
+        "--directory", default=None, help="Directory of the temporary files"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        infile = args.infile
+        if infile is None:
+            infile = os.path.join(tmpdir, "read_threads.ff")
+            nfields = args.ntimes * len(get_items(pressure_levels=True))
+            write_fieldsfile(
+                infile, get_fields(nfields, pressure_levels=True), wgdos=not args.ieee
+            )
+        fields = umutils.read_fieldsfile(infile).fields
+        npacked = sum(field.lbpack == 1 for field in fields)
+        print(f"{infile}: {len(fields)} fields, {npacked} WGDOS-packed")
+        print(
+            f"{'reader':>8} {'threads':>8} {'time (s)':>9} {'MiB/s':>8} {'speedup':>8}"
+        )
+        reference, size = time_read(infile, fields, cold=args.cold)
+        print(
+            f"{'mule':>8} {1:>8} {reference:>9.2f} "
+            f"{size / 1024**2 / reference:>8.1f} {1:>8.2f}"
+        )
+        for nthreads in args.threads:
+            elapsed, size = time_read(infile, fields, nthreads, args.cold)
+            print(
+                f"{'amami':>8} {nthreads:>8} {elapsed:>9.2f} "
+                f"{size / 1024**2 / elapsed:>8.1f} {reference / elapsed:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Benchmark of the scaling of `amami um2nc` with the number of fields in the UM file.
+
+Synthetic files with 10, 1k and 50k fields (by default) are converted, on a small
+grid so that the time is dominated by the per-field work outside the data I/O
+(loading, sorting, masking decisions, naming, writing the variables).
+The time per field should stay flat as the number of fields grows.
+
+Usage: python -m benchmarks.bench_scaling [--sizes 10 1000 50000] [--engine amami]
+"""
+
+import argparse
+import os
+import tempfile
+from benchmarks.synthetic import get_fields, run_um2nc, write_fieldsfile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 50000])
+    parser.add_argument("--nstash", type=int, default=250, help="STASH items per time")
+    parser.add_argument("--shape", type=int, nargs=2, default=[8, 16])
+    parser.add_argument(
+        "--engine", default="amami", choices=["iris", "amami", "structured"]
+    )
+    parser.add_argument(
+        "--directory", default=None, help="Directory of the temporary files"
+    )
+    args = parser.parse_args()
+
+    print(f"{'fields':>8} {'variables':>9} {'total (s)':>10} {'per field (ms)':>15}")
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        for nfields in args.sizes:
+            infile = os.path.join(tmpdir, f"scaling_{nfields}.ff")
+            outfile = os.path.join(tmpdir, f"scaling_{nfields}.nc")
+            fields = get_fields(nfields, nstash=args.nstash)
+            write_fieldsfile(infile, fields, shape=args.shape)
+            elapsed = run_um2nc(
+                ["-i", infile, "-o", outfile, "--engine", args.engine, "--nohist", "-s"]
+            )
+            nvars = len({itemcode for _, itemcode, _ in fields})
+            print(
+                f"{nfields:>8} {nvars:>9} {elapsed:>10.2f} {1000 * elapsed / nfields:>15.3f}"
+            )
+            os.remove(infile)
+            os.remove(outfile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Profile of the translation of the UM field headers into cube metadata (the iris
+PP load rules), with the plain iris rules and with the cached rules of
+`amami.um_load.CachedConverter`.
+
+For each, the time spent in the rules is reported against the total loading time
+(generic iris loading and merging). With '--profile N', the N functions with the
+highest cumulative time are also printed.
+
+Usage: python -m benchmarks.profile_rules [UM_FILE] [--profile 20]
+"""
+
+import argparse
+import cProfile
+import os
+import pstats
+import tempfile
+import time
+import warnings
+import iris.fileformats.pp_load_rules as pp_rules
+from amami.um_load import CachedConverter, load_cubes_iris
+from benchmarks.synthetic import get_fields, get_items, write_fieldsfile
+
+
+class TimedConverter:
+    """PP load rules that record the time spent in them"""
+
+    def __init__(self, converter):
+        self.converter = converter
+        self.nfields = 0
+        self.elapsed = 0.0
+
+    def __call__(self, field):
+        start = time.perf_counter()
+        metadata = self.converter(field)
+        self.elapsed += time.perf_counter() - start
+        self.nfields += 1
+        return metadata
+
+
+def profile_load(infile, converter, nfunctions):
+    """Load the UM file with the 'converter' rules, and return the total time (s)"""
+    profile = cProfile.Profile() if nfunctions else None
+    start = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    cubes = load_cubes_iris(infile, converter)
+    if profile is not None:
+        profile.disable()
+    elapsed = time.perf_counter() - start
+    if profile is not None:
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(nfunctions)
+    return elapsed, len(cubes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("infile", nargs="?", help="UM file (default: synthetic file)")
+    parser.add_argument(
+        "--ntimes", type=int, default=6, help="Times of the synthetic file"
+    )
+    parser.add_argument("--shape", type=int, nargs=2, default=[72, 96])
+    parser.add_argument("--profile", type=int, default=0, metavar="N")
+    parser.add_argument(
+        "--directory", default=None, help="Directory of the temporary files"
+    )
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        infile = args.infile
+        if infile is None:
+            infile = os.path.join(tmpdir, "rules.ff")
+            nfields = args.ntimes * len(get_items(pressure_levels=True))
+            fields = get_fields(nfields, pressure_levels=True)
+            write_fieldsfile(infile, fields, shape=args.shape)
+        for label, converter in (
+            ("iris rules", TimedConverter(pp_rules.convert)),
+            ("cached rules", CachedConverter()),
+        ):
+            elapsed, ncubes = profile_load(infile, converter, args.profile)
+            print(
+                f"{label:>12}: {converter.nfields} fields into {ncubes} cubes in "
+                f"{elapsed:.2f} s, of which {converter.elapsed:.2f} s "
+                f"({100 * converter.elapsed / elapsed:.0f}%) in the rules"
+            )
+
+
+if __name__ == "__main__":
+    main()
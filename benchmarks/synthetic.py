@@ -0,0 +1,253 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Synthetic UM fieldsfiles for the benchmarks, and helpers to time `amami um2nc`.
+
+The files are written directly (fixed length header, integer and real constants,
+lookup table and data records), with the fields on a regular global ENDGame grid,
+ordered by time, then STASH code, then level (as in UM output).
+Single-level fields are taken from section 3 of the STASH list, and pressure level
+fields from section 30, with the heaviside functions needed to mask them.
+"""
+
+import datetime
+import math
+import os
+import time
+from typing import Sequence
+import numpy as np
+from amami._atm_stashlist import ATM_STASHLIST
+from amami.cli import Amami
+from amami.record_reader import WORD_SIZE
+from amami.um_utils import (
+    DATA_START,
+    FIXED_HEADER_LENGTH,
+    IMDI,
+    LOOKUP_DIM1,
+    LOOKUP_DIM2,
+    LOOKUP_DTYPE,
+    LOOKUP_START,
+    RMDI,
+)
+
+# Item codes of the single-level and pressure level fields
+SINGLE_LEVEL_ITEMS = tuple(
+    itemcode for itemcode in ATM_STASHLIST if itemcode // 1000 == 3
+)
+PRESSURE_LEVEL_ITEMS = tuple(range(30201, 30209)) + (30293, 30294)
+HEAVISIDE_ITEMS = (30301, 30304)
+PRESSURES = (
+    1000.0,
+    925.0,
+    850.0,
+    700.0,
+    600.0,
+    500.0,
+    400.0,
+    300.0,
+    250.0,
+    200.0,
+    150.0,
+    100.0,
+    70.0,
+    50.0,
+    30.0,
+    20.0,
+    10.0,
+    5.0,
+    1.0,
+)
+# N96 grid of ACCESS-CM2 and ACCESS-ESM1.5
+N96_SHAPE = (144, 192)
+# Records are padded to sectors of 512 words
+SECTOR_SIZE = 512
+# Accuracy (power of 2) of the WGDOS packed fields
+WGDOS_ACCURACY = -10
+_INTEGER_CONSTANTS_LENGTH = 46
+_REAL_CONSTANTS_LENGTH = 38
+
+
+def _sectors(nwords: int) -> int:
+    return -(-nwords // SECTOR_SIZE) * SECTOR_SIZE
+
+
+def _fixed_header(shape, nlookup, data_start) -> np.ndarray:
+    """Fixed length header (see UMDP F3, the positions are 1-based)"""
+    fixed = np.full(FIXED_HEADER_LENGTH, IMDI, dtype=">i8")
+    for position, value in (
+        (1, 20),  # Data set format version
+        (2, 1),  # Atmosphere sub-model
+        (3, 1),  # Hybrid vertical coordinates
+        (4, 0),  # Global grid
+        (5, 3),  # Fieldsfile
+        (8, 1),  # Gregorian calendar
+        (9, 6),  # ENDGame grid staggering
+        (12, 1003),  # UM version
+        (100, FIXED_HEADER_LENGTH + 1),
+        (101, _INTEGER_CONSTANTS_LENGTH),
+        (105, FIXED_HEADER_LENGTH + _INTEGER_CONSTANTS_LENGTH + 1),
+        (106, _REAL_CONSTANTS_LENGTH),
+    ):
+        fixed[position - 1] = value
+    fixed[LOOKUP_START] = (
+        FIXED_HEADER_LENGTH + _INTEGER_CONSTANTS_LENGTH + _REAL_CONSTANTS_LENGTH + 1
+    )
+    fixed[LOOKUP_DIM1] = len(LOOKUP_DTYPE.names)
+    fixed[LOOKUP_DIM2] = nlookup
+    fixed[DATA_START] = data_start + 1
+    return fixed
+
+
+def _grid(shape):
+    """Spacing and first point of the rows and columns of a global ENDGame P grid"""
+    nrows, ncols = shape
+    row_spacing = 180.0 / nrows
+    col_spacing = 360.0 / ncols
+    return row_spacing, -90.0 + row_spacing / 2, col_spacing, col_spacing / 2
+
+
+def _constants(shape, nlevels):
+    integer_constants = np.full(_INTEGER_CONSTANTS_LENGTH, IMDI, dtype=">i8")
+    integer_constants[5:8] = (shape[1], shape[0], nlevels)
+    real_constants = np.full(_REAL_CONSTANTS_LENGTH, RMDI, dtype=">f8")
+    row_spacing, first_lat, col_spacing, first_lon = _grid(shape)
+    real_constants[:6] = (col_spacing, row_spacing, first_lat, first_lon, 90.0, 0.0)
+    return integer_constants, real_constants
+
+
+def get_items(nstash: int = 100, pressure_levels: bool = False) -> list:
+    """
+    Get the (item code, pressure) of the fields at each time: up to 'nstash'
+    single-level items and, with 'pressure_levels', pressure level items on all
+    the PRESSURES, with the heaviside functions to mask them.
+    """
+    items = [(itemcode, None) for itemcode in SINGLE_LEVEL_ITEMS[:nstash]]
+    if pressure_levels:
+        items += [
+            (itemcode, pressure)
+            for itemcode in PRESSURE_LEVEL_ITEMS + HEAVISIDE_ITEMS
+            for pressure in PRESSURES
+        ]
+    return items
+
+
+def get_fields(nfields: int, nstash: int = 100, pressure_levels: bool = False) -> list:
+    """
+    Get the (time index, item code, pressure) of 'nfields' fields, in the order of
+    the file, with the items of `get_items` at each time.
+    """
+    items = get_items(nstash, pressure_levels)
+    ntimes = math.ceil(nfields / len(items))
+    fields = [
+        (t, itemcode, pressure) for t in range(ntimes) for itemcode, pressure in items
+    ]
+    return fields[:nfields]
+
+
+def write_fieldsfile(
+    path: str,
+    fields: Sequence,
+    shape: Sequence[int] = N96_SHAPE,
+    wgdos: bool = False,
+    seed: int = 0,
+) -> None:
+    """
+    Write the 'fields' (see `get_fields`) to the UM fieldsfile 'path', on a grid
+    with the given 'shape', unpacked or WGDOS packed (which requires mule).
+    The fields are daily instantaneous values, from 2000-01-01.
+    """
+    if wgdos:
+        from mule.packing import wgdos_pack
+    rng = np.random.default_rng(seed)
+    nfields = len(fields)
+    row_spacing, first_lat, col_spacing, first_lon = _grid(shape)
+    lookup = np.zeros(nfields, dtype=LOOKUP_DTYPE)
+    start = datetime.datetime(2000, 1, 1)
+    dates = np.array(
+        [(start + datetime.timedelta(days=t)).timetuple()[:3] for t, _, _ in fields]
+    )
+    for names in (("lbyr", "lbmon", "lbdat"), ("lbyrd", "lbmond", "lbdatd")):
+        for i, name in enumerate(names):
+            lookup[name] = dates[:, i]
+    lookup["lbtim"] = 11
+    lookup["lbcode"] = 1
+    lookup["lbrow"], lookup["lbnpt"] = shape
+    lookup["lbpack"] = 1 if wgdos else 0
+    lookup["lbrel"] = 3
+    lookup["lbuser1"] = 1
+    lookup["lbuser4"] = [itemcode for _, itemcode, _ in fields]
+    lookup["lbuser7"] = 1
+    pressures = np.array([-1.0 if p is None else p for _, _, p in fields])
+    lookup["lbvc"] = np.where(pressures < 0, 129, 8)
+    lookup["lblev"] = np.where(pressures < 0, 9999, 1)
+    lookup["blev"] = np.maximum(pressures, 0.0)
+    lookup["bacc"] = WGDOS_ACCURACY if wgdos else 0.0
+    lookup["bplat"] = 90.0
+    lookup["bzy"], lookup["bdy"] = first_lat - row_spacing, row_spacing
+    lookup["bzx"], lookup["bdx"] = first_lon - col_spacing, col_spacing
+    lookup["bmdi"] = RMDI
+    lookup["bmks"] = 1.0
+
+    # A smooth field for each item, varying in time
+    lat = np.linspace(-1.0, 1.0, shape[0])[:, None]
+    lon = np.linspace(0.0, 2 * np.pi, shape[1], endpoint=False)[None, :]
+    pattern = np.cos(np.pi / 2 * lat) * (1 + 0.2 * np.sin(lon))
+    records = []
+    for i, (t, itemcode, pressure) in enumerate(fields):
+        if itemcode in HEAVISIDE_ITEMS:
+            data = np.clip(
+                1.5 * pattern - 0.2 + 0.1 * (pressure or 0) / 1000.0, 0.0, 1.0
+            )
+        else:
+            data = (itemcode % 1000) * pattern + t + rng.standard_normal(shape)
+        if wgdos:
+            raw = bytes(wgdos_pack(data, RMDI, WGDOS_ACCURACY))
+        else:
+            raw = data.astype(">f8").tobytes()
+        lookup["lblrec"][i] = -(-len(raw) // WORD_SIZE)
+        records.append(raw)
+
+    nlookup = len(lookup)
+    lookup_end = int(
+        FIXED_HEADER_LENGTH
+        + _INTEGER_CONSTANTS_LENGTH
+        + _REAL_CONSTANTS_LENGTH
+        + nlookup * len(LOOKUP_DTYPE.names)
+    )
+    data_start = _sectors(lookup_end)
+    lookup["lbnrec"] = [_sectors(nwords) for nwords in lookup["lblrec"]]
+    lookup["lbegin"] = data_start + np.concatenate(
+        [[0], np.cumsum(lookup["lbnrec"])[:-1]]
+    )
+    integer_constants, real_constants = _constants(shape, 1)
+    with open(path, "wb") as fout:
+        fout.write(_fixed_header(shape, nlookup, data_start).tobytes())
+        fout.write(integer_constants.tobytes())
+        fout.write(real_constants.tobytes())
+        fout.write(lookup.astype(LOOKUP_DTYPE.newbyteorder(">")).tobytes())
+        fout.write(bytes((data_start - lookup_end) * WORD_SIZE))
+        for raw, nwords in zip(records, lookup["lbnrec"]):
+            fout.write(raw.ljust(int(nwords) * WORD_SIZE, b"\0"))
+
+
+def drop_cache(path: str) -> None:
+    """
+    Evict the file 'path' from the page cache (where supported), so that it is
+    read again from disk. Its dirty pages are written first.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def run_um2nc(args: Sequence[str]) -> float:
+    """Run `amami um2nc` with the command line 'args', and return its wall time (s)"""
+    start = time.perf_counter()
+    Amami(["amami", "um2nc", *args]).run_command_main_function()
+    return time.perf_counter() - start
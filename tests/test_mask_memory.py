@@ -0,0 +1,108 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the masking of pressure level fields, and of its peak memory"""
+
+import tracemalloc
+import numpy as np
+import dask.array as da
+import iris.coords
+import iris.cube
+import pytest
+from amami.commands.um2nc import apply_mask
+
+SHAPE = (4, 8, 360, 480)
+PRESSURES = [1000.0, 925.0, 850.0, 700.0, 600.0, 500.0, 400.0, 300.0]
+HCRIT = 0.5
+
+
+def make_cube(data, pressures=PRESSURES):
+    cube = iris.cube.Cube(data, var_name="field")
+    cube.add_dim_coord(
+        iris.coords.DimCoord(pressures, long_name="pressure", units="hPa"), 1
+    )
+    return cube
+
+
+@pytest.fixture(scope="module")
+def heaviside():
+    rng = np.random.default_rng(0)
+    return make_cube(rng.uniform(0.0, 1.0, SHAPE).astype(np.float32))
+
+
+def field_values(shape=SHAPE, dtype=np.float32):
+    return np.arange(np.prod(shape), dtype=dtype).reshape(shape) % 1000 + 1
+
+
+def peak_memory(function, *args) -> int:
+    """Peak memory (bytes) allocated by the call of 'function'"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def check_masked(cube, values, heaviside):
+    expected_mask = heaviside <= HCRIT
+    assert cube.dtype == np.float32
+    np.testing.assert_array_equal(cube.data.mask, expected_mask)
+    np.testing.assert_allclose(
+        cube.data.compressed(), (values / heaviside)[~expected_mask], rtol=1e-6
+    )
+
+
+def test_apply_mask(heaviside):
+    values = field_values()
+    cube = make_cube(values.copy())
+    apply_mask(cube, heaviside, HCRIT)
+    check_masked(cube, values, heaviside.data)
+
+
+def test_apply_mask_lazy_masked(heaviside):
+    values = np.ma.masked_greater(field_values(dtype=np.float64), 900)
+    cube = make_cube(
+        da.ma.masked_array(values.data, mask=values.mask, chunks=(1, 1) + SHAPE[2:])
+    )
+    apply_mask(cube, heaviside, HCRIT)
+    assert cube.dtype == np.float32
+    expected_mask = values.mask | (heaviside.data <= HCRIT)
+    np.testing.assert_array_equal(cube.data.mask, expected_mask)
+    np.testing.assert_allclose(
+        cube.data.compressed(),
+        (values.data / heaviside.data)[~expected_mask],
+        rtol=1e-6,
+    )
+
+
+def test_apply_mask_levels(heaviside):
+    """Field defined on a subset of the levels of the heaviside function"""
+    levels = [1, 4, 5]
+    values = field_values(SHAPE[:1] + (len(levels),) + SHAPE[2:])
+    cube = make_cube(values.copy(), [PRESSURES[i] for i in levels])
+    apply_mask(cube, heaviside, HCRIT)
+    check_masked(cube, values, heaviside.data[:, levels])
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("lazy", [False, True])
+def test_apply_mask_memory(heaviside, dtype, lazy):
+    """
+    The peak memory of the masking is within the size of the 32-bit masked field
+    (data and mask), plus the temporary comparison with the heaviside function
+    and, for lazy or 64-bit data, the 32-bit data.
+    """
+    values = field_values(dtype=dtype)
+    # Lazy data in 2D chunks, as loaded by iris
+    data = da.from_array(values, chunks=(1, 1) + SHAPE[2:]) if lazy else values.copy()
+    cube = make_cube(data)
+    heaviside.data  # Realised outside of the measure
+    field_size = np.prod(SHAPE) * np.dtype(np.float32).itemsize
+    mask_size = np.prod(SHAPE)
+    limit = 2 * mask_size
+    if lazy or dtype == np.float64:
+        limit += field_size
+    peak = peak_memory(apply_mask, cube, heaviside, HCRIT)
+    assert peak <= limit * 1.1
+    check_masked(cube, values, heaviside.data)
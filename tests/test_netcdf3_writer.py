@@ -0,0 +1,146 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the memory-mapped netCDF3 writer"""
+
+import numpy as np
+import dask.array as da
+import iris.cube
+import iris.coords
+import iris.fileformats.netcdf
+import netCDF4
+import pytest
+from amami.netcdf3_writer import MemmapWriter, map_variable, read_header, set_attribute
+
+FORMATS = ["NETCDF3_CLASSIC", "NETCDF3_64BIT_OFFSET", "NETCDF3_64BIT_DATA"]
+
+
+@pytest.fixture(params=FORMATS)
+def ncfile(request, tmp_path):
+    """netCDF3 file with three record variables, a fixed variable and a scalar"""
+    path = str(tmp_path / "file.nc")
+    with netCDF4.Dataset(path, "w", format=request.param) as dset:
+        dset.createDimension("time", None)
+        dset.createDimension("y", 3)
+        dset.createDimension("x", 5)
+        dset.title = "test"
+        temp = dset.createVariable("temp", "f4", ("time", "y", "x"), fill_value=-1.0)
+        packed = dset.createVariable("packed", "i2", ("time", "x"))
+        packed.scale_factor = np.float32(1.0)
+        packed.add_offset = np.float32(0.0)
+        dset.createVariable("flag", "i1", ("time", "x"))
+        dset.createVariable("orog", "f8", ("y", "x"))
+        dset.createVariable("scalar", "i2")
+        temp[:2] = 0.0
+    return path
+
+
+def test_read_header(ncfile):
+    header = read_header(ncfile)
+    assert header.numrecs == 2
+    assert set(header.variables) == {"temp", "packed", "flag", "orog", "scalar"}
+    temp = header.variables["temp"]
+    assert temp.is_record and temp.shape == (0, 3, 5)
+    assert temp.dtype == np.dtype(">f4") and temp.fill_value == -1.0
+    assert set(temp.attributes) == {"_FillValue"}
+    assert set(header.variables["packed"].attributes) == {"scale_factor", "add_offset"}
+    orog = header.variables["orog"]
+    assert not orog.is_record and orog.shape == (3, 5)
+    # Default netCDF fill value
+    assert header.variables["flag"].fill_value == netCDF4.default_fillvals["i1"]
+    # Padded record sizes of the record variables
+    assert header.recsize == 3 * 5 * 4 + 12 + 8
+
+
+def test_map_variable(ncfile):
+    header = read_header(ncfile)
+    temp = np.arange(30, dtype=np.float32).reshape(2, 3, 5)
+    flag = np.arange(10, dtype=np.int8).reshape(2, 5)
+    orog = np.linspace(0.0, 1.0, 15).reshape(3, 5)
+    for name, values in (("temp", temp), ("flag", flag), ("orog", orog)):
+        target = map_variable(ncfile, header, name)
+        assert target.shape == values.shape
+        target[...] = values
+        del target
+    with netCDF4.Dataset(ncfile) as dset:
+        dset.set_auto_maskandscale(False)
+        np.testing.assert_array_equal(dset["temp"][:], temp)
+        np.testing.assert_array_equal(dset["flag"][:], flag)
+        np.testing.assert_array_equal(dset["orog"][:], orog)
+
+
+def test_set_attribute(ncfile):
+    set_attribute(ncfile, read_header(ncfile), "packed", "scale_factor", 0.5)
+    with netCDF4.Dataset(ncfile) as dset:
+        assert dset["packed"].scale_factor == np.float32(0.5)
+        assert dset["packed"].scale_factor.dtype == np.float32
+        assert dset["packed"].add_offset == 0.0
+        assert dset.title == "test"
+
+
+def test_memmap_writer(ncfile):
+    """Data written in order, packed, with missing values and unwritten records"""
+    temp = np.ma.masked_array(np.full((1, 3, 5), 7.0), mask=np.eye(3, 5)[None])
+    packed = np.ma.masked_array(
+        [[1.0, 2.0, 3.0, 4.0, 5.0], [0.0, 0.5, 1.0, 1.5, 2.0]],
+        mask=[[0] * 5, [1] + [0] * 4],
+    )
+    packing = {
+        "dtype": np.dtype("int16"),
+        "scale_factor": np.float32(0.5),
+        "add_offset": np.float32(1.0),
+    }
+    flag = np.ones((1, 5), dtype=np.int8)
+    orog = np.arange(15.0).reshape(3, 5)
+    writer = MemmapWriter(["temp", "packed", "flag", "orog"])
+    with writer.open(ncfile):
+        writer.write_data(temp)
+        writer.write_data(packed, packing)
+        writer.write_data(flag)
+        writer.write_data(orog)
+    with netCDF4.Dataset(ncfile) as dset:
+        written = dset["temp"][:]
+        np.testing.assert_array_equal(written.mask[0], temp.mask[0])
+        np.testing.assert_array_equal(written[0], temp[0])
+        # The second record is not written by the data
+        assert written.mask[1].all()
+        assert dset["packed"].scale_factor == 0.5 and dset["packed"].add_offset == 1.0
+        np.testing.assert_array_equal(dset["packed"][:], packed)
+        np.testing.assert_array_equal(dset["packed"][:].mask, packed.mask)
+        flags = dset["flag"][:]
+        np.testing.assert_array_equal(flags[0], flag[0])
+        assert flags.mask[1].all()
+        np.testing.assert_array_equal(dset["orog"][:], orog)
+
+
+def test_memmap_writer_too_many_records(ncfile):
+    writer = MemmapWriter(["flag"])
+    with writer.open(ncfile):
+        with pytest.raises(Exception, match="more records"):
+            writer.write_data(np.ones((3, 5), dtype=np.int8))
+
+
+@pytest.mark.parametrize("nc_format", FORMATS)
+def test_memmap_writer_structure(tmp_path, nc_format):
+    """The file is preallocated with the records of the structures written by iris"""
+    path = str(tmp_path / "iris.nc")
+    values = np.arange(24, dtype=np.float32).reshape(4, 2, 3)
+    cube = iris.cube.Cube(np.zeros_like(values), var_name="field", units="K")
+    cube.add_dim_coord(
+        iris.coords.DimCoord(np.arange(4.0), "time", units="days since 2000-01-01"), 0
+    )
+    writer = MemmapWriter()
+    # The iris Saver cannot create CDF5 files, which are created with netCDF4
+    dataset = netCDF4.Dataset(path, "w", format=nc_format)
+    sman = iris.fileformats.netcdf.Saver(dataset, "NETCDF3_64BIT", compute=False)
+    with sman:
+        structure = cube.copy(da.empty(cube.shape, dtype=cube.dtype, chunks=cube.shape))
+        varname = writer.write_structure(sman, structure, unlimited_dimensions=["time"])
+    dataset.close()
+    sman.complete()
+    with writer.open(path):
+        writer.write_data(values)
+    with netCDF4.Dataset(path) as dset:
+        assert dset.dimensions["time"].isunlimited()
+        np.testing.assert_array_equal(dset[varname][:], values)
+        np.testing.assert_array_equal(dset["time"][:], np.arange(4.0))
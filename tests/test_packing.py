@@ -0,0 +1,121 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the packing of floating-point data into small integers"""
+
+import numpy as np
+import dask.array as da
+import netCDF4
+import pytest
+from amami.packing import (
+    PACK_TYPES,
+    get_fill_value,
+    get_packed_range,
+    get_packing,
+    get_unset_packing,
+    pack,
+    to_packable,
+)
+
+
+@pytest.fixture
+def data():
+    """Masked float32 data, with a missing value"""
+    rng = np.random.default_rng(0)
+    values = rng.uniform(-40.0, 310.0, (30, 40)).astype(np.float32)
+    return np.ma.masked_array(values, mask=values > 300)
+
+
+def unpack(packed, packing):
+    """Unpack 'packed' values, masking the fill values"""
+    fill_value = get_fill_value(packing["dtype"])
+    values = packed * np.float64(packing["scale_factor"]) + np.float64(
+        packing["add_offset"]
+    )
+    return np.ma.masked_where(packed == fill_value, values)
+
+
+@pytest.mark.parametrize("pack_type", PACK_TYPES)
+def test_get_packing(data, pack_type):
+    packing = get_packing(data, pack_type)
+    assert packing["dtype"] == np.dtype(pack_type)
+    # The packing attributes have the type of the data
+    assert packing["scale_factor"].dtype == data.dtype
+    assert packing["add_offset"].dtype == data.dtype
+    pmin, pmax = get_packed_range(pack_type)
+    scale = np.float64(packing["scale_factor"])
+    offset = np.float64(packing["add_offset"])
+    assert offset + pmin * scale == pytest.approx(data.min(), rel=1e-6)
+    assert offset + pmax * scale == pytest.approx(data.max(), rel=1e-6)
+
+
+def test_get_packing_lazy(data):
+    lazy = da.ma.masked_array(da.from_array(data.data, chunks=(10, 10)), mask=data.mask)
+    assert get_packing(lazy, "int16") == get_packing(data, "int16")
+
+
+@pytest.mark.parametrize(
+    "digits,packed",
+    [(3, True), (6, False)],
+)
+def test_get_packing_digits(data, digits, packed):
+    assert (get_packing(data, "int16", digits) is not None) == packed
+
+
+def test_get_packing_constant():
+    data = np.full((4, 5), 3.5, dtype=np.float32)
+    packing = get_packing(data, "int16", significant_digits=7)
+    packed = pack(data, **packing, fill_value=get_fill_value("int16"))
+    np.testing.assert_array_equal(unpack(packed, packing), data)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        np.arange(10),
+        np.ma.masked_all((3, 4), dtype=np.float32),
+        np.full((3, 4), np.nan, dtype=np.float32),
+    ],
+)
+def test_get_packing_none(data):
+    assert get_packing(data, "int16") is None
+
+
+@pytest.mark.parametrize("pack_type", PACK_TYPES)
+def test_pack(data, pack_type):
+    packing = get_packing(data, pack_type)
+    data[0, 0] = np.nan
+    fill_value = get_fill_value(pack_type)
+    packed = pack(data, **packing, fill_value=fill_value)
+    assert packed.dtype == np.dtype(pack_type)
+    missing = np.ma.getmaskarray(np.ma.masked_invalid(data))
+    np.testing.assert_array_equal(packed == fill_value, missing)
+    error = np.abs(unpack(packed, packing) - data)
+    assert error.max() <= np.float64(packing["scale_factor"]) / 2 * (1 + 1e-6)
+
+
+@pytest.mark.parametrize("pack_type", PACK_TYPES)
+def test_to_packable(tmp_path, data, pack_type):
+    """netCDF4 packs the converted data exactly as `pack`"""
+    packing = get_packing(data, pack_type)
+    data[0, 0] = np.nan
+    fill_value = get_fill_value(pack_type)
+    path = tmp_path / "packed.nc"
+    with netCDF4.Dataset(path, "w") as dset:
+        dset.createDimension("y", data.shape[0])
+        dset.createDimension("x", data.shape[1])
+        var = dset.createVariable("var", pack_type, ("y", "x"))
+        var.scale_factor = packing["scale_factor"]
+        var.add_offset = packing["add_offset"]
+        var[:] = to_packable(data, packing)
+    with netCDF4.Dataset(path) as dset:
+        dset.set_auto_maskandscale(False)
+        written = dset["var"][:]
+    np.testing.assert_array_equal(written, pack(data, **packing, fill_value=fill_value))
+
+
+def test_get_unset_packing():
+    packing = get_unset_packing(np.float32, "int8")
+    assert packing["dtype"] == np.dtype("int8")
+    assert packing["scale_factor"].dtype == np.float32
+    assert np.isnan(packing["scale_factor"]) and np.isnan(packing["add_offset"])
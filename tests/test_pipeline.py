@@ -0,0 +1,81 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the pipeline of processing stages"""
+
+import threading
+import time
+import pytest
+from amami.pipeline import run_pipeline
+
+STAGES = [lambda x: x + 1, lambda x: None if x % 3 == 0 else x, lambda x: 2 * x]
+
+
+@pytest.mark.parametrize("queue_size", [0, 1, 4])
+def test_order(queue_size):
+    expected = [2 * (x + 1) for x in range(100) if (x + 1) % 3]
+    assert list(run_pipeline(range(100), STAGES, queue_size)) == expected
+
+
+@pytest.mark.parametrize("queue_size", [0, 2])
+@pytest.mark.parametrize("failing", [0, 1, 2])
+def test_exceptions(queue_size, failing):
+    def fail(x):
+        if x == 10:
+            raise RuntimeError("stage failed")
+        return x
+
+    stages = [lambda x: x] * 3
+    stages[failing] = fail
+    with pytest.raises(RuntimeError, match="stage failed"):
+        list(run_pipeline(range(100), stages, queue_size))
+
+
+def test_source_exception():
+    def items():
+        yield 1
+        raise RuntimeError("source failed")
+
+    outputs = run_pipeline(items(), [lambda x: x], 2)
+    assert next(outputs) == 1
+    with pytest.raises(RuntimeError, match="source failed"):
+        next(outputs)
+
+
+def test_bounded():
+    """The source does not run ahead of the stages by more than the queue sizes"""
+    produced = []
+
+    def items():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    outputs = run_pipeline(items(), [lambda x: x, lambda x: x], queue_size=2)
+    assert next(outputs) == 0
+    time.sleep(0.3)
+    # Up to 'queue_size' items in each queue, and one in each stage and the source
+    assert len(produced) <= 3 * 2 + 3 + 1
+    outputs.close()
+
+
+def test_close_stops_threads():
+    outputs = run_pipeline(iter(range(10**6)), [lambda x: x], queue_size=2)
+    next(outputs)
+    nthreads = threading.active_count()
+    outputs.close()
+    assert threading.active_count() <= nthreads - 2
+
+
+def test_overlap():
+    """The stages run at the same time on different items"""
+    delay = 0.05
+
+    def slow(x):
+        time.sleep(delay)
+        return x
+
+    start = time.perf_counter()
+    assert list(run_pipeline(range(10), [slow, slow], queue_size=1)) == list(range(10))
+    # 10 items through 2 stages take about 11 delays (instead of 20) when overlapped
+    assert time.perf_counter() - start < 16 * delay
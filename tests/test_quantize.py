@@ -0,0 +1,118 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the quantization of floating-point data"""
+
+import numpy as np
+import netCDF4
+import pytest
+from amami.quantize import QUANTIZE_MODES, get_max_precision, quantize
+
+PRECISIONS = [
+    ("BitGroom", 3),
+    ("BitGroom", 5),
+    ("BitRound", 9),
+    ("BitRound", 20),
+    ("GranularBitRound", 3),
+    ("GranularBitRound", 6),
+]
+
+
+@pytest.fixture
+def values():
+    """Values of very different magnitudes, with zeros of both signs"""
+    rng = np.random.default_rng(0)
+    values = rng.standard_normal((50, 60)) * np.exp(rng.uniform(-10, 10, (50, 60)))
+    values[0, :2] = [0.0, -0.0]
+    return values
+
+
+def netcdf_quantize(tmp_path, data, nsd, mode):
+    """Quantize 'data' with netCDF-C, by writing it to a file and reading it back"""
+    path = tmp_path / "quantize.nc"
+    with netCDF4.Dataset(path, "w") as dset:
+        dims = [
+            dset.createDimension(f"dim{i}", size).name
+            for i, size in enumerate(data.shape)
+        ]
+        var = dset.createVariable(
+            "var", data.dtype, dims, significant_digits=nsd, quantize_mode=mode
+        )
+        var[:] = data
+    with netCDF4.Dataset(path) as dset:
+        return dset["var"][:].data
+
+
+@pytest.mark.skipif(
+    not getattr(netCDF4, "__has_quantization_support__", False),
+    reason="netCDF-C without quantization support",
+)
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+@pytest.mark.parametrize("mode,nsd", PRECISIONS)
+def test_same_as_netcdf(tmp_path, values, dtype, mode, nsd):
+    data = values.astype(dtype)
+    expected = netcdf_quantize(tmp_path, data, nsd, mode)
+    result = quantize(data.copy(), nsd, mode)
+    # Compare the bits, so that signed zeros are distinguished
+    utype = f"u{data.itemsize}"
+    np.testing.assert_array_equal(result.view(utype), expected.view(utype))
+
+
+@pytest.mark.parametrize("mode,nsd", PRECISIONS)
+def test_byte_order(values, mode, nsd):
+    native = quantize(values.astype("float32"), nsd, mode)
+    big_endian = quantize(values.astype(">f4"), nsd, mode)
+    assert big_endian.dtype == np.dtype(">f4")
+    np.testing.assert_array_equal(big_endian.astype("float32"), native)
+
+
+@pytest.mark.parametrize("mode", QUANTIZE_MODES)
+def test_in_place_masked(values, mode):
+    data = np.ma.masked_array(values.astype("float32"), mask=values > 1)
+    data[1, 1] = np.nan
+    original = data.copy()
+    result = quantize(data, 3, mode)
+    assert result is data
+    assert np.isnan(result.data[1, 1])
+    np.testing.assert_array_equal(result.data[data.mask], original.data[data.mask])
+    changed = result.data != original.data
+    assert changed[~data.mask & ~np.isnan(original.data)].any()
+
+
+@pytest.mark.parametrize("mode,nsd", PRECISIONS)
+def test_precision_kept(values, mode, nsd):
+    data = values.astype("float64")
+    result = quantize(data.copy(), nsd, mode)
+    nonzero = data != 0
+    error = np.abs(result[nonzero] - data[nonzero]) / np.abs(data[nonzero])
+    # A relative error within one unit of the last significant digit (or bit)
+    tolerance = 2.0 ** (1 - nsd) if mode == "BitRound" else 10.0 ** (1 - nsd)
+    assert error.max() < tolerance
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+@pytest.mark.parametrize("mode", QUANTIZE_MODES)
+def test_max_precision(values, dtype, mode):
+    data = values.astype(dtype)
+    nsd = get_max_precision(dtype, mode)
+    quantize(data.copy(), nsd, mode)
+    with pytest.raises(ValueError):
+        quantize(data.copy(), nsd + 1, mode)
+    with pytest.raises(ValueError):
+        quantize(data.copy(), 0, mode)
+
+
+def test_bitgroom_full_precision(values):
+    """No bit can be removed with 7 digits of 32-bit data"""
+    data = values.astype("float32")
+    np.testing.assert_array_equal(quantize(data.copy(), 7, "BitGroom"), data)
+
+
+def test_not_float():
+    data = np.arange(10)
+    np.testing.assert_array_equal(quantize(data, 100), np.arange(10))
+
+
+def test_unknown_mode(values):
+    with pytest.raises(ValueError):
+        quantize(values.astype("float32"), 3, "Unknown")
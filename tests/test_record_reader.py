@@ -0,0 +1,106 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the planned, multithreaded reads of UM records"""
+
+import types
+import numpy as np
+import pytest
+from amami.record_reader import WORD_SIZE, RecordReader, plan_reads
+
+
+def test_plan_reads_sorted():
+    """Records are read in file order, whatever the order they are requested in"""
+    reads = plan_reads([(0, 300, 400), (1, 0, 100), (2, 100, 200)], max_gap=0)
+    assert reads == [
+        [0, 200, [(1, 0, 100), (2, 100, 200)]],
+        [300, 400, [(0, 300, 400)]],
+    ]
+
+
+def test_plan_reads_gap():
+    extents = [(0, 0, 100), (1, 150, 250), (2, 1000, 1100)]
+    reads = plan_reads(extents, max_gap=50)
+    assert [read[:2] for read in reads] == [[0, 250], [1000, 1100]]
+    assert len(plan_reads(extents, max_gap=1000)) == 1
+    assert len(plan_reads(extents, max_gap=0)) == 3
+
+
+def test_plan_reads_max_size():
+    extents = [(i, 100 * i, 100 * (i + 1)) for i in range(10)]
+    reads = plan_reads(extents, max_size=300)
+    assert [read[:2] for read in reads] == [
+        [0, 300],
+        [300, 600],
+        [600, 900],
+        [900, 1000],
+    ]
+    # Larger records are read on their own
+    reads = plan_reads([(0, 0, 500), (1, 500, 600)], max_size=300)
+    assert [read[:2] for read in reads] == [[0, 500], [500, 600]]
+
+
+def test_plan_reads_all_records():
+    rng = np.random.default_rng(0)
+    starts = np.cumsum(rng.integers(1, 1000, 500))
+    extents = [
+        (i, int(start), int(start) + 10)
+        for i, start in enumerate(rng.permutation(starts))
+    ]
+    reads = plan_reads(extents, max_size=5000, max_gap=300)
+    records = [record for _, _, read_records in reads for record in read_records]
+    assert sorted(records) == sorted(extents)
+    for start, stop, read_records in reads:
+        assert stop - start <= 5000
+        assert all(
+            start <= rstart and rstop <= stop for _, rstart, rstop in read_records
+        )
+
+
+@pytest.fixture
+def umfile(tmp_path):
+    """UM-like file with 64 and 32-bit IEEE records, and fields with their data"""
+    rng = np.random.default_rng(0)
+    path = tmp_path / "records.ff"
+    fields = []
+    position = 16
+    with open(path, "wb") as fout:
+        fout.write(b"\0" * position * WORD_SIZE)
+        for i in range(20):
+            data = rng.standard_normal((3 + i % 4, 5))
+            lbpack = 2 if i % 3 == 0 else 0
+            raw = data.astype(">f4" if lbpack == 2 else ">f8").tobytes()
+            nwords = -(-len(raw) // WORD_SIZE) + i % 2
+            fout.write(raw.ljust(nwords * WORD_SIZE, b"\0"))
+            fields.append(
+                types.SimpleNamespace(
+                    lbpack=lbpack,
+                    lbegin=position,
+                    lbnrec=nwords,
+                    lbrow=data.shape[0],
+                    lbnpt=data.shape[1],
+                    lbuser1=1,
+                    bmdi=-1073741824.0,
+                    data=data.astype(np.float32) if lbpack == 2 else data,
+                    get_data=None,
+                )
+            )
+            position += nwords
+    # Fields that are not read directly are read with their 'get_data'
+    fields[5].lbpack = 4
+    fields[5].get_data = lambda: fields[5].data
+    return str(path), fields
+
+
+@pytest.mark.parametrize("nthreads", [1, 4])
+def test_read(umfile, nthreads):
+    path, fields = umfile
+    results = {}
+    order = np.random.default_rng(1).permutation(len(fields))
+    RecordReader(path, nthreads).read(
+        [fields[i] for i in order],
+        lambda i, data: results.setdefault(int(order[i]), data),
+    )
+    assert len(results) == len(fields)
+    for i, field in enumerate(fields):
+        np.testing.assert_array_equal(results[i], field.data)
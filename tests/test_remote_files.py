@@ -0,0 +1,160 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Tests of the access to remote UM and netCDF files, on the fsspec in-memory file
+system and on a local S3 stand-in (moto server).
+"""
+
+import os
+import socket
+import numpy as np
+import pytest
+from amami.exceptions import UMError
+from amami.record_reader import WORD_SIZE
+from amami.um_utils import (
+    DATA_START,
+    FIXED_HEADER_LENGTH,
+    LOOKUP_DIM1,
+    LOOKUP_DIM2,
+    LOOKUP_DTYPE,
+    LOOKUP_START,
+)
+
+fsspec = pytest.importorskip("fsspec")
+from amami.remote_files import fetch_fieldsfile, is_url, upload_file  # noqa: E402
+
+STASH_CODES = [24, 30, 24, 16203, 30, 24]
+# Length (words) of the data records
+RECORD_LENGTH = 512
+
+
+def make_umfile() -> bytes:
+    """UM-like file with a data record per STASH code, and empty lookup entries"""
+    nlookup = len(STASH_CODES) + 2
+    data_start = FIXED_HEADER_LENGTH + nlookup * len(LOOKUP_DTYPE.names) + 100
+    fixed = np.zeros(FIXED_HEADER_LENGTH, dtype=">i8")
+    fixed[LOOKUP_START] = FIXED_HEADER_LENGTH + 1
+    fixed[LOOKUP_DIM1] = len(LOOKUP_DTYPE.names)
+    fixed[LOOKUP_DIM2] = nlookup
+    fixed[DATA_START] = data_start + 1
+    lookup = np.zeros(nlookup, dtype=LOOKUP_DTYPE.newbyteorder(">"))
+    lookup[len(STASH_CODES) :].view(">i8")[:] = -99
+    records = lookup[: len(STASH_CODES)]
+    records["lbrel"] = 3
+    records["lbuser4"] = STASH_CODES
+    records["lbnrec"] = RECORD_LENGTH
+    records["lbegin"] = data_start + RECORD_LENGTH * np.arange(len(STASH_CODES))
+    data = np.arange(len(STASH_CODES) * RECORD_LENGTH, dtype=">f8") + 1
+    header = fixed.tobytes() + lookup.tobytes()
+    return header.ljust(data_start * WORD_SIZE, b"\0") + data.tobytes()
+
+
+def get_record(content: bytes, index: int) -> bytes:
+    start = (
+        len(content) // WORD_SIZE - RECORD_LENGTH * (len(STASH_CODES) - index)
+    ) * WORD_SIZE
+    return content[start : start + RECORD_LENGTH * WORD_SIZE]
+
+
+def check_fetched(url, content, select=None):
+    """Check that the fetched copy of 'url' only has the selected records"""
+    spool = fetch_fieldsfile(url, select)
+    try:
+        with open(spool, "rb") as fspool:
+            fetched = fspool.read()
+    finally:
+        os.remove(spool)
+    assert len(fetched) == len(content)
+    header_size = len(content) - len(STASH_CODES) * RECORD_LENGTH * WORD_SIZE
+    assert fetched[:header_size] == content[:header_size]
+    for i, stash in enumerate(STASH_CODES):
+        if select is None or select(stash):
+            assert get_record(fetched, i) == get_record(content, i)
+        else:
+            assert get_record(fetched, i) == bytes(RECORD_LENGTH * WORD_SIZE)
+
+
+@pytest.fixture
+def memory_fs():
+    fs = fsspec.filesystem("memory")
+    yield fs
+    fs.rm("/amami", recursive=True)
+
+
+def test_is_url():
+    assert is_url("s3://bucket/file")
+    assert is_url("memory://file")
+    assert not is_url("/path/to/file")
+    assert not is_url("archive.tar::member")
+
+
+@pytest.mark.parametrize(
+    "select", [None, lambda stash: stash == 30, lambda stash: False]
+)
+def test_fetch_fieldsfile(memory_fs, select):
+    content = make_umfile()
+    memory_fs.pipe("/amami/file.ff", content)
+    check_fetched("memory://amami/file.ff", content, select)
+
+
+def test_fetch_fieldsfile_errors(memory_fs):
+    with pytest.raises(UMError):
+        fetch_fieldsfile("memory://amami/missing.ff")
+    memory_fs.pipe(
+        "/amami/file.nc", b"CDF\x01".ljust(FIXED_HEADER_LENGTH * WORD_SIZE, b"\0")
+    )
+    with pytest.raises(UMError):
+        fetch_fieldsfile("memory://amami/file.nc")
+
+
+def test_upload_file(tmp_path, memory_fs):
+    path = tmp_path / "file.nc"
+    content = os.urandom(300000)
+    path.write_bytes(content)
+    upload_file(str(path), "memory://amami/file.nc", part_size=100000)
+    assert memory_fs.cat("/amami/file.nc") == content
+
+
+@pytest.fixture(scope="module")
+def s3_endpoint():
+    """Local S3 stand-in (moto server)"""
+    pytest.importorskip("s3fs")
+    moto_server = pytest.importorskip("moto.server")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    yield f"http://127.0.0.1:{port}"
+    server.stop()
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch, s3_endpoint):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # Options of the S3 file systems created from the URLs
+    monkeypatch.setitem(fsspec.config.conf, "s3", {"endpoint_url": s3_endpoint})
+    fs = fsspec.filesystem("s3", skip_instance_cache=True)
+    fs.mkdir("amami-test")
+    yield fs
+    fs.rm("amami-test", recursive=True)
+    fsspec.filesystem("s3").clear_instance_cache()
+
+
+@pytest.mark.parametrize("select", [None, lambda stash: stash in (24, 16203)])
+def test_s3_fetch_fieldsfile(s3_bucket, select):
+    content = make_umfile()
+    s3_bucket.pipe("amami-test/file.ff", content)
+    check_fetched("s3://amami-test/file.ff", content, select)
+
+
+def test_s3_upload_file(tmp_path, s3_bucket):
+    """Multipart upload (S3 parts are at least 5 MiB)"""
+    path = tmp_path / "file.nc"
+    content = os.urandom(12 * 1024**2)
+    path.write_bytes(content)
+    upload_file(str(path), "s3://amami-test/file.nc", part_size=5 * 1024**2)
+    assert s3_bucket.cat("amami-test/file.nc") == content
@@ -0,0 +1,114 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the storage policy of the fields"""
+
+import json
+import numpy as np
+import pytest
+from amami.exceptions import AmamiError
+from amami.storage_policy import FieldStorage, StoragePolicy, convert_data
+
+DEFAULT = FieldStorage(level=4)
+
+
+def write_policy(tmp_path, content) -> str:
+    path = tmp_path / "policy.json"
+    path.write_text(json.dumps(content), encoding="utf-8")
+    return str(path)
+
+
+def test_load(tmp_path):
+    path = write_policy(
+        tmp_path,
+        {
+            "default": {"level": 1},
+            "30201-30288": {"significant_digits": 3, "chunks": [1, 1, 145, 192]},
+            "30250-30260": {"level": 9},
+            "m01s00i030": {"dtype": "int8"},
+            "30255": {"significant_digits": None},
+            "ts": {"pack": "int16"},
+        },
+    )
+    policy = StoragePolicy.load(path, DEFAULT)
+    assert policy.get(16203) == FieldStorage(level=1)
+    assert policy.get(30201) == FieldStorage(
+        level=1, significant_digits=3, chunks=(1, 1, 145, 192)
+    )
+    # Ranges are applied in order, then the item itself
+    assert policy.get(30252).level == 9
+    assert policy.get(30255).significant_digits is None
+    assert policy.get(30255).chunks == (1, 1, 145, 192)
+    assert policy.get(30).dtype == "int8"
+    # All the items with the variable name in the STASH list
+    assert policy.get(24).pack == "int16"
+    assert policy.get(233).pack == "int16"
+
+
+def test_load_command_line_defaults(tmp_path):
+    """The command line settings are kept unless the policy overrides them"""
+    path = write_policy(tmp_path, {"30": {"level": 9}})
+    policy = StoragePolicy.load(path, FieldStorage(codec="none", significant_digits=5))
+    assert policy.get(30) == FieldStorage(codec="none", level=9, significant_digits=5)
+    assert policy.get(24) == FieldStorage(codec="none", significant_digits=5)
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        [],
+        {"default": []},
+        {"default": {"unknown": 1}},
+        {"default": {"codec": "lz4"}},
+        {"default": {"level": 10}},
+        {"default": {"significant_digits": 0}},
+        {"default": {"quantize_mode": "Round"}},
+        {"default": {"pack": "int32"}},
+        {"default": {"dtype": "uint8"}},
+        {"default": {"chunks": [1, 0]}},
+        {"30-x": {"level": 1}},
+        {"not_a_stash_name": {"level": 1}},
+    ],
+)
+def test_load_invalid(tmp_path, content):
+    with pytest.raises(AmamiError):
+        StoragePolicy.load(write_policy(tmp_path, content), DEFAULT)
+
+
+def test_load_unreadable(tmp_path):
+    path = tmp_path / "policy.json"
+    path.write_text("{", encoding="utf-8")
+    with pytest.raises(AmamiError):
+        StoragePolicy.load(str(path), DEFAULT)
+    with pytest.raises(AmamiError):
+        StoragePolicy.load(str(tmp_path / "missing.json"), DEFAULT)
+
+
+@pytest.mark.parametrize(
+    "storage,digits",
+    [
+        (FieldStorage(significant_digits=3), 3),
+        (FieldStorage(significant_digits=3, pack="int16"), None),
+        (FieldStorage(significant_digits=3, dtype="int8"), None),
+        (FieldStorage(significant_digits=3, dtype="float32"), 3),
+    ],
+)
+def test_quantize_digits(storage, digits):
+    assert storage.quantize_digits == digits
+
+
+def test_get_chunksizes():
+    storage = FieldStorage(chunks=(1, 200, 100))
+    assert storage.get_chunksizes((12, 145, 192)) == (1, 145, 100)
+    assert storage.get_chunksizes((145, 192)) is None
+    assert FieldStorage().get_chunksizes((145, 192)) is None
+
+
+def test_convert_data():
+    data = np.ma.masked_array(
+        [0.4, 1.6, -130.0, 127.0, np.nan, 5.0], mask=[0, 0, 0, 0, 0, 1]
+    )
+    converted = convert_data(data, "int8")
+    assert converted.dtype == np.int8
+    np.testing.assert_array_equal(converted.mask, [0, 0, 1, 0, 1, 1])
+    np.testing.assert_array_equal(converted.compressed(), [0, 2, 127])
@@ -0,0 +1,128 @@
+# Copyright 2022 ACCESS-NRI and contributors. See the top-level COPYRIGHT file for details.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tests of the lookup table of UM files"""
+
+import numpy as np
+import pytest
+from amami.exceptions import UMError
+from amami.um_utils import (
+    FIXED_HEADER_LENGTH,
+    LOOKUP_DIM1,
+    LOOKUP_DIM2,
+    LOOKUP_DTYPE,
+    LOOKUP_START,
+    filter_lookup,
+    get_lookup_table,
+    get_stash,
+    get_validity_time,
+    group_lookup,
+    sort_lookup,
+)
+
+# STASH item codes, months and pressure levels of the records
+RECORDS = [
+    (30201, 1, 1000.0),
+    (30201, 1, 500.0),
+    (16203, 1, 1000.0),
+    (30201, 2, 1000.0),
+    (16203, 2, 500.0),
+    (24, 1, 0.0),
+    (30201, 2, 500.0),
+]
+
+
+def make_lookup(records=RECORDS) -> np.ndarray:
+    lookup = np.zeros(len(records), dtype=LOOKUP_DTYPE)
+    lookup["lbyr"] = 2000
+    lookup["lbrel"] = 3
+    lookup["lbdat"] = 1
+    lookup["lbuser4"], lookup["lbmon"], lookup["blev"] = zip(*records)
+    lookup["lbpack"] = [1, 1, 0, 1, 0, 2, 1]
+    return lookup
+
+
+@pytest.fixture
+def umfile(tmp_path):
+    """UM file with the lookup of the RECORDS, followed by empty lookup entries"""
+    lookup = make_lookup()
+    nempty = 3
+    fixed = np.zeros(FIXED_HEADER_LENGTH, dtype=">i8")
+    fixed[LOOKUP_START] = FIXED_HEADER_LENGTH + 1
+    fixed[LOOKUP_DIM1] = len(LOOKUP_DTYPE.names)
+    fixed[LOOKUP_DIM2] = len(lookup) + nempty
+    empty = np.full((nempty, len(LOOKUP_DTYPE.names)), -99, dtype=">i8")
+    path = tmp_path / "file.ff"
+    with open(path, "wb") as fout:
+        fout.write(fixed.tobytes())
+        fout.write(lookup.astype(LOOKUP_DTYPE.newbyteorder(">")).tobytes())
+        fout.write(empty.tobytes())
+    return str(path)
+
+
+def test_get_lookup_table(umfile):
+    lookup = get_lookup_table(umfile)
+    assert lookup.dtype == LOOKUP_DTYPE
+    np.testing.assert_array_equal(lookup, make_lookup())
+
+
+def test_get_stash(umfile):
+    assert get_stash(umfile) == [record[0] for record in RECORDS]
+    assert get_stash(umfile, repeat=False) == [30201, 16203, 24]
+
+
+def test_not_um_file(tmp_path):
+    path = tmp_path / "file.nc"
+    path.write_bytes(b"CDF\x01" + bytes(4000))
+    with pytest.raises(UMError):
+        get_lookup_table(str(path))
+    path.write_bytes(b"short")
+    with pytest.raises(UMError):
+        get_stash(str(path))
+
+
+def test_group_lookup():
+    groups = group_lookup(make_lookup())
+    # Groups in order of first occurrence, with the records in file order
+    assert list(groups) == [(30201,), (16203,), (24,)]
+    np.testing.assert_array_equal(groups[(30201,)], [0, 1, 3, 6])
+    np.testing.assert_array_equal(groups[(16203,)], [2, 4])
+    np.testing.assert_array_equal(groups[(24,)], [5])
+
+
+def test_group_lookup_keys():
+    groups = group_lookup(make_lookup(), ("stash", "level"))
+    assert list(groups) == [
+        (30201, 1000.0),
+        (30201, 500.0),
+        (16203, 1000.0),
+        (16203, 500.0),
+        (24, 0.0),
+    ]
+    np.testing.assert_array_equal(groups[(30201, 500.0)], [1, 6])
+    assert group_lookup(make_lookup()[:0]) == {}
+
+
+def test_filter_lookup():
+    lookup = make_lookup()
+    np.testing.assert_array_equal(filter_lookup(lookup, stash=30201, lbmon=2), [3, 6])
+    np.testing.assert_array_equal(filter_lookup(lookup, stash=[16203, 24]), [2, 4, 5])
+    np.testing.assert_array_equal(filter_lookup(lookup, packing=0), [2, 4])
+    with pytest.raises(UMError):
+        filter_lookup(lookup, unknown=1)
+
+
+def test_sort_lookup():
+    lookup = make_lookup()
+    order = sort_lookup(lookup)
+    np.testing.assert_array_equal(order, [5, 2, 4, 1, 0, 6, 3])
+    np.testing.assert_array_equal(sort_lookup(lookup, ()), np.arange(len(lookup)))
+
+
+def test_get_validity_time():
+    lookup = make_lookup()
+    lookup["lbhr"] = 6
+    np.testing.assert_array_equal(
+        get_validity_time(lookup)[2:5],
+        [20000101060000, 20000201060000, 20000201060000],
+    )